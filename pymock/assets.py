@@ -0,0 +1,135 @@
+import os
+import re
+import gzip
+import time
+import hashlib
+import mimetypes
+import posixpath
+import collections
+
+mimetypes.add_type('font/woff2', '.woff2')
+# extensions worth compressing, setup.py precompresses the same ones
+compressible = ('.html', '.js', '.css', '.json', '.svg', '.txt')
+_html_ref_re = re.compile(r'''((?:src|href)=")([^"#?]+)(")''')
+_css_ref_re = re.compile(r'''(url\(['"]?)([^'")#?]+)([^)]*\))''')
+
+
+class Asset:
+    def __init__(self, path, data, gz, mtime, deps=()):
+        self.path = path
+        self.data = data
+        self.gz = gz
+        self.mtime = mtime
+        self.version = hashlib.sha1(data).hexdigest()[:12]
+        self.etag = f'"{self.version}"'
+        self.gz_etag = f'"{self.version}-gz"'
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if self.content_type.startswith('text/') or self.content_type == 'application/javascript':
+            self.content_type += '; charset=UTF-8'
+        # (path, version) of the assets referenced with ?v=
+        self.deps = deps
+        self.size = len(data) + (len(gz) if gz else 0)
+        self.checked_at = time.monotonic()
+
+
+class AssetCache:
+    # files of the web ui kept in memory with their gzip variants, an asset is
+    # only checked against the disk every check_interval seconds. html and css
+    # references to other assets get a ?v=<content hash> so those can be
+    # cached by browsers for good
+    def __init__(self, root, max_size=32 * 1024 * 1024, check_interval=5):
+        self.root = os.path.abspath(root)
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.size = 0
+        # relative path => Asset, least recently used first
+        self.items = collections.OrderedDict()
+
+    def get(self, path):
+        # None when the path is not a file under root
+        path = posixpath.normpath(path.lstrip('/'))
+        if path.startswith('..') or path == '.' or '\\' in path:
+            return None
+        asset = self.items.get(path)
+        if asset is not None:
+            self.items.move_to_end(path)
+            if time.monotonic() - asset.checked_at < self.check_interval:
+                return asset
+            if self._mtime(path) == asset.mtime and self._deps_current(asset):
+                asset.checked_at = time.monotonic()
+                return asset
+            # a changed reference changes the ?v= of the page too
+            self._remove(path)
+        return self._load(path)
+
+    def _deps_current(self, asset):
+        for dep_path, version in asset.deps:
+            dep = self.get(dep_path)
+            if dep is None or dep.version != version:
+                return False
+        return True
+
+    def _mtime(self, path):
+        try:
+            return os.stat(os.path.join(self.root, path)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _remove(self, path):
+        asset = self.items.pop(path)
+        self.size -= asset.size
+
+    def _load(self, path):
+        file_path = os.path.join(self.root, path)
+        if not os.path.isfile(file_path):
+            return None
+        mtime = os.stat(file_path).st_mtime_ns
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        data = raw
+        deps = []
+        if path.endswith('.html'):
+            data = self._versioned(path, raw, _html_ref_re, deps)
+        elif path.endswith('.css'):
+            data = self._versioned(path, raw, _css_ref_re, deps)
+        gz = None
+        if path.endswith(compressible):
+            if data is raw:
+                gz = self._precompressed(file_path, mtime)
+            if gz is None:
+                gz = gzip.compress(data)
+            if len(gz) >= len(data):
+                gz = None
+        asset = Asset(path, data, gz, mtime, deps)
+        if asset.size <= self.max_size:
+            self.items[path] = asset
+            self.size += asset.size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.items)))
+        return asset
+
+    def _precompressed(self, file_path, mtime):
+        # built by setup.py, ignored once the source file is newer
+        try:
+            if os.stat(f'{file_path}.gz').st_mtime_ns < mtime:
+                return None
+            with open(f'{file_path}.gz', 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _versioned(self, path, raw, ref_re, deps):
+        directory = posixpath.dirname(path)
+
+        def replace(m):
+            ref = m.group(2).strip()
+            if ':' in ref or ref.startswith('/') or ref.endswith('.html') or m.group(3).startswith('?'):
+                return m.group(0)
+            asset = self.get(posixpath.join(directory, ref))
+            if asset is None:
+                return m.group(0)
+            deps.append((asset.path, asset.version))
+            return f'{m.group(1)}{ref}?v={asset.version}{m.group(3)}'
+        data = ref_re.sub(replace, raw.decode('utf-8')).encode('utf-8')
+        # unchanged data may still use the precompressed file
+        return raw if data == raw else data
@@ -0,0 +1,136 @@
+import zlib
+import asyncio
+import logging
+import itertools
+
+logger = logging.getLogger('pymock.tunnel')
+BALANCE_ROUND_ROBIN = 'round_robin'
+BALANCE_LEAST_CONN = 'least_conn'
+BALANCE_HASH = 'hash'
+balance_modes = (BALANCE_ROUND_ROBIN, BALANCE_LEAST_CONN, BALANCE_HASH)
+health_check_options = ('interval', 'timeout', 'fall', 'rise')
+
+
+def health_check_config(config):
+    # checks the "health_check" option of a tunnel mapping, None without
+    # active checks, else the keyword arguments of HealthCheck
+    if config is None or config is False:
+        return None
+    if config is True:
+        return {}
+    if not isinstance(config, dict):
+        raise ValueError(f'health_check should be a boolean or an object with {health_check_options}')
+    unknown = set(config) - set(health_check_options)
+    if unknown:
+        raise ValueError(f'unknown health_check options {sorted(unknown)}, should be in {health_check_options}')
+    for name, value in config.items():
+        if isinstance(value, bool) or not isinstance(value, int if name in ('fall', 'rise') else (int, float)) \
+                or value <= 0:
+            raise ValueError(f'health_check {name} should be a positive number')
+    return config
+
+
+class Backend:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.name = f'{host}:{port}'
+        self.healthy = True
+        self.active = 0
+        self.total = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # consecutive check results, see HealthCheck
+        self.check_failures = 0
+        self.check_successes = 0
+
+    def to_dict(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'healthy': self.healthy,
+            'active': self.active,
+            'total': self.total,
+            'failures': self.failures,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out
+        }
+
+
+class Balancer:
+    def __init__(self, backends, mode=BALANCE_ROUND_ROBIN):
+        if not backends:
+            raise ValueError('tunnel requires at least one destination')
+        if mode not in balance_modes:
+            raise ValueError(f'unknown balance mode {mode}, should be one of {balance_modes}')
+        self.backends = backends
+        self.mode = mode
+        self._rr = itertools.count()
+
+    def candidates(self, peer_ip):
+        # backends in the order they should be tried, the healthy ones first
+        backends = self.backends
+        count = len(backends)
+        if self.mode == BALANCE_HASH:
+            # a peer keeps its backend as long as the backend is healthy,
+            # peers of an ejected backend move to the next one
+            start = zlib.crc32(peer_ip.encode('utf-8')) % count
+        else:
+            start = next(self._rr) % count
+        ordered = backends[start:] + backends[:start]
+        if self.mode == BALANCE_LEAST_CONN:
+            ordered.sort(key=lambda b: b.active)
+        healthy = [b for b in ordered if b.healthy]
+        # with every backend ejected the connection is still attempted
+        return healthy + [b for b in ordered if not b.healthy]
+
+
+class HealthCheck:
+    # active tcp connect checks, a backend is ejected after fall consecutive
+    # failures and restored after rise consecutive successes
+    def __init__(self, backends, desc, interval=5, timeout=2, fall=2, rise=2):
+        self.backends = backends
+        self.desc = desc
+        self.interval = interval
+        self.timeout = timeout
+        self.fall = fall
+        self.rise = rise
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.gather(*[self.check(backend) for backend in self.backends])
+            await asyncio.sleep(self.interval)
+
+    async def check(self, backend):
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(backend.host, backend.port), self.timeout)
+            writer.close()
+            ok = True
+        except (OSError, asyncio.TimeoutError):
+            ok = False
+        self.report(backend, ok)
+
+    def report(self, backend, ok):
+        if ok:
+            backend.check_failures = 0
+            backend.check_successes += 1
+            if not backend.healthy and backend.check_successes >= self.rise:
+                backend.healthy = True
+                logger.info(f'tunnel {self.desc}: backend {backend.name} is healthy')
+        else:
+            backend.check_successes = 0
+            backend.check_failures += 1
+            if backend.healthy and backend.check_failures >= self.fall:
+                backend.healthy = False
+                logger.warning(f'tunnel {self.desc}: backend {backend.name} ejected')
@@ -0,0 +1,664 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import logging
+import subprocess
+
+logger = logging.getLogger('pymock.bench')
+percentiles = (50, 75, 90, 99, 99.9, 99.99)
+# compared with -baseline: name, key, whether higher is better
+compared_results = (
+    ('throughput', ('throughput',), True),
+    ('p50 latency', ('latency_ms', 'p50'), False),
+    ('p99 latency', ('latency_ms', 'p99'), False),
+    ('error rate', ('error_rate',), False),
+    ('tunnel MB/s', ('tunnel_mb_per_sec',), True)
+)
+# bytes written per send of the tunnel benchmark
+tunnel_chunk_size = 256 * 1024
+
+
+class LatencyHistogram:
+    # log-linear buckets in microseconds like HdrHistogram: values below
+    # sub_bucket_count are exact, larger ones keep sub_bits significant bits,
+    # i.e. about 2 significant decimal digits for the default of 8
+    def __init__(self, sub_bits=8):
+        self.sub_bits = sub_bits
+        self.sub_bucket_count = 1 << sub_bits
+        self.half_count = self.sub_bucket_count >> 1
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        return shift * self.half_count + (value >> shift)
+
+    def _highest_equivalent(self, index):
+        if index < self.sub_bucket_count:
+            return index
+        shift = (index - self.half_count) // self.half_count
+        return ((index - shift * self.half_count + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        idx = self._index(value)
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.total += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if self.total == 0:
+            return 0
+        rank = max(1, int(self.total * p / 100 + 0.5))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return min(self._highest_equivalent(idx), self.max)
+        return self.max
+
+    def buckets(self):
+        return [[self._highest_equivalent(idx), self.counts[idx]] for idx in sorted(self.counts)]
+
+    def summary_ms(self):
+        result = {
+            'min': (self.min or 0) / 1000,
+            'mean': self.sum / self.total / 1000 if self.total else 0,
+            'max': self.max / 1000
+        }
+        for p in percentiles:
+            result[f'p{p:g}'] = self.percentile(p) / 1000
+        return result
+
+
+class BenchConnection:
+    # minimal keep-alive http/1.1 client, tornado's client costs more per
+    # request than the mock under test
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, data):
+        if self.writer is None:
+            await self.connect()
+        self.writer.write(data)
+        reader = self.reader
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by the server')
+        status = int(status_line.split(b' ', 2)[1])
+        length = None
+        chunked = False
+        keep_alive = True
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            if name == b'content-length':
+                length = int(value)
+            elif name == b'transfer-encoding':
+                chunked = b'chunked' in value.lower()
+            elif name == b'connection':
+                keep_alive = b'close' not in value.lower()
+        if chunked:
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif length is not None:
+            await reader.readexactly(length)
+        else:
+            await reader.read()
+            keep_alive = False
+        if not keep_alive:
+            self.close()
+        return status
+
+
+class LoadGenerator:
+    # open-loop when rps > 0: requests are scheduled at a fixed rate whatever
+    # the response times and latency is measured from the scheduled time, so
+    # a stalled server is not hidden by the generator waiting for it
+    # (coordinated omission). closed-loop otherwise: every connection sends
+    # its next request as soon as the previous one completes
+    def __init__(self, host, port, requests, connections, rps, timeout):
+        self.host = host
+        self.port = port
+        self.requests = requests
+        self.connections = connections
+        self.rps = rps
+        self.timeout = timeout
+        # requests scheduled before are warmup requests, not measured
+        self.measure_start = float('inf')
+        self.stopped = False
+        self.histogram = LatencyHistogram()
+        self.status = {}
+        self.errors = {}
+        self.completed = 0
+        self.unsent = 0
+        self.queue = asyncio.Queue()
+        self._seq = 0
+
+    def _next_request(self):
+        data = self.requests[self._seq % len(self.requests)]
+        self._seq += 1
+        return data
+
+    def _error(self, name, scheduled):
+        if scheduled >= self.measure_start:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def _send(self, conn, scheduled):
+        try:
+            status = await asyncio.wait_for(conn.request(self._next_request()), self.timeout)
+        except asyncio.TimeoutError:
+            conn.close()
+            self._error('timeout', scheduled)
+            return
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError) as e:
+            conn.close()
+            self._error(type(e).__name__, scheduled)
+            return
+        if scheduled >= self.measure_start:
+            self.histogram.record(time.monotonic() - scheduled)
+            self.completed += 1
+            self.status[status] = self.status.get(status, 0) + 1
+
+    async def _worker(self):
+        conn = BenchConnection(self.host, self.port)
+        try:
+            while not self.stopped:
+                if self.rps > 0:
+                    scheduled = await self.queue.get()
+                    if scheduled is None:
+                        return
+                else:
+                    scheduled = time.monotonic()
+                await self._send(conn, scheduled)
+        finally:
+            conn.close()
+
+    async def _schedule(self, end):
+        interval = 1 / self.rps
+        start = time.monotonic()
+        sent = 0
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                return
+            due = int((now - start) * self.rps) + 1
+            while sent < due:
+                self.queue.put_nowait(start + sent * interval)
+                sent += 1
+            await asyncio.sleep(min(interval, 0.001))
+
+    async def run(self, warmup, duration):
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.connections)]
+        try:
+            if self.rps > 0:
+                start = time.monotonic() + warmup
+                self.measure_start = start
+                await self._schedule(start + duration)
+            else:
+                await asyncio.sleep(warmup)
+                start = self.measure_start = time.monotonic()
+                await asyncio.sleep(duration)
+            elapsed = time.monotonic() - start
+            self.stopped = True
+            # in-flight requests complete or time out, the unsent ones are counted
+            while not self.queue.empty():
+                self.queue.get_nowait()
+                self.unsent += 1
+            for _ in workers:
+                self.queue.put_nowait(None)
+            await asyncio.wait(workers, timeout=self.timeout + 1)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        return elapsed
+
+    def result(self, elapsed):
+        errors = sum(self.errors.values()) + self.unsent
+        server_errors = sum(count for status, count in self.status.items() if status >= 500)
+        total = self.completed + errors
+        return {
+            'duration': round(elapsed, 3),
+            'requests': self.completed,
+            'throughput': round(self.completed / elapsed, 1) if elapsed > 0 else 0,
+            'error_rate': round((errors + server_errors) / total, 6) if total else 0,
+            'errors': dict(self.errors, unsent=self.unsent) if self.unsent else self.errors,
+            'status': {str(status): count for status, count in sorted(self.status.items())},
+            'latency_ms': self.histogram.summary_ms(),
+            'histogram_us': self.histogram.buckets()
+        }
+
+
+class TunnelBench:
+    # bulk one-way transfer through a tunnel of the pymock under test, its
+    # mapping must point to the sink started here on sink_port. the sink
+    # counts the bytes received after the warmup and answers the end of
+    # every connection with a line so in-flight bytes are not lost
+    def __init__(self, host, port, sink_port, connections, timeout):
+        self.host = host
+        self.port = port
+        self.sink_port = sink_port
+        self.connections = connections
+        self.timeout = timeout
+        self.measure_start = float('inf')
+        self.received = 0
+        self.errors = {}
+
+    async def _sink(self, reader, writer):
+        try:
+            while True:
+                data = await reader.read(tunnel_chunk_size)
+                if not data:
+                    break
+                if time.monotonic() >= self.measure_start:
+                    self.received += len(data)
+            writer.write(b'done\n')
+            await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def _sender(self, end):
+        chunk = b'x' * tunnel_chunk_size
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+            return
+        try:
+            while time.monotonic() < end:
+                writer.write(chunk)
+                await asyncio.wait_for(writer.drain(), self.timeout)
+            writer.write_eof()
+            if await asyncio.wait_for(reader.readline(), self.timeout) != b'done\n':
+                raise ConnectionError('tunnel closed before the sink')
+        except (OSError, asyncio.TimeoutError) as e:
+            self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+        finally:
+            writer.close()
+
+    async def run(self, warmup, duration):
+        server = await asyncio.start_server(self._sink, '127.0.0.1', self.sink_port)
+        try:
+            self.measure_start = time.monotonic() + warmup
+            end = self.measure_start + duration
+            await asyncio.gather(*[self._sender(end) for _ in range(self.connections)])
+            return time.monotonic() - self.measure_start
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def result(self, elapsed):
+        return {
+            'duration': round(elapsed, 3),
+            'tunnel_bytes': self.received,
+            'tunnel_mb_per_sec': round(self.received / elapsed / 1024 / 1024, 1) if elapsed > 0 else 0,
+            'errors': self.errors
+        }
+
+
+def _timed(fn, count):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    return {'seconds': round(elapsed, 3), 'ops_per_sec': round(count / elapsed) if elapsed > 0 else 0}
+
+
+def micro_store(opts):
+    # put/get/expire of -keys keys in-process. the keys with a ttl are put
+    # three times so the expiry heap holds stale entries and gets compacted
+    # while they expire. the loop stall is the longest gap between two loop
+    # iterations meanwhile, garbage collections included, and the lag the
+    # time from the last expiry to the last key reclaimed
+    from .store import Store
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    store = Store()
+    keys = [f'key-{i}' for i in range(opts.keys)]
+    result = {'keys': opts.keys}
+
+    def put(ttl=None):
+        for i, key in enumerate(keys):
+            store.put(key, i, ttl)
+
+    def get():
+        for key in keys:
+            store.get(key)
+
+    result['put'] = _timed(put, opts.keys)
+    result['get'] = _timed(get, opts.keys)
+    store.flush_all()
+    # long enough for none to expire before the puts are done
+    ttl = result['put']['seconds'] * 4 + 1
+    result['put_ttl'] = _timed(lambda: put(ttl), opts.keys)
+    put(ttl)
+    put(ttl)
+    last_expiry = time.time() + ttl
+    stall = [0, time.perf_counter()]
+
+    def tick():
+        now = time.perf_counter()
+        stall[0] = max(stall[0], now - stall[1])
+        stall[1] = now
+        if len(store) > 0:
+            loop.call_soon(tick)
+        else:
+            loop.stop()
+    loop.call_soon(tick)
+    loop.run_forever()
+    loop.close()
+    result['expire'] = {
+        'expired': store.expired,
+        'lag_ms': round((time.time() - last_expiry) * 1000, 1),
+        'max_loop_stall_ms': round(stall[0] * 1000, 3)
+    }
+    return result
+
+
+def micro_body(opts):
+    # a request body of 1 KB to 100 MB received in 64 KB chunks: appending
+    # the chunks to a BodyBuffer, then the view of request_body_view against
+    # the bytes copy of request_body. concat is the former bytes += chunk,
+    # quadratic, so only measured up to 10 MB. times are per body
+    from .utils import BodyBuffer
+    chunk_size = 64 * 1024
+    result = {'chunk_size': chunk_size}
+    for size in (1024, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024):
+        chunks = [b'x' * min(chunk_size, size - offset) for offset in range(0, size, chunk_size)]
+        rounds = max(1, 64 * 1024 * 1024 // size)
+        buffers = [BodyBuffer() for _ in range(rounds)]
+
+        def append():
+            for body in buffers:
+                for chunk in chunks:
+                    body.append(chunk)
+
+        def view():
+            for body in buffers:
+                body.getbuffer().release()
+
+        def copy():
+            for body in buffers:
+                body.getvalue()
+
+        def concat():
+            for _ in range(rounds):
+                body = b''
+                for chunk in chunks:
+                    body += chunk
+        item = {}
+        for name, fn in (('append', append), ('view', view), ('copy', copy), ('concat', concat)):
+            if name == 'concat' and size > 10 * 1024 * 1024:
+                continue
+            start = time.perf_counter()
+            fn()
+            item[f'{name}_us'] = round((time.perf_counter() - start) * 1e6 / rounds, 1)
+        result[f'{size // 1024}KB'] = item
+        del buffers
+    return result
+
+
+def micro_rules(opts):
+    # dispatch time of RuleIndex.match with 10 to 10000 rules against the
+    # former linear startswith scan, over paths matching rules spread across
+    # the table and a miss. times are per match
+    from .config import Rule
+    from .router import RuleIndex
+    result = {}
+    for count in (10, 100, 1000, 10000):
+        rules = [Rule(f'/api/v1/service-{i}/', None, '', True) for i in range(count)]
+        rules.append(Rule('/', None, '', True))
+        index = RuleIndex(rules)
+        paths = [f'/api/v1/service-{i}/items/42?q=1' for i in range(0, count, max(1, count // 10))]
+        paths.append('/static/app.js')
+        rounds = max(1, 200000 // len(paths))
+
+        def indexed():
+            for _ in range(rounds):
+                for path in paths:
+                    index.match(path)
+
+        def linear():
+            for _ in range(max(1, rounds // count)):
+                for path in paths:
+                    for rule in rules:
+                        if path.startswith(rule.prefix):
+                            break
+        item = {}
+        for name, fn, matches in (('index', indexed, rounds * len(paths)),
+                                  ('linear', linear, max(1, rounds // count) * len(paths))):
+            start = time.perf_counter()
+            fn()
+            item[f'{name}_us'] = round((time.perf_counter() - start) * 1e6 / matches, 2)
+        result[f'{count} rules'] = item
+    return result
+
+
+micro_benchmarks = {
+    'store': micro_store,
+    'body': micro_body,
+    'rules': micro_rules
+}
+
+
+def report_micro(result, opts):
+    print(f'micro benchmark {opts.micro}')
+    for name, value in result.items():
+        if isinstance(value, dict):
+            value = ', '.join(f'{k}={v}' for k, v in value.items())
+        print(f'  {name:<12} {value}')
+
+
+def build_requests(opts, host, port):
+    body = b'x' * opts.body_size
+    requests = []
+    for path in opts.path or ['/']:
+        head = f'{opts.method} {path} HTTP/1.1\r\nHost: {host}:{port}\r\n'
+        for header in opts.header or []:
+            head += f'{header}\r\n'
+        if body or opts.method in ('POST', 'PUT', 'PATCH'):
+            head += f'Content-Length: {len(body)}\r\n'
+        requests.append(head.encode('latin-1') + b'\r\n' + body)
+    return requests
+
+
+def wait_port(host, port, proc, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'pymock exited with code {proc.returncode}')
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'pymock not listening on {host}:{port} after {timeout}s')
+
+
+def start_server(opts):
+    args = [sys.executable, '-m', 'pymock.main', '-wd', opts.wd, '-mp', str(opts.mp), '-cp', str(opts.cp),
+            '-addr', '127.0.0.1', '-workers', str(opts.workers)]
+    if opts.no_splice:
+        args.append('-no-splice')
+    log = open(os.path.join(opts.wd, 'bench-server.log'), 'w')
+    logger.info(f'starting {" ".join(args)}')
+    proc = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_port('127.0.0.1', opts.mp, proc)
+        if opts.tunnel:
+            wait_port('127.0.0.1', opts.tunnel, proc)
+    except Exception:
+        stop_server(proc)
+        raise
+    return proc
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def _lookup(result, key):
+    for part in key:
+        result = result.get(part) if isinstance(result, dict) else None
+    return result
+
+
+def compare(result, baseline, threshold):
+    regressions = []
+    for name, key, higher_better in compared_results:
+        current = _lookup(result, key)
+        previous = _lookup(baseline, key)
+        if current is None or previous is None:
+            continue
+        if higher_better:
+            change = (previous - current) / previous if previous else 0
+        elif key == ('error_rate',):
+            # an absolute floor, a relative change of a tiny error rate means nothing
+            change = current - previous if current - previous > 0.001 else 0
+        else:
+            change = (current - previous) / previous if previous else 0
+        status = 'REGRESSION' if change > threshold else 'ok'
+        print(f'  {name:<12} {previous:>12g} -> {current:<12g} {status}')
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def report(result, opts):
+    latency = result['latency_ms']
+    mode = f'{opts.rps} rps open-loop' if opts.rps > 0 else 'closed-loop'
+    print(f'{mode}, {opts.c} connections, {result["duration"]}s')
+    print(f'  requests     {result["requests"]}')
+    print(f'  throughput   {result["throughput"]} req/s')
+    print(f'  error rate   {result["error_rate"]:.4%} {result["errors"] or ""}')
+    print(f'  status       {result["status"]}')
+    print('  latency (ms)')
+    for name in ['min', 'mean'] + [f'p{p:g}' for p in percentiles] + ['max']:
+        print(f'    {name:<8} {latency[name]:10.3f}')
+
+
+def report_tunnel(result, opts):
+    print(f'tunnel {opts.tunnel} => sink {opts.sink_port}, {opts.c} connections, {result["duration"]}s')
+    print(f'  transferred  {result["tunnel_bytes"]} bytes')
+    print(f'  throughput   {result["tunnel_mb_per_sec"]} MB/s')
+    if result['errors']:
+        print(f'  errors       {result["errors"]}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pymock bench')
+    parser.add_argument('-wd', default='.', help='working directory of the pymock under test, with its config.json')
+    parser.add_argument('-target', help='host:port of a running mock, no pymock is started')
+    parser.add_argument('-mp', type=int, default=18080, help='mock port of the started pymock')
+    parser.add_argument('-cp', type=int, default=18081, help='controller port of the started pymock')
+    parser.add_argument('-workers', type=int, default=0, help='workers of the started pymock')
+    parser.add_argument('-path', action='append', help='request path, repeat to rotate over several')
+    parser.add_argument('-method', default='GET', help='request method')
+    parser.add_argument('-header', action='append', help='extra request header "Name: value"')
+    parser.add_argument('-body-size', type=int, default=0, help='request body size in bytes')
+    parser.add_argument('-rps', type=int, default=0, help='target requests per second, 0 for closed-loop')
+    parser.add_argument('-c', type=int, default=50, help='connections')
+    parser.add_argument('-d', type=float, default=10, help='measured duration in seconds')
+    parser.add_argument('-warmup', type=float, default=2, help='warmup duration in seconds, not measured')
+    parser.add_argument('-timeout', type=float, default=10, help='request timeout in seconds')
+    parser.add_argument('-tunnel', type=int, help='measure the throughput of this tunnel port instead of the mock')
+    parser.add_argument('-sink-port', type=int, default=18090, help='port of the sink the benchmarked tunnel maps to')
+    parser.add_argument('-no-splice', action='store_true', help='start pymock with -no-splice')
+    parser.add_argument('-micro', choices=sorted(micro_benchmarks), help='run an in-process micro benchmark instead')
+    parser.add_argument('-keys', type=int, default=1000000, help='keys of the store micro benchmark')
+    parser.add_argument('-o', help='write the json result to this file')
+    parser.add_argument('-baseline', help='json result to compare with, exit code 1 on regression')
+    parser.add_argument('-threshold', type=float, default=0.1, help='relative change reported as a regression')
+    opts = parser.parse_args(argv)
+    opts.wd = os.path.abspath(opts.wd)
+    if opts.micro:
+        result = micro_benchmarks[opts.micro](opts)
+        report_micro(result, opts)
+        if opts.o:
+            with open(opts.o, 'w', encoding='utf-8') as out:
+                json.dump(result, out, indent=2)
+        return 0
+
+    proc = None
+    if opts.target:
+        host, _, port = opts.target.rpartition(':')
+        port = int(port)
+    else:
+        host, port = '127.0.0.1', opts.mp
+        proc = start_server(opts)
+    try:
+        if opts.tunnel:
+            generator = TunnelBench(host, opts.tunnel, opts.sink_port, opts.c, opts.timeout)
+        else:
+            generator = LoadGenerator(host, port, build_requests(opts, host, port), opts.c, opts.rps, opts.timeout)
+        elapsed = asyncio.run(generator.run(opts.warmup, opts.d))
+    finally:
+        if proc is not None:
+            stop_server(proc)
+
+    result = generator.result(elapsed)
+    if opts.tunnel:
+        result['options'] = {
+            'tunnel': opts.tunnel,
+            'connections': opts.c,
+            'splice': not opts.no_splice
+        }
+        report_tunnel(result, opts)
+    else:
+        result['options'] = {
+            'paths': opts.path or ['/'],
+            'method': opts.method,
+            'body_size': opts.body_size,
+            'rps': opts.rps,
+            'connections': opts.c,
+            'workers': opts.workers
+        }
+        report(result, opts)
+    if opts.o:
+        with open(opts.o, 'w', encoding='utf-8') as out:
+            json.dump(result, out, indent=2)
+    if opts.baseline:
+        with open(opts.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f'compared with {opts.baseline}')
+        regressions = compare(result, baseline, opts.threshold)
+        if regressions:
+            print(f'regressions: {", ".join(regressions)}')
+            return 1
+    return 0
@@ -0,0 +1,164 @@
+import time
+import logging
+import collections
+from email.utils import parsedate_to_datetime
+from tornado import httputil
+
+logger = logging.getLogger('pymock.cache')
+cacheable_status = (200, 203, 300, 301, 404, 410)
+
+
+def _parse_cache_control(value):
+    directives = {}
+    for part in value.split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+
+def _parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def cache_options(cache):
+    # checks the "cache" option of a rule or forward(), None when not
+    # cached, else a dict with the optional ttl and vary
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return {}
+    if not isinstance(cache, dict):
+        raise ValueError('cache should be a boolean or an object with ttl and vary')
+    unknown = set(cache) - {'ttl', 'vary'}
+    if unknown:
+        raise ValueError(f'unknown cache options {sorted(unknown)}')
+    ttl = cache.get('ttl')
+    if ttl is not None and (isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl < 0):
+        raise ValueError('cache ttl should be a number of seconds')
+    vary = cache.get('vary', ())
+    if not isinstance(vary, (list, tuple)) or not all(isinstance(name, str) for name in vary):
+        raise ValueError('cache vary should be a list of header names')
+    return cache
+
+
+def freshness_lifetime(headers, ttl=None, request_headers=None):
+    # seconds the response stays fresh, None if it must not be stored
+    cache_control = _parse_cache_control(headers.get('Cache-Control', ''))
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return None
+    # the response to an authorized request is only shared when the origin
+    # allows it, RFC 7234 section 3.2
+    if request_headers is not None and 'Authorization' in request_headers and \
+            not {'public', 's-maxage', 'must-revalidate'} & set(cache_control):
+        return None
+    if headers.get('Vary', '').strip() == '*':
+        return None
+    # the cookie of one client would be replayed to the others
+    if 'Set-Cookie' in headers:
+        return None
+    if ttl is not None:
+        return ttl
+    if 'no-cache' in cache_control:
+        # stored only to be revalidated, which needs a validator
+        return 0 if 'ETag' in headers or 'Last-Modified' in headers else None
+    for name in ('s-maxage', 'max-age'):
+        if name in cache_control:
+            try:
+                return max(0, int(cache_control[name]))
+            except ValueError:
+                return 0
+    if 'Expires' in headers:
+        expires_at = _parse_http_date(headers['Expires'])
+        if expires_at is None:
+            return 0
+        date = _parse_http_date(headers.get('Date', '')) or time.time()
+        return max(0, expires_at - date)
+    if 'ETag' in headers or 'Last-Modified' in headers:
+        # no explicit freshness, store it and revalidate every time
+        return 0
+    return None
+
+
+class CacheEntry:
+    def __init__(self, status, reason, headers, body, lifetime):
+        self.status = status
+        self.reason = reason
+        self.headers = httputil.HTTPHeaders(headers)
+        self.body = body
+        self.size = len(body or b'') + sum(len(k) + len(v) for k, v in self.headers.get_all())
+        self.expires_at = time.time() + lifetime
+        self.etag = self.headers.get('ETag')
+        self.last_modified = self.headers.get('Last-Modified')
+
+    def fresh(self):
+        return self.expires_at > time.time()
+
+    def revalidatable(self):
+        return self.etag is not None or self.last_modified is not None
+
+    def refresh(self, headers, lifetime):
+        for name in ('Cache-Control', 'Expires', 'Date', 'ETag', 'Last-Modified'):
+            if name in headers:
+                self.headers[name] = headers[name]
+        self.etag = self.headers.get('ETag')
+        self.last_modified = self.headers.get('Last-Modified')
+        self.expires_at = time.time() + lifetime
+
+
+class ResponseCache:
+    # byte-size bounded LRU cache of upstream responses used by forward()
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.hit_bytes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(method, uri, headers, vary=()):
+        return (method, uri) + tuple(headers.get(name, '') for name in vary)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        self.remove(key)
+        self.entries[key] = entry
+        self.bytes += entry.size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'hit_bytes': self.hit_bytes,
+            'evictions': self.evictions
+        }
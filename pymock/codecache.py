@@ -0,0 +1,143 @@
+import os
+import time
+import struct
+import marshal
+import hashlib
+import logging
+import importlib.util
+
+from . import metrics
+
+logger = logging.getLogger('pymock.config')
+_header = struct.Struct('<4sqq')
+
+
+class CodeCache:
+    # processor and controller files are only executed again when their
+    # mtime or size changed, compiled code may also be kept on disk like
+    # __pycache__ so a restart skips compiling unchanged files
+    def __init__(self, directory=None):
+        self.directory = directory
+        # (path, var_name) => ((mtime_ns, size), value)
+        self.items = {}
+        # path => ((mtime_ns, size), code)
+        self.codes = {}
+        self.hits = 0
+        self.executed = 0
+        self.compiled = 0
+        self.disk_hits = 0
+        self.load_time = 0.0
+
+    def set_directory(self, directory):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+    def prepare(self, file):
+        # the part of a load that touches the disk, the config reloads run it
+        # in the executor and load on the loop thread
+        st = os.stat(file)
+        self._code(file, (st.st_mtime_ns, st.st_size))
+
+    def load(self, file, var_name, scope, force=False):
+        # executes the code of the last prepare of the file
+        if file not in self.codes:
+            self.prepare(file)
+        version, code = self.codes[file]
+        cached = self.items.get((file, var_name))
+        if not force and cached is not None and cached[0] == version:
+            self.hits += 1
+            return cached[1]
+        start = time.monotonic()
+        exec(code, scope)
+        if var_name not in scope:
+            raise ValueError(f'no {var_name} defined in {file}')
+        value = scope[var_name]
+        self.items[(file, var_name)] = (version, value)
+        self.executed += 1
+        elapsed = time.monotonic() - start
+        self.load_time += elapsed
+        logger.debug(f'{file}:{var_name} loaded in {elapsed * 1000:.1f}ms')
+        return value
+
+    def _code(self, file, version):
+        cached = self.codes.get(file)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        code = self._read_disk(file, version)
+        if code is None:
+            with open(file, encoding='utf-8') as f:
+                source = f.read()
+            code = compile(source, file, 'exec')
+            self.compiled += 1
+            self._write_disk(file, version, code)
+        else:
+            self.disk_hits += 1
+        self.codes[file] = (version, code)
+        return code
+
+    def _disk_path(self, file):
+        digest = hashlib.sha1(os.path.abspath(file).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f'{os.path.basename(file)}.{digest}.pyc')
+
+    def _read_disk(self, file, version):
+        if not self.directory:
+            return None
+        try:
+            with open(self._disk_path(file), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < _header.size:
+            return None
+        magic, mtime_ns, size = _header.unpack_from(data)
+        if magic != importlib.util.MAGIC_NUMBER or (mtime_ns, size) != version:
+            return None
+        try:
+            return marshal.loads(data[_header.size:])
+        except (EOFError, ValueError, TypeError):
+            logger.warning(f'invalid code cache of {file}')
+            return None
+
+    def _write_disk(self, file, version, code):
+        if not self.directory:
+            return
+        path = self._disk_path(file)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_header.pack(importlib.util.MAGIC_NUMBER, *version))
+                f.write(marshal.dumps(code))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'code cache of {file} not written: {e}')
+
+    def checkpoint(self):
+        return (self.hits, self.executed, self.compiled, self.disk_hits, self.load_time)
+
+    def summary(self, checkpoint):
+        hits, executed, compiled, disk_hits, load_time = (
+            now - before for now, before in zip(self.checkpoint(), checkpoint))
+        total = hits + executed
+        hit_rate = hits / total if total else 0
+        return (f'{total} files, {hits} unchanged ({hit_rate:.0%}), {executed} executed in {load_time * 1000:.1f}ms '
+                f'({compiled} compiled, {disk_hits} from the disk cache)')
+
+
+code_cache = CodeCache()
+
+
+def _collect_metrics():
+    result = []
+    for name, help, value in (
+            ('pymock_code_cache_hits_total', 'file loads skipped as unchanged', code_cache.hits),
+            ('pymock_code_cache_executed_total', 'file loads executed', code_cache.executed),
+            ('pymock_code_cache_compiled_total', 'files compiled', code_cache.compiled),
+            ('pymock_code_cache_disk_hits_total', 'code objects read from the disk cache', code_cache.disk_hits)):
+        metric = metrics.Collected(name, 'counter', help)
+        metric.add(value=value)
+        result.append(metric)
+    return result
+
+
+metrics.add_collector(_collect_metrics)
@@ -1,108 +1,196 @@
 import logging
 import re
 import json
+import time
+import asyncio
 import os.path
+from tornado import ioloop
 from .utils import normalize_path
-from .tunnel import Tunnel, ControllerBase, reload_tunnel
+from .tunnel import Tunnel, ControllerBase, reload_tunnel, get_tunnel
+from .shaping import Shaping
+from .balancer import BALANCE_ROUND_ROBIN, health_check_config
+from .router import RuleIndex, MATCH_FIRST
+from .codecache import code_cache
+from .cache import cache_options
+from . import replay
 
 logger = logging.getLogger('pymock.config')
 config_file = 'config.json'
-rule_list = []
 controller_list = []
+# False in the -workers supervisor, the rules are kept for the watcher but
+# their processors and replay indexes are only loaded by the workers
+load_mocks = True
+# serializes reloads, the code cache is not shared between loader threads
+_reload_lock = asyncio.Lock()
 
 
-def _load_item(file, var_name, scope={}):
+def _prepare_item(file):
     if not os.path.isfile(file):
         raise ValueError(f'{file} is not a file')
-    with open(file, encoding='utf-8') as f:
-        code = f.read()
-    exec(code, scope)
-    if var_name not in scope:
-        raise ValueError(f'no {var_name} defined in {file}')
-    logger.debug(f'{file}:{var_name} loaded')
-    return scope[var_name]
+    code_cache.prepare(file)
 
 
-def load_mock_processor(file):
-    processor = _load_item(file, 'processor')
+def _load_item(file, var_name, scope=None, force=False):
+    # every file runs in its own globals, unchanged files are not executed
+    # again unless forced
+    return code_cache.load(file, var_name, {} if scope is None else dict(scope), force)
+
+
+def load_mock_processor(file, force=False):
+    processor = _load_item(file, 'processor', force=force)
     if not callable(processor):
         raise ValueError('processor should be callable')
     return processor
 
 
-def load_tunnel_controller(file):
-    controller = _load_item(file, 'Controller', scope={'ControllerBase': ControllerBase})
+def load_tunnel_controller(file, force=False):
+    controller = _load_item(file, 'Controller', scope={'ControllerBase': ControllerBase}, force=force)
     if not issubclass(controller, ControllerBase):
         raise ValueError(f'Controller should be subclass of ControllerBase')
     return controller
 
 
 class Rule:
-    def __init__(self, prefix, processor, file_path, strip):
+    def __init__(self, prefix, processor, file_path, strip, cache=None):
         self.prefix = prefix
         self.strip = strip
         self.processor = processor
         self.file_path = file_path
+        self.cache = cache
+
+    def with_processor(self, processor):
+        return Rule(self.prefix, processor, self.file_path, self.strip, self.cache)
+
+
+class RuleTable:
+    # never modified once published, a reload builds a new table and replaces
+    # rule_table so a request matches against one consistent table
+    def __init__(self, rules, match_mode=MATCH_FIRST):
+        self.index = RuleIndex(rules, match_mode)
+        self.rules = self.index.rules
+        self.match_mode = match_mode
+
+    def with_processor(self, file, processor):
+        rules = [rule.with_processor(processor) if rule.file_path == file else rule for rule in self.rules]
+        return RuleTable(rules, self.match_mode)
+
+    def match(self, path):
+        return self.index.match(path)
+
+
+rule_table = RuleTable(())
+
+
+async def mock_processor(ctx):
+    # rule_table is read once, a reload while the request runs does not affect it
+    rule = rule_table.match(ctx.request.path)
+    if rule is None:
+        ctx.logger.error(f'no processor found for {ctx.request.path}')
+        ctx.set_status(404)
+        return
+    logger.debug('found matched processor: ' + rule.file_path)
+    ctx.rule = rule
+    if rule.strip:
+        prefix_len = len(rule.prefix)
+        ctx.request.path = ctx.request.path[prefix_len:]
+        ctx.request.uri = ctx.request.uri[prefix_len:]
+    await rule.processor(ctx)
+
+
+def _run_in_executor(func, *args):
+    # files are read off the loop, in the executor set up by main, and
+    # executed on the loop thread where processors may use the loop
+    return ioloop.IOLoop.current().run_in_executor(None, func, *args)
 
 
-async def reload_file(file, mock):
+async def reload_file(file, mock, tunnels=True):
+    async with _reload_lock:
+        return await _reload_file(file, mock, tunnels)
+
+
+async def _reload_file(file, mock, tunnels):
+    global rule_table
     if file == config_file:
-        generator, tunnel_list = load_config()
-        mock.set_processor(generator)
-        await reload_tunnel(tunnel_list)
+        start = time.monotonic()
+        checkpoint = code_cache.checkpoint()
+        config = await _run_in_executor(read_config)
+        table, tunnel_list = build_config(config, start, checkpoint)
+        publish_config(table, tunnel_list)
+        mock.set_processor(mock_processor)
+        if tunnels:
+            await reload_tunnel(tunnel_list)
         return 'config file reloaded'
     else:
-        for item in rule_list:
-            if item.file_path == file:
-                processor = load_mock_processor(file)
-                item.processor = processor
-                return 'processor file reloaded'
-        for item in controller_list:
-            if item['file_path'] == file:
-                controller_cls = load_tunnel_controller(file)
-                item['tunnel'].controller_cls = controller_cls
-                return 'controller file reloaded'
+        if any(rule.file_path == file for rule in rule_table.rules):
+            if not load_mocks:
+                return 'processor file reloaded by the workers'
+            await _run_in_executor(_prepare_item, file)
+            processor = load_mock_processor(file, True)
+            rule_table = rule_table.with_processor(file, processor)
+            return 'processor file reloaded'
+        items = [item for item in controller_list if item['file_path'] == file]
+        if items:
+            await _run_in_executor(_prepare_item, file)
+            controller_cls = load_tunnel_controller(file, True)
+            for item in items:
+                # the running tunnel, which may have been kept by a config reload
+                t = get_tunnel(item['port'])
+                if t is not None:
+                    t.controller_cls = controller_cls
+            return 'controller file reloaded'
     return 'unregistered file, ignore'
 
 
-def generate_mock_processor(config):
+def watched_files():
+    files = {config_file}
+    files.update(rule.file_path for rule in rule_table.rules if os.path.isfile(rule.file_path))
+    files.update(item['file_path'] for item in controller_list)
+    return files
+
+
+def generate_rule_table(config):
+    match_mode = config['mock_match'] if 'mock_match' in config else MATCH_FIRST
     if 'mock' in config:
-        rule_list.clear()
+        rules = []
         for idx, item in enumerate(config['mock']):
             if 'prefix' not in item:
                 raise ValueError(f'prefix required for rules[{idx}]')
-            if 'file' not in item:
-                raise ValueError(f'file required for rules[{idx}]')
             prefix = item['prefix']
-            file_path = normalize_path(item['file'])
-            processor = load_mock_processor(file_path)
+            if 'replay' in item:
+                # serve recorded responses, "replay": true or a recordings directory
+                directory = item['replay'] if isinstance(item['replay'], str) else 'recordings'
+                file_path = normalize_path(directory)
+                # "replay_fallback": true serves the latest recording of the method and path
+                # when no request matches the query and body
+                fallback = item.get('replay_fallback', False) is True
+                processor = replay.get_index(file_path).processor(fallback) if load_mocks else None
+            elif 'file' in item:
+                file_path = normalize_path(item['file'])
+                processor = load_mock_processor(file_path) if load_mocks else None
+            else:
+                raise ValueError(f'file or replay required for rules[{idx}]')
             strip = item['strip'] if 'strip' in item else True
-            rule = Rule(prefix, processor, file_path, strip)
-            rule_list.append(rule)
-    async def mock_processor(ctx):
-        for rule in rule_list:
-            if ctx.request.path.startswith(rule.prefix):
-                logger.debug('found matched processor: ' + rule.file_path)
-                if rule.strip:
-                    prefix_len = len(rule.prefix)
-                    ctx.request.path = ctx.request.path[prefix_len:]
-                    ctx.request.uri = ctx.request.uri[prefix_len:]
-                await rule.processor(ctx)
-                return
-        ctx.logger.error(f'no processor found for {ctx.request.path}')
-        ctx.set_status(404)
-    return mock_processor
+            # "cache": true or {"ttl": seconds, "vary": [header names]} for forward()
+            try:
+                cache = cache_options(item.get('cache'))
+            except ValueError as e:
+                raise ValueError(f'{e} for rules[{idx}]')
+            rule = Rule(prefix, processor, file_path, strip, cache)
+            rules.append(rule)
+    else:
+        rules = rule_table.rules
+    return RuleTable(rules, match_mode)
 
 
 def load_tunnels(config):
     tunnel_list = []
     if 'tunnel' in config:
-        controller_list.clear()
         tunnel_cfg = config['tunnel']
         if 'mappings' in tunnel_cfg:
-            for mapping in tunnel_cfg['mappings']:
-                if 'port' not in mapping or 'dest_host' not in mapping or 'dest_port' not in mapping:
-                    logger.error('port|dest_host|dest_port is required for tunnel mappings')
+            for idx, mapping in enumerate(tunnel_cfg['mappings']):
+                if 'port' not in mapping or not mapping.get('destinations') and \
+                        ('dest_host' not in mapping or 'dest_port' not in mapping):
+                    logger.error('port and dest_host|dest_port or destinations are required for tunnel mappings')
                     exit(1)
                 if 'controller' in mapping:
                     controller_file = normalize_path(mapping['controller'])
@@ -110,17 +198,68 @@ def load_tunnels(config):
                 else:
                     controller_file = None
                     controller_cls = None
-                tunnel = Tunnel(mapping['port'], mapping['dest_host'], mapping['dest_port'], controller_cls)
+                shaping = None
+                if mapping.get('shaping'):
+                    shaping = Shaping.from_config(mapping['shaping'])
+                # a list of {"host": ..., "port": ...} or "host:port"
+                destinations = []
+                for dest in mapping.get('destinations', []):
+                    if isinstance(dest, str):
+                        host, _, dest_port = dest.rpartition(':')
+                        destinations.append((host, int(dest_port)))
+                    else:
+                        destinations.append((dest['host'], dest['port']))
+                try:
+                    health_check = health_check_config(mapping.get('health_check'))
+                except ValueError as e:
+                    raise ValueError(f'{e} for tunnel mappings[{idx}]')
+                tunnel = Tunnel(mapping['port'], mapping.get('dest_host'), mapping.get('dest_port'), controller_cls,
+                                shaping, destinations, mapping.get('balance', BALANCE_ROUND_ROBIN), health_check)
+                # "splice": false relays through the event loop like a tunnel with a controller
+                tunnel.use_splice = mapping.get('splice', True) is not False
+                # a reload keeps the running tunnel when its mapping is the same
+                tunnel.signature = json.dumps(mapping, sort_keys=True)
+                tunnel.controller_file = controller_file
                 tunnel_list.append(tunnel)
-                if controller_file:
-                    controller_list.append({
-                        'tunnel': tunnel,
-                        'file_path': controller_file
-                    })
     return tunnel_list
 
 
-def load_config():
+def read_config():
+    # the disk reads of a config load: the config, the code of the files it
+    # names and the replay indexes. reloads run it in the executor
     with open(config_file, encoding='utf-8') as f:
         config = json.loads(f.read())
-    return generate_mock_processor(config), load_tunnels(config)
\ No newline at end of file
+    if load_mocks:
+        for item in config.get('mock', []):
+            if 'replay' in item:
+                replay.get_index(normalize_path(item['replay'] if isinstance(item['replay'], str) else 'recordings'))
+            elif 'file' in item:
+                _prepare_item(normalize_path(item['file']))
+    for mapping in config.get('tunnel', {}).get('mappings', []):
+        if 'controller' in mapping:
+            _prepare_item(normalize_path(mapping['controller']))
+    return config
+
+
+def build_config(config, start, checkpoint):
+    # executes the files read by read_config and builds the rule table and
+    # tunnels on the loop thread, publish_config makes them current
+    result = generate_rule_table(config), load_tunnels(config)
+    elapsed = (time.monotonic() - start) * 1000
+    logger.info(f'config loaded in {elapsed:.1f}ms, {code_cache.summary(checkpoint)}')
+    return result
+
+
+def publish_config(table, tunnel_list):
+    global rule_table, controller_list
+    controller_list = [{'port': t.port, 'file_path': t.controller_file} for t in tunnel_list if t.controller_file]
+    rule_table = table
+    replay.close_indexes({rule.file_path for rule in table.rules})
+
+
+def load_config():
+    start = time.monotonic()
+    checkpoint = code_cache.checkpoint()
+    table, tunnel_list = build_config(read_config(), start, checkpoint)
+    publish_config(table, tunnel_list)
+    return mock_processor, tunnel_list
\ No newline at end of file
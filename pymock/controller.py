@@ -1,21 +1,31 @@
-from tornado import web, websocket, httpserver
+from tornado import web, websocket, httpserver, ioloop
 import os
+import re
+import sys
 import json
-import functools
-import traceback
 import asyncio
+import stat
+import tempfile
+import collections
+import traceback
+import time
 from http import HTTPStatus
 import logging
 import ssl
 import base64
 
 from .utils import normalize_path, randstr, socket_nolinger
+from .wshandler import LogFilter
+from .assets import AssetCache
+from .shaping import Shaping, shaping_options
 from .config import reload_file, load_config
-from . import tunnel
+from . import tunnel, mock, metrics, search
 
 logger = logging.getLogger('pymock.controller')
 log_clients = []
 server_password = None
+# first-last or -suffix of a "bytes=" range
+_byte_range_re = re.compile(r'^(\d*)-(\d*)$')
 
 
 class BasicAuthHandler(web.RequestHandler):
@@ -61,12 +71,61 @@ class CommonRequestHandler(BasicAuthHandler):
         self.set_header('Cache-control', 'no-cache')
         self.write(text)
 
+    def get_int_argument(self, name, default, minimum, maximum):
+        value = self.get_query_argument(name, None)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise web.HTTPError(HTTPStatus.BAD_REQUEST, f'{name} should be an integer')
+        return min(max(value, minimum), maximum)
+
     def compute_etag(self):
         return None
 
 
-class FileWithAuthHandler(BasicAuthHandler, web.StaticFileHandler):
-    pass
+class StaticAssetHandler(BasicAuthHandler):
+    # web ui files from an AssetCache, gzip encoded when the client accepts
+    # it, requested with the current ?v= they are cached for a year
+    def initialize(self, assets):
+        self.assets = assets
+
+    def head(self, path):
+        return self.get(path, include_body=False)
+
+    def get(self, path, include_body=True):
+        asset = self.assets.get(path)
+        if asset is None:
+            raise web.HTTPError(HTTPStatus.NOT_FOUND)
+        self.set_header('Content-Type', asset.content_type)
+        if self.get_query_argument('v', None) == asset.version:
+            self.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+        else:
+            self.set_header('Cache-Control', 'no-cache')
+        data = asset.data
+        etag = asset.etag
+        if asset.gz is not None:
+            self.set_header('Vary', 'Accept-Encoding')
+            if _accepts_gzip(self.request.headers.get('Accept-Encoding', '')):
+                self.set_header('Content-Encoding', 'gzip')
+                data = asset.gz
+                etag = asset.gz_etag
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(HTTPStatus.NOT_MODIFIED)
+            return
+        self.set_header('Content-Length', len(data))
+        if include_body:
+            self.write(data)
+
+
+def _accepts_gzip(accept_encoding):
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        if coding.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
 
 
 class FileCommonHandler(CommonRequestHandler):
@@ -85,90 +144,272 @@ class FileCommonHandler(CommonRequestHandler):
         return self.path
 
 
+def _in_executor(func, *args):
+    return ioloop.IOLoop.current().run_in_executor(None, func, *args)
+
+
+def _scan_dir(path):
+    # runs in the executor, a directory may hold a lot of recordings, entries
+    # are kept as names and only the listed page is turned into dicts
+    dirs = []
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                dirs.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+    # directories first, then by name
+    dirs.sort()
+    files.sort()
+    return len(dirs), dirs + files
+
+
+class DirListingCache:
+    # sorted listings of the recently listed directories, a listing is scanned
+    # again when the directory mtime changes, which happens when entries are
+    # added, removed or renamed
+    def __init__(self, capacity=32):
+        self.capacity = capacity
+        # path => ((st_ino, st_mtime_ns), (dir_count, names))
+        self.items = collections.OrderedDict()
+        # path => future of a running scan, concurrent requests share it
+        self.scans = {}
+
+    async def get(self, path):
+        st = os.stat(path)
+        version = (st.st_ino, st.st_mtime_ns)
+        cached = self.items.get(path)
+        if cached is not None and cached[0] == version:
+            self.items.move_to_end(path)
+            return cached[1]
+        scan = self.scans.get(path)
+        if scan is None:
+            scan = self.scans[path] = asyncio.ensure_future(self._scan(path, version))
+        return await asyncio.shield(scan)
+
+    async def _scan(self, path, version):
+        try:
+            listing = await _in_executor(_scan_dir, path)
+        finally:
+            del self.scans[path]
+        self.items[path] = (version, listing)
+        self.items.move_to_end(path)
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+        return listing
+
+
+dir_listing_cache = DirListingCache()
+
+
 class FileListHandler(FileCommonHandler):
-    def get(self):
+    async def get(self):
         path = self.get_path()
         if not os.path.isdir(path):
             self.send_error(HTTPStatus.METHOD_NOT_ALLOWED)
             return
+        offset = self.get_int_argument('offset', 0, 0, sys.maxsize)
+        limit = self.get_int_argument('limit', 500, 1, 5000)
         lst = []
-        lst.append({
-            'type': 'dir',
-            'path': '..',
-            'name': '..'
-        })
-        with os.scandir(path) as it:
-            for entry in it:
-                if entry.is_dir() or entry.is_file():
-                    entry_type = 'dir' if entry.is_dir() else 'file'
-                    lst.append({
-                        'type': entry_type,
-                        'path': entry.path,
-                        'name': entry.name
-                    })
-        def entry_cmp(e1, e2):
-            if e1['type'] == 'dir' and e2['type'] == 'file':
-                return -1
-            if e1['type'] == 'file' and e2['type'] == 'dir':
-                return 1
-            return int(e1['name'] > e2['name'])
-        lst.sort(key=functools.cmp_to_key(entry_cmp))
+        if offset == 0:
+            lst.append({
+                'type': 'dir',
+                'path': '..',
+                'name': '..'
+            })
+        dir_count, names = await dir_listing_cache.get(path)
+        for idx in range(offset, min(offset + limit, len(names))):
+            name = names[idx]
+            lst.append({
+                'type': 'dir' if idx < dir_count else 'file',
+                'path': os.path.join(path, name),
+                'name': name
+            })
+        next_offset = offset + limit
         self.write_json({
             'current_path': path,
-            'entries': lst
+            'entries': lst,
+            'total': len(names),
+            'next_offset': next_offset if next_offset < len(names) else None
         })
 
 
 class ReloadHandler(FileCommonHandler):
-    def initialize(self, mock):
+    def initialize(self, mock, workers):
         self.mock = mock
+        self.workers = workers
 
     async def post(self):
         path = self.get_path()
         if not os.path.isfile(path):
             self.send_error(HTTPStatus.METHOD_NOT_ALLOWED)
             return
-        message = await reload_file(path, self.mock)
+        try:
+            message = await reload_file(path, self.mock)
+        except ValueError as e:
+            # an invalid config, the running one is kept
+            raise web.HTTPError(HTTPStatus.BAD_REQUEST, str(e))
+        if self.workers:
+            await self.workers.broadcast_reload(path)
         self.write(message)
 
 
+def _parse_range(header, size):
+    # (start, end) of a single "bytes=" range, end excluded, None to send the
+    # whole file, raises ValueError when the range is not satisfiable
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    m = _byte_range_re.match(spec.strip())
+    # a syntactically invalid range is ignored, RFC 7233 section 2.1
+    if m is None or not m.group(1) and not m.group(2):
+        return None
+    if not m.group(1):
+        # suffix range, the last bytes of the file
+        length = int(m.group(2))
+        if length == 0 or size == 0:
+            raise ValueError('range not satisfiable')
+        return max(size - length, 0), size
+    start = int(m.group(1))
+    end = int(m.group(2)) + 1 if m.group(2) else size
+    if m.group(2) and end <= start:
+        return None
+    if start >= size:
+        raise ValueError('range not satisfiable')
+    return start, min(end, size)
+
+
+def _open_upload(path):
+    # the upload is written next to the file and renamed over it once complete
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=directory or '.')
+    os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+    return os.fdopen(fd, 'wb'), tmp_path
+
+
+def _commit_upload(f, tmp_path, path):
+    try:
+        f.close()
+        os.replace(tmp_path, path)
+    except OSError:
+        _discard_upload(f, tmp_path)
+        raise
+
+
+def _discard_upload(f, tmp_path):
+    f.close()
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+def _create_file(file_path, file_type):
+    if file_type == 'folder':
+        os.mkdir(file_path)
+    else:
+        open(file_path, 'a').close()
+
+
+@web.stream_request_body
 class FileHandler(FileCommonHandler):
-    def get(self):
-        path = self.get_path()
-        if not os.path.isfile(path):
-            self.send_error(HTTPStatus.METHOD_NOT_ALLOWED)
-            return
-        with open(path, encoding='utf-8') as f:
-            self.write_text(f.read())
+    # file contents are streamed in chunks and the disk io runs in the
+    # executor, large recordings do not block the mocks sharing the loop
+    chunk_size = 64 * 1024
+    max_upload_size = 1024 * 1024 * 1024
 
-    def put(self):
+    def initialize(self):
+        super().initialize()
+        # (file, temp path) of a PUT, set before prepare may fail
+        self.upload = None
+
+    async def prepare(self):
+        super().prepare()
+        if self.request.method == 'PUT':
+            path = self.get_path()
+            if not os.path.isfile(path):
+                raise web.HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+            self.request.connection.set_max_body_size(self.max_upload_size)
+            self.upload = await _in_executor(_open_upload, path)
+
+    async def data_received(self, chunk):
+        if self.upload is not None:
+            await _in_executor(self.upload[0].write, chunk)
+
+    def on_finish(self):
+        self._discard_upload()
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        self._discard_upload()
+
+    def _discard_upload(self):
+        if self.upload is not None:
+            f, tmp_path = self.upload
+            self.upload = None
+            _in_executor(_discard_upload, f, tmp_path)
+
+    async def get(self):
         path = self.get_path()
         if not os.path.isfile(path):
             self.send_error(HTTPStatus.METHOD_NOT_ALLOWED)
             return
-        content = str(self.request.body, encoding='utf-8')
-        with open(path, encoding='utf-8', mode='w') as f:
-            f.write(content)
+        f = await _in_executor(open, path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size
+            range_header = self.request.headers.get('Range')
+            if range_header:
+                try:
+                    file_range = _parse_range(range_header, size)
+                except ValueError:
+                    self.set_status(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.set_header('Content-Range', f'bytes */{size}')
+                    return
+                if file_range is not None:
+                    start, end = file_range
+                    self.set_status(HTTPStatus.PARTIAL_CONTENT)
+                    self.set_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+            self.set_header('Content-Type', 'text/plain')
+            self.set_header('Cache-control', 'no-cache')
+            self.set_header('Accept-Ranges', 'bytes')
+            self.set_header('Content-Length', end - start)
+            if start:
+                await _in_executor(f.seek, start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = await _in_executor(f.read, min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self.write(chunk)
+                await self.flush()
+        finally:
+            _in_executor(f.close)
+
+    async def put(self):
+        f, tmp_path = self.upload
+        self.upload = None
+        await _in_executor(_commit_upload, f, tmp_path, self.get_path())
 
-    def post(self):
+    async def post(self):
         path = self.get_path()
         if not os.path.isdir(path):
             self.send_error(HTTPStatus.BAD_REQUEST)
             return
         file_name = self.get_query_argument('name')
         file_type = self.get_query_argument('type')
-        file_path = os.path.join(path, file_name)
-        if file_type == 'folder':
-            os.mkdir(file_path)
-        elif file_type == 'file':
-            open(file_path, 'a').close()
-        else:
+        if file_type not in ('folder', 'file'):
             self.send_error(HTTPStatus.BAD_REQUEST)
+            return
+        await _in_executor(_create_file, os.path.join(path, file_name), file_type)
 
 
 def _get_tunnel(handler):
     port = handler.get_query_argument('port')
-    t = tunnel.get_tunnel(port)
+    # tunnels are keyed by the int port of the config
+    t = tunnel.get_tunnel(int(port)) if port.isdigit() else None
     if not t:
         raise web.HTTPError(HTTPStatus.NOT_FOUND, f'tunnel[{port}] not found')
     return t
@@ -189,7 +430,10 @@ class TunnelServerHandler(CommonRequestHandler):
             'port': t.port,
             'dest_host': t.dest_host,
             'dest_port': t.dest_port,
-            'status': t.status
+            'status': t.status,
+            'shaping': t.shaping.to_dict() if t.shaping is not None else None,
+            'balance': t.balancer.mode,
+            'backends': [b.to_dict() for b in t.backends]
         } for t in tunnel_list])
 
     async def post(self):
@@ -202,6 +446,18 @@ class TunnelServerHandler(CommonRequestHandler):
             t = _get_tunnel(self)
             await t.stop()
             self.write_text('tunnel stopped')
+        elif action == 'shape':
+            # applies to new connections and at once to the ones not spliced
+            t = _get_tunnel(self)
+            options = {name: self.get_query_argument(name) for name in shaping_options
+                       if self.get_query_argument(name, None)}
+            shaping = Shaping(**(t.shaping.to_dict() if t.shaping is not None else {}))
+            try:
+                shaping.update(**options)
+            except ValueError as e:
+                raise web.HTTPError(HTTPStatus.BAD_REQUEST, str(e))
+            t.shaping = shaping if shaping.active() else None
+            self.write_json(shaping.to_dict())
         else:
             raise web.HTTPError(HTTPStatus.BAD_REQUEST, f'unknown action {action}')
 
@@ -212,7 +468,8 @@ class TunnelConnectionHandler(CommonRequestHandler):
         self.write_json([{
             'conn_id': c.conn_id,
             'peer_ip': c.peer_ip,
-            'peer_port': c.peer_port
+            'peer_port': c.peer_port,
+            'backend': c.backend.name if c.backend is not None else None
         } for c in t.connections.values()])
 
     async def post(self):
@@ -232,52 +489,150 @@ class TunnelConnectionHandler(CommonRequestHandler):
             raise web.HTTPError(HTTPStatus.BAD_REQUEST, f'unknown action {action}')
 
 
+class CacheHandler(CommonRequestHandler):
+    # every -workers process has its own cache, the totals come with the
+    # stats of each worker, {"error": ...} for the ones not answering
+    def initialize(self, workers):
+        self.workers = workers
+
+    async def get(self):
+        if not self.workers:
+            self.write_json(mock.response_cache.stats())
+            return
+        answers = await self.workers.query('stats')
+        stats = [answer.get('cache', answer) for answer in answers]
+        totals = {}
+        for worker_stats in stats:
+            if 'error' in worker_stats:
+                continue
+            for key, value in worker_stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals[key] = totals.get(key, 0) + value
+        totals['workers'] = stats
+        self.write_json(totals)
+
+    async def post(self):
+        action = self.get_query_argument('action')
+        if action == 'clear':
+            if not self.workers:
+                mock.response_cache.clear()
+                self.write_text('cache cleared')
+                return
+            answers = await self.workers.query('cache-clear')
+            lines = [f'worker[{idx}] {answer["error"]}' for idx, answer in enumerate(answers) if 'error' in answer]
+            cleared = len(answers) - len(lines)
+            self.write_text('\n'.join([f'cache cleared on {cleared}/{len(answers)} workers'] + lines))
+        else:
+            raise web.HTTPError(HTTPStatus.BAD_REQUEST, f'unknown action {action}')
+
+
+class StoreHandler(CommonRequestHandler):
+    async def get(self):
+        self.write_json(await mock.store.stats_async())
+
+    def post(self):
+        action = self.get_query_argument('action')
+        if action == 'flush':
+            mock.store.flush_all()
+            self.write_text('store flushed')
+        else:
+            raise web.HTTPError(HTTPStatus.BAD_REQUEST, f'unknown action {action}')
+
+
+class MetricsHandler(CommonRequestHandler):
+    def initialize(self, workers):
+        self.workers = workers
+
+    async def get(self):
+        if self.workers:
+            # the mock metrics are the workers', with a worker label
+            answers = await self.workers.query('stats')
+            self.write_text(metrics.render([(idx, answer.get('metrics')) for idx, answer in enumerate(answers)]))
+        else:
+            self.write_text(metrics.render())
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+
+
+class RecordingSearchHandler(CommonRequestHandler):
+    async def get(self):
+        if search.search_index is None:
+            raise web.HTTPError(HTTPStatus.NOT_FOUND, 'recordings are not indexed')
+        query = self.get_query_argument('q', '')
+        offset = self.get_int_argument('offset', 0, 0, sys.maxsize)
+        limit = self.get_int_argument('limit', 20, 1, 100)
+        try:
+            result = await _in_executor(search.search_index.search, query, offset, limit)
+        except ValueError as e:
+            raise web.HTTPError(HTTPStatus.BAD_REQUEST, str(e))
+        self.write_json(result)
+
+
 class LogWSHandler(websocket.WebSocketHandler):
-    def initialize(self):
+    def initialize(self, workers):
+        # the workers only forward their log records while clients are connected
+        self.workers = workers
         self.client_id = randstr(10)
-        self.queue = asyncio.Queue(100)
-        self.task = asyncio.create_task(self.start())
-
-    async def start(self):
-        while True:
-            log = await self.queue.get()
-            self.write_message(log)
+        self.connected_at = time.time()
+        # sequence of the next log record to send, see WebsocketHandler._send_batch
+        self.log_seq = None
+        self.log_filter = None
+        self.dropped = 0
+        self._write_future = None
 
     def open(self):
         logger.debug(f'[{self.client_id}] log client connected')
         log_clients.append(self)
+        if self.workers is not None:
+            self.workers.set_forward_logs(True)
 
     def on_message(self, message):
-        # ignore client message
-        pass
+        # subscription filter, an empty object subscribes to everything
+        try:
+            spec = json.loads(message)
+            if not isinstance(spec, dict):
+                raise ValueError('filter should be an object')
+            self.log_filter = LogFilter(spec) if spec else None
+        except (ValueError, re.error) as e:
+            self.write_message(json.dumps([f'invalid log filter: {e}']))
+            return
+        logger.debug(f'[{self.client_id}] log filter: {spec}')
 
     def on_close(self):
-        logger.debug(f'[{self.client_id}] log client disconnected')
+        logger.debug(f'[{self.client_id}] log client disconnected, {self.dropped} log lines dropped')
         log_clients.remove(self)
-        self.task.cancel()
+        if self.workers is not None:
+            self.workers.set_forward_logs(bool(log_clients))
+
+    def sending(self):
+        return self._write_future is not None and not self._write_future.done()
 
-    def send_log(self, log):
+    def send_logs(self, lines):
         try:
-            self.queue.put_nowait(log)
-        except asyncio.QueueFull:
-            logger.warn(f'[{self.client_id}] log queue full')
+            self._write_future = self.write_message(json.dumps(lines))
+        except websocket.WebSocketClosedError:
+            pass
 
 
 def get_log_clients():
     return log_clients
 
 
-def setup_controller(mock, port, https, addr):
+def setup_controller(mock, port, https, addr, workers=None):
     res_dir = os.path.join(os.path.dirname(__file__), 'res')
     app = web.Application([
         (r'/', web.RedirectHandler, {'url': '/static/index.html'}),
-        (r'/static/(.*)', FileWithAuthHandler, {'path': res_dir}),
+        (r'/static/(.*)', StaticAssetHandler, {'assets': AssetCache(res_dir)}),
         (r'/file/list', FileListHandler),
         (r'/file', FileHandler),
-        (r'/file/reload', ReloadHandler, {'mock': mock}),
-        (r'/ws/logs', LogWSHandler),
+        (r'/file/reload', ReloadHandler, {'mock': mock, 'workers': workers}),
+        (r'/ws/logs', LogWSHandler, {'workers': workers}),
         (r'/tunnel', TunnelServerHandler),
-        (r'/tunnel/connection', TunnelConnectionHandler)
+        (r'/tunnel/connection', TunnelConnectionHandler),
+        (r'/cache', CacheHandler, {'workers': workers}),
+        # with -workers the store is the supervisor's, shared with the workers
+        (r'/store', StoreHandler),
+        (r'/metrics', MetricsHandler, {'workers': workers}),
+        (r'/recordings/search', RecordingSearchHandler)
     ])
     if https:
         ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
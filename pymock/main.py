@@ -1,10 +1,14 @@
 from concurrent.futures import ThreadPoolExecutor
 from tornado import ioloop
 import os
-from . import mock, tunnel, controller
+from . import mock, tunnel, controller, replay, workers, store, watcher, search, config
+from .persistence import StorePersistence
+from .store_server import StoreServer, RemoteStore
 from .utils import init_logging, set_verbose
-from .config import load_config
+from .config import load_config, reload_file
+from .codecache import code_cache
 import argparse
+import functools
 import logging
 import sys
 import asyncio
@@ -15,6 +19,9 @@ logger = logging.getLogger('pymock.main')
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        from . import bench
+        sys.exit(bench.main(sys.argv[2:]))
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose logging')
     parser.add_argument('-mp', type=int, default=8080, help='mock port')
@@ -23,6 +30,22 @@ def main():
     parser.add_argument('-p', help='password')
     parser.add_argument('-addr', default='0.0.0.0', help='bind ip address')
     parser.add_argument('-https', action='store_true', help='use https for webui')
+    parser.add_argument('-cache-size', type=int, default=64, help='forward response cache size in MB')
+    parser.add_argument('-store-maxmemory', type=int, default=0, help='store memory limit in MB, 0 for unlimited')
+    parser.add_argument('-store-policy', default=store.POLICY_LRU, choices=store.eviction_policies,
+                        help='store eviction policy')
+    parser.add_argument('-store-dir', help='directory to persist the store in, disabled by default')
+    parser.add_argument('-store-snapshot-interval', type=int, default=300, help='seconds between store snapshots')
+    parser.add_argument('-store-serve', help='share the store with other processes on this unix socket')
+    parser.add_argument('-store-connect', help='use the store served on this unix socket')
+    parser.add_argument('-code-cache', help='directory to keep compiled processor and controller files in')
+    parser.add_argument('-watch', action='store_true', help='reload config, rule and controller files on change')
+    parser.add_argument('-watch-interval', type=float, default=1, help='polling interval without inotify')
+    parser.add_argument('-no-splice', action='store_true', help='relay tunnels through the event loop, not os.splice')
+    parser.add_argument('-workers', type=int, default=0,
+                        help='number of mock worker processes, each with its own store without -store-serve')
+    parser.add_argument('-worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('-reply-fd', type=int, help=argparse.SUPPRESS)
     opts = parser.parse_args()
     if opts.verbose:
         set_verbose()
@@ -39,14 +62,70 @@ def main():
     mock_port = opts.mp
     controller_port = opts.cp
     controller.server_password = opts.p
+    tunnel.splice_enabled = not opts.no_splice
+    mock.response_cache.max_bytes = opts.cache_size * 1024 * 1024
+    if opts.code_cache:
+        code_cache.set_directory(opts.code_cache)
+    mock.store.configure(opts.store_maxmemory * 1024 * 1024, opts.store_policy)
+    if opts.workers > 0 and opts.store_dir and not opts.store_serve and not opts.store_connect:
+        # without a shared store every worker has its own, which is not persisted
+        print('-store-dir with -workers requires -store-serve or -store-connect', file=sys.stderr)
+        exit(1)
+    store_server = None
+    if opts.store_connect:
+        mock.store = RemoteStore(opts.store_connect)
+    elif opts.store_serve:
+        store_server = StoreServer(mock.store, opts.store_serve)
+        ioloop.IOLoop.current().run_sync(store_server.start)
+    persistence = None
+    if opts.store_dir and not opts.store_connect:
+        persistence = StorePersistence(mock.store, opts.store_dir, opts.store_snapshot_interval)
+        persistence.restore()
+        persistence.start()
 
-    mocker = mock.setup_mock(mock_port, opts.addr)
-    mock_processor, tunnel_list = load_config()
-    mocker.set_processor(mock_processor)
-    tunnel.setup_tunnel(tunnel_list)
+    worker_pool = None
+    if opts.worker:
+        # serve the mock port only, controller and tunnels stay in the supervisor
+        mocker = mock.setup_mock(mock_port, opts.addr, reuse_port=True)
+        replay.setup_replay(mock.recorder)
+        mock_processor, _ = load_config()
+        mocker.set_processor(mock_processor)
+        ioloop.IOLoop.current().spawn_callback(
+            workers.read_commands, mocker, functools.partial(reload_file, tunnels=False), opts.reply_fd)
+    else:
+        if opts.workers > 0:
+            if os.name == 'nt':
+                print('-workers is not supported on windows', file=sys.stderr)
+                exit(1)
+            worker_args = ['-mp', str(mock_port), '-addr', opts.addr, '-cache-size', str(opts.cache_size)]
+            if opts.store_connect or opts.store_serve:
+                # the workers share the store, every one has its own otherwise
+                worker_args += ['-store-connect', opts.store_connect or opts.store_serve]
+            else:
+                worker_args += ['-store-maxmemory', str(opts.store_maxmemory), '-store-policy', opts.store_policy]
+            if opts.code_cache:
+                worker_args += ['-code-cache', opts.code_cache]
+            if opts.verbose:
+                worker_args.append('-v')
+            worker_pool = workers.WorkerPool(opts.workers, worker_args)
+            # the supervisor keeps a delegate for config reloads but does not serve mocks
+            mocker = mock.MockConnectionDelegate()
+            config.load_mocks = False
+        else:
+            mocker = mock.setup_mock(mock_port, opts.addr)
+            replay.setup_replay(mock.recorder)
+        mock_processor, tunnel_list = load_config()
+        mocker.set_processor(mock_processor)
+        tunnel.setup_tunnel(tunnel_list)
 
-    controller.setup_controller(mocker, controller_port, opts.https, opts.addr)
-    mock.setup_wslogs()
+        # the controller indexes the recordings of the workers too
+        search.setup_search(mock.recorder)
+        controller.setup_controller(mocker, controller_port, opts.https, opts.addr, worker_pool)
+        log_handler = mock.setup_wslogs()
+        if worker_pool:
+            worker_pool.log_handler = log_handler
+        if opts.watch:
+            watcher.setup_watcher(mocker, worker_pool, opts.watch_interval)
 
     # setup event loop
     _executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tornado")
@@ -59,11 +138,25 @@ def main():
         period_check.start()
     else:
         loop.add_signal_handler(signal.SIGTERM, lambda: _ioloop.stop())
+    if worker_pool:
+        worker_pool.start()
     try:
-        logger.info(f'starting server, mock_port={mock_port}, controller_port={controller_port}')
+        if opts.worker:
+            logger.info(f'starting worker, pid={os.getpid()}, mock_port={mock_port}')
+        else:
+            logger.info(f'starting server, mock_port={mock_port}, controller_port={controller_port}, workers={opts.workers}')
         _ioloop.start()
     except KeyboardInterrupt as e:
         pass
+    if worker_pool:
+        worker_pool.stop()
+    if persistence:
+        persistence.close()
+    if store_server:
+        ioloop.IOLoop.current().run_sync(store_server.stop)
+    mock.recorder.close()
+    replay.close_indexes()
+    search.close_search()
     logger.info(f'server stopped')
 
 
@@ -0,0 +1,170 @@
+import bisect
+import logging
+
+logger = logging.getLogger('pymock.metrics')
+# metrics are only updated from the event loop thread, so the hot path is a
+# plain dict lookup and an integer add, without any locking
+registry = []
+collectors = []
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        values = self.values
+        values[labels] = values.get(labels, 0) + amount
+
+    def expose(self):
+        for labels, value in self.values.items():
+            yield f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}'
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        self.values[labels] = value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = buckets
+        # labels => [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def expose(self):
+        bounds = self.buckets + (float('inf'),)
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}'
+            label_str = _format_labels(self.label_names, labels)
+            yield f'{self.name}_sum{label_str} {total}'
+            yield f'{self.name}_count{label_str} {cumulative}'
+
+
+class Collected:
+    # metric sampled at scrape time by a collector, see add_collector
+    def __init__(self, name, type, help, labels=()):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+
+    def add(self, *labels, value):
+        self.values[labels] = value
+
+    def expose(self):
+        return Counter.expose(self)
+
+
+def add_collector(collector):
+    # collector() returns a list of Collected, called on every scrape
+    collectors.append(collector)
+
+
+def _merge(families, worker, text):
+    # adds the samples rendered by a worker process with a worker label
+    label = f'worker="{_escape(worker)}"'
+    family = None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            name, _, help = line[7:].partition(' ')
+            family = families.setdefault(name, [help, None, []])
+        elif line.startswith('# TYPE '):
+            if family is not None and family[1] is None:
+                family[1] = line[7:].partition(' ')[2]
+        elif line and family is not None:
+            name, sep, rest = line.partition('{')
+            if sep:
+                family[2].append(f'{name}{{{label},{rest}')
+            else:
+                name, _, value = line.partition(' ')
+                family[2].append(f'{name}{{{label}}} {value}')
+
+
+def render(workers=None):
+    # workers is a list of (worker, text rendered by it or None when it did
+    # not answer) in the -workers supervisor
+    metrics = list(registry)
+    for collector in collectors:
+        try:
+            metrics.extend(collector())
+        except Exception:
+            logger.exception('error collecting metrics')
+    if workers is not None:
+        up = Collected('pymock_worker_up', 'gauge', 'whether the worker answered the scrape', ('worker',))
+        for worker, text in workers:
+            up.add(worker, value=0 if text is None else 1)
+        metrics.append(up)
+    # name => [help, type, samples], the samples of a family stay together
+    families = {}
+    for metric in metrics:
+        families[metric.name] = [metric.help, metric.type, list(metric.expose())]
+    for worker, text in workers or ():
+        if text is not None:
+            _merge(families, worker, text)
+    lines = []
+    for name, (help, type, samples) in families.items():
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {type}')
+        lines.extend(samples)
+    lines.append('')
+    return '\n'.join(lines)
+
+
+mock_requests = Counter('pymock_requests_total', 'mock requests by rule prefix and status', ('rule', 'status'))
+mock_received_bytes = Counter('pymock_received_bytes_total', 'mock request body bytes by rule prefix', ('rule',))
+mock_sent_bytes = Counter('pymock_sent_bytes_total', 'mock response body bytes by rule prefix', ('rule',))
+processor_seconds = Histogram('pymock_processor_seconds', 'time spent in the mock processor by rule prefix',
+                              ('rule',))
+forward_seconds = Histogram('pymock_forward_seconds', 'upstream time of forward() by rule prefix', ('rule',))
+mock_connections = Gauge('pymock_connections', 'open connections on the mock port')
+mock_connections_total = Counter('pymock_connections_total', 'connections accepted on the mock port')
@@ -3,17 +3,32 @@ import os
 import logging
 import socket
 import struct
+import time
 import http.client
-from datetime import datetime
-from tornado import ioloop, web, httputil, httpserver, httpclient
+from tornado import ioloop, web, httputil, httpserver, httpclient, netutil
 
 from .simple_httpclient import SimpleAsyncHTTPClient
-from . import utils
+from . import utils, metrics
 from .store import Store
+from .recorder import Recorder, Recording
+from .cache import ResponseCache, CacheEntry, freshness_lifetime, cacheable_status, cache_options
 
 logger = logging.getLogger('pymock')
 httpclient.AsyncHTTPClient.configure(SimpleAsyncHTTPClient)
 store = Store()
+recorder = Recorder()
+response_cache = ResponseCache()
+
+
+class MockHTTPServer(httpserver.HTTPServer):
+    def handle_stream(self, stream, address):
+        metrics.mock_connections.inc()
+        metrics.mock_connections_total.inc()
+        super().handle_stream(stream, address)
+
+    def on_close(self, server_conn):
+        metrics.mock_connections.dec()
+        super().on_close(server_conn)
 
 
 class MockConnectionDelegate(httputil.HTTPServerConnectionDelegate):
@@ -41,20 +56,27 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
         self._input_closed = False
         self._task = None
         self._body_parsed = False
+        self._body_buffer = None
         self._recording = False
         self.utils = utils
-        self.logger = logger
         self.request_id = utils.randstr(8)
+        # structured fields for the log subscriptions of the websocket viewer
+        self.log_fields = {'request_id': self.request_id, 'request_path': None}
+        self.logger = logging.LoggerAdapter(logger, self.log_fields)
         self.request = None
+        self.rule = None
         self.resp_headers = httputil.HTTPHeaders()
         self.resp_status = 200
         self.resp_reason = 'OK'
         self.resp_body = None
         self.store = store
+        self._received_bytes = 0
+        self._sent_bytes = 0
 
     # override
     def headers_received(self, start_line, headers):
-        logger.info(f'[{self.request_id}] REQUEST {start_line.method} {start_line.path}')
+        self.log_fields['request_path'] = start_line.path.split('?', 1)[0]
+        self.logger.info(f'[{self.request_id}] REQUEST {start_line.method} {start_line.path}')
         self.request = httputil.HTTPServerRequest(
             connection=self.request_conn,
             server_connection=self.server_conn,
@@ -64,17 +86,18 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
 
     # override
     async def data_received(self, chunk):
+        self._received_bytes += len(chunk)
         await self._chunk_queue.put(chunk)
 
     # override
     def finish(self):
-        logger.debug(f'[{self.request_id}] request finished')
+        self.logger.debug(f'[{self.request_id}] request finished')
         if self._task:
             asyncio.create_task(self._chunk_queue.put(None))
 
     # override
     def on_connection_close(self):
-        logger.debug(f'[{self.request_id}] connection closed')
+        self.logger.debug(f'[{self.request_id}] connection closed')
         if self._task:
             self._task.cancel()
             asyncio.create_task(self._chunk_queue.put(None))
@@ -82,9 +105,9 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
     async def _request_done(self):
         try:
             result = self._task.result()
-            logger.debug(f'[{self.request_id}] request completed with result: {result}')
+            self.logger.debug(f'[{self.request_id}] request completed with result: {result}')
         except Exception as e:
-            logger.exception(f'[{self.request_id}] request completed with error')
+            self.logger.exception(f'[{self.request_id}] request completed with error')
         finally:
             dropped = 0
             while not self._input_closed:
@@ -95,11 +118,11 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
                 dropped += 1
             if dropped > 0:
                 dropped_msg = f'dropped {dropped} {"chunk" if dropped == 1 else "chunks"}'
-                logger.debug(f'[{self.request_id}] {dropped_msg}')
+                self.logger.debug(f'[{self.request_id}] {dropped_msg}')
 
-    async def request_body(self):
+    async def _read_body(self):
         if self._input_closed:
-            return self.request.body
+            return
         body = None
         while True:
             chunk = await self._chunk_queue.get()
@@ -107,11 +130,25 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
                 self._input_closed = True
                 break
             if body is None:
-                body = chunk
-            else:
-                body += chunk
-        self.request.body = body
-        return body
+                body = utils.BodyBuffer()
+            body.append(chunk)
+        # converted to bytes once request_body() is called
+        self._body_buffer = body
+        self.request.body = None
+
+    async def request_body(self):
+        await self._read_body()
+        if self._body_buffer is not None:
+            self.request.body = self._body_buffer.getvalue()
+            self._body_buffer = None
+        return self.request.body
+
+    async def request_body_view(self):
+        # zero-copy view for processors which only scan the body
+        await self._read_body()
+        if self._body_buffer is not None:
+            return self._body_buffer.getbuffer()
+        return memoryview(self.request.body or b'')
 
     async def request_chunk(self):
         if self._input_closed:
@@ -164,7 +201,7 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
     async def write_header(self):
         if not self._header_written:
             if self._socket_closed:
-                logger.info(f'[{self.request_id}] SOCKET CLOSED')
+                self.logger.info(f'[{self.request_id}] SOCKET CLOSED')
                 return
             start_line = httputil.ResponseStartLine('', self.resp_status, self.resp_reason)
             if self.resp_body is not None:
@@ -174,11 +211,12 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
                 self.resp_headers['Content-Length'] = '0'
             await self.request_conn.write_headers(start_line, self.resp_headers)
             self._header_written = True
-            logger.info(f'[{self.request_id}] RESPONSE {start_line.code} {start_line.reason}')
+            self.logger.info(f'[{self.request_id}] RESPONSE {start_line.code} {start_line.reason}')
 
     async def write_body(self):
         if not self._body_written and not self._socket_closed:
             if self.resp_body is not None:
+                self._sent_bytes += len(self.resp_body)
                 await self.request_conn.write(self.resp_body)
             self._body_written = True
 
@@ -202,7 +240,13 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
         if 'Content-Encoding' in headers:
             del headers['Content-Encoding']
 
-    async def forward(self, host, port=80, is_https=None, streaming_request=False, streaming_response=False):
+    def _apply_cache_entry(self, entry):
+        self.resp_status = entry.status
+        self.resp_reason = entry.reason
+        self.resp_headers = httputil.HTTPHeaders(entry.headers)
+        self.resp_body = entry.body
+
+    async def forward(self, host, port=80, is_https=None, streaming_request=False, streaming_response=False, cache=None):
         client = httpclient.AsyncHTTPClient()
         if is_https is None:
             is_https = port == 443
@@ -211,8 +255,39 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
         
         headers = httputil.HTTPHeaders(self.request.headers)
         self._remove_encoding(headers)
+        # hop-by-hop headers, the upstream connection is managed by the client pool
+        for name in ('Connection', 'Keep-Alive'):
+            if name in headers:
+                del headers[name]
         headers['Host'] = host + port_str
-        
+
+        # cache=None follows the matched rule's "cache" option
+        if cache is None and self.rule is not None:
+            cache = self.rule.cache
+        cache = cache_options(cache)
+        cache_key = cache_entry = None
+        if cache is not None and self.request.method == 'GET' and not streaming_response:
+            cache_key = ResponseCache.key('GET', url, headers, cache.get('vary', ()))
+            cache_entry = response_cache.get(cache_key)
+            if cache_entry is not None and cache_entry.fresh():
+                response_cache.hits += 1
+                response_cache.hit_bytes += cache_entry.size
+                self.logger.info(f'[{self.request_id}] CACHE HIT {url}')
+                self._apply_cache_entry(cache_entry)
+                return
+            response_cache.misses += 1
+            # the conditional headers refer to our cached entry, not the client's copy
+            for name in ('If-None-Match', 'If-Modified-Since'):
+                if name in headers:
+                    del headers[name]
+            if cache_entry is not None and cache_entry.revalidatable():
+                if cache_entry.etag is not None:
+                    headers['If-None-Match'] = cache_entry.etag
+                if cache_entry.last_modified is not None:
+                    headers['If-Modified-Since'] = cache_entry.last_modified
+            else:
+                cache_entry = None
+
         if streaming_request:
             body = None
             async def body_producer(write_fn):
@@ -233,17 +308,17 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
             self._remove_encoding(self.resp_headers)
             if streaming_response:
                 await self.request_conn.write_headers(start_line, self.resp_headers)
-                logger.info(f'[{self.request_id}] RESPONSE {start_line.code} {start_line.reason}')
+                self.logger.info(f'[{self.request_id}] RESPONSE {start_line.code} {start_line.reason}')
                 self._header_written = True
         
+        resp_buffer = utils.BodyBuffer()
+
         async def streaming_callback(chunk):
             if streaming_response:
+                self._sent_bytes += len(chunk)
                 await self.request_conn.write(chunk)
             else:
-                if self.resp_body is None:
-                    self.resp_body = chunk
-                else:
-                    self.resp_body += chunk
+                resp_buffer.append(chunk)
 
         request = httpclient.HTTPRequest(
             url=url,
@@ -255,10 +330,51 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
             streaming_callback=streaming_callback,
             follow_redirects=False
         )
-        logger.info(f'[{self.request_id}] FORWARD TO {url}')
-        await client.fetch(request, raise_error=False)
+        self.logger.info(f'[{self.request_id}] FORWARD TO {url}')
+        start = time.monotonic()
+        try:
+            await client.fetch(request, raise_error=False)
+        finally:
+            metrics.forward_seconds.observe(time.monotonic() - start, self._rule_label())
+        if len(resp_buffer) > 0:
+            if self.resp_body is None:
+                self.resp_body = resp_buffer.getvalue()
+            else:
+                self.resp_body += resp_buffer.getvalue()
+        if cache_key is not None:
+            self._update_cache(cache_key, cache_entry, cache.get('ttl'))
+
+    def _update_cache(self, key, entry, ttl):
+        if entry is not None and self.resp_status == 304:
+            lifetime = freshness_lifetime(self.resp_headers, ttl)
+            entry.refresh(self.resp_headers, lifetime or 0)
+            response_cache.revalidated += 1
+            self.logger.info(f'[{self.request_id}] CACHE REVALIDATED')
+            self._apply_cache_entry(entry)
+            return
+        if self.resp_status not in cacheable_status:
+            return
+        lifetime = freshness_lifetime(self.resp_headers, ttl, self.request.headers)
+        if lifetime is None:
+            response_cache.remove(key)
+            return
+        entry = CacheEntry(self.resp_status, self.resp_reason, self.resp_headers, self.resp_body, lifetime)
+        response_cache.put(key, entry)
+
+    def _rule_label(self):
+        return self.rule.prefix if self.rule is not None else ''
+
+    def _update_metrics(self, elapsed):
+        rule = self._rule_label()
+        metrics.mock_requests.inc(rule, self.resp_status)
+        metrics.processor_seconds.observe(elapsed, rule)
+        if self._received_bytes:
+            metrics.mock_received_bytes.inc(rule, amount=self._received_bytes)
+        if self._sent_bytes:
+            metrics.mock_sent_bytes.inc(rule, amount=self._sent_bytes)
 
     async def _process(self, request):
+        start = time.monotonic()
         try:
             if self._processor is None:
                 self.set_status(404)
@@ -269,30 +385,79 @@ class MockMessageDelegate(httputil.HTTPMessageDelegate):
             if e.log_message:
                 self.set_body(e.log_message)
         except Exception as e:
-            logger.exception(f'[{self.request_id}] EXCEPTION')
+            self.logger.exception(f'[{self.request_id}] EXCEPTION')
             self.set_status(500)
             self.set_body(str(e))
         finally:
+            elapsed = time.monotonic() - start
             if self._recording:
-                time_str = datetime.now().strftime('%H%M%S%f')
-                filename = f'{time_str}-{utils.safe_filename(self.request.path)}.txt'
-                with open(f'recordings/{filename}', 'wb') as out:
-                    out.write(b'===== REQUEST =====\n')
-                    out.write(f'{self.request.method} {self.request.uri}\n'.encode('ascii'))
-                    for name, value in self.request.headers.get_all():
-                        out.write(f'{name}: {value}\n'.encode('ascii'))
-                    out.write(b'\n')
-                    body = await self.request_body()
-                    if body is not None:
-                        out.write(body)
-                    out.write(b'\n===== RESPONSE =====\n')
-                    out.write(f'{self.resp_status} {self.resp_reason}\n'.encode('ascii'))
-                    for name, value in self.resp_headers.get_all():
-                        out.write(f'{name}: {value}\n'.encode('ascii'))
-                    out.write(b'\n')
-                    if self.resp_body is not None:
-                        out.write(self.resp_body)
-            await self.flush()
+                await self.request_body()
+            try:
+                await self.flush()
+            finally:
+                # persisted by the recorder thread after the response is sent
+                if self._recording:
+                    recorder.submit(Recording(
+                        self.request_id, self.request.method, self.request.uri,
+                        list(self.request.headers.get_all()), self.request.body,
+                        self.resp_status, self.resp_reason,
+                        list(self.resp_headers.get_all()), self.resp_body))
+                self._update_metrics(elapsed)
+
+
+def _collect_metrics():
+    client = httpclient.AsyncHTTPClient()
+    client_metrics = [
+        metrics.Collected('pymock_client_active_requests', 'gauge', 'active forward() requests'),
+        metrics.Collected('pymock_client_queued_requests', 'gauge', 'forward() requests queued by max_clients'),
+        metrics.Collected('pymock_client_pool_hits_total', 'counter', 'upstream connections reused from the pool'),
+        metrics.Collected('pymock_client_pool_misses_total', 'counter', 'upstream connections opened'),
+        metrics.Collected('pymock_client_pool_idle_connections', 'gauge', 'idle upstream connections in the pool')
+    ]
+    pool = client.pool
+    values = (len(client.active), len(client.queue), pool.hits, pool.misses, pool.idle_count)
+    for metric, value in zip(client_metrics, values):
+        metric.add(value=value)
+    result = client_metrics
+
+    for name, type, help, value in (
+            ('pymock_recordings_written_total', 'counter', 'recordings written', recorder.written),
+            ('pymock_recordings_dropped_total', 'counter', 'recordings dropped on a full queue', recorder.dropped),
+            ('pymock_recording_queue_bytes', 'gauge', 'bytes of the recordings waiting to be written',
+             recorder.queued_bytes)):
+        metric = metrics.Collected(name, type, help)
+        metric.add(value=value)
+        result.append(metric)
+
+    cache_stats = response_cache.stats()
+    for key, type, help in (
+            ('entries', 'gauge', 'forward response cache entries'),
+            ('bytes', 'gauge', 'forward response cache size in bytes'),
+            ('hits', 'counter', 'forward response cache hits'),
+            ('misses', 'counter', 'forward response cache misses'),
+            ('revalidated', 'counter', 'forward response cache entries revalidated upstream'),
+            ('evictions', 'counter', 'forward response cache evictions')):
+        name = f'pymock_cache_{key}' + ('_total' if type == 'counter' else '')
+        metric = metrics.Collected(name, type, help)
+        metric.add(value=cache_stats[key])
+        result.append(metric)
+
+    if isinstance(store, Store):
+        # a remote store is reported by the process serving it
+        store_stats = store.stats()
+        for key, type, help in (
+                ('keys', 'gauge', 'keys in the store'),
+                ('bytes', 'gauge', 'approximate store size in bytes'),
+                ('evictions', 'counter', 'store keys evicted by maxmemory'),
+                ('expired', 'counter', 'store keys expired')):
+            name = f'pymock_store_{key}' + ('_total' if type == 'counter' else '')
+            metric = metrics.Collected(name, type, help)
+            metric.add(value=store_stats[key])
+            result.append(metric)
+    return result
+
+
+metrics.add_collector(_collect_metrics)
 
 
 def setup_wslogs():
@@ -301,11 +466,14 @@ def setup_wslogs():
     formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s')
     handler = WebsocketHandler(get_log_clients)
     handler.setFormatter(formatter)
+    handler.start()
     logger.addHandler(handler)
+    return handler
 
 
-def setup_mock(port, addr):
+def setup_mock(port, addr, reuse_port=False):
     mock = MockConnectionDelegate()
-    server = httpserver.HTTPServer(mock)
-    server.listen(port, addr)
+    server = MockHTTPServer(mock)
+    sockets = netutil.bind_sockets(port, addr, reuse_port=reuse_port)
+    server.add_sockets(sockets)
     return mock
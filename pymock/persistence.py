@@ -0,0 +1,191 @@
+import os
+import re
+import gc
+import time
+import heapq
+import pickle
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('store')
+_log_re = re.compile(r'^store\.(\d+)\.aof$')
+
+
+def _iter_pickles(f):
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+        except (pickle.UnpicklingError, ValueError, AttributeError, ImportError):
+            # torn tail of a log written during a crash
+            logger.warning(f'truncated record in {f.name}')
+            return
+
+
+class StorePersistence:
+    # snapshot + append-only log of Store mutations, like redis rdb/aof:
+    # store.snapshot holds the state at the start of generation G and
+    # store.<G>.aof, store.<G+1>.aof... the mutations after it
+    def __init__(self, store, directory, snapshot_interval=300, flush_interval=1):
+        self.store = store
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self.flush_interval = flush_interval
+        self.snapshot_chunk = 10000
+        self.generation = 0
+        self._buffer = []
+        self._log_file = None
+        self._snapshotting = False
+        # single thread keeps the writes ordered
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store-persistence')
+        self._tasks = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _log_generations(self):
+        generations = []
+        for name in os.listdir(self.directory):
+            m = _log_re.match(name)
+            if m:
+                generations.append(int(m.group(1)))
+        return sorted(generations)
+
+    def restore(self):
+        start = time.monotonic()
+        now = time.time()
+        loaded = skipped = replayed = 0
+        snapshot_generation = 0
+        snapshot_path = self._path('store.snapshot')
+        # a restore allocates millions of objects, collecting in between is wasted work
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            if os.path.isfile(snapshot_path):
+                self.store.flush_all()
+                with open(snapshot_path, 'rb') as f:
+                    records = _iter_pickles(f)
+                    header = next(records, None)
+                    if header is not None:
+                        snapshot_generation = header['generation']
+                        for chunk in records:
+                            skipped += self.store._load(chunk, now)
+                            loaded += len(chunk)
+                heapq.heapify(self.store.expiring_heap)
+                self.store._evict()
+            generations = [g for g in self._log_generations() if g >= snapshot_generation]
+            for generation in generations:
+                with open(self._path(f'store.{generation}.aof'), 'rb') as f:
+                    for record in _iter_pickles(f):
+                        self.store._apply(record, now)
+                        replayed += 1
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.generation = max([snapshot_generation] + generations)
+        elapsed = (time.monotonic() - start) * 1000
+        logger.info(f'store restored in {elapsed:.0f}ms, {loaded - skipped} keys from snapshot, '
+                    f'{skipped} expired skipped, {replayed} log records replayed')
+
+    def start(self):
+        self.generation += 1
+        self._log_file = open(self._path(f'store.{self.generation}.aof'), 'ab')
+        self.store.journal = self
+        loop = asyncio.get_event_loop()
+        self._tasks.append(loop.create_task(self._periodic(self.flush_interval, self.flush)))
+        self._tasks.append(loop.create_task(self._periodic(self.snapshot_interval, self.snapshot)))
+
+    async def _periodic(self, interval, fn):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await fn()
+            except Exception:
+                logger.exception('store persistence error')
+
+    def log(self, record):
+        try:
+            self._buffer.append(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            logger.warning(f'mutation of key {record[1] if len(record) > 1 else None!r} not persisted: {e}')
+
+    def _take_buffer(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        return data
+
+    @staticmethod
+    def _write(f, data, close=False):
+        if data:
+            f.write(data)
+            f.flush()
+        if close:
+            f.close()
+
+    async def flush(self):
+        data = self._take_buffer()
+        if data:
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._write, self._log_file, data)
+
+    async def snapshot(self):
+        if self._snapshotting:
+            return
+        self._snapshotting = True
+        try:
+            await self._snapshot()
+        finally:
+            self._snapshotting = False
+
+    async def _snapshot(self):
+        start = time.monotonic()
+        loop = asyncio.get_event_loop()
+        # switch to a new log first, everything changed from now on is
+        # replayed on top of the snapshot, so it may be taken incrementally
+        old_file = self._log_file
+        loop.run_in_executor(self._executor, self._write, old_file, self._take_buffer(), True)
+        self.generation += 1
+        generation = self.generation
+        self._log_file = open(self._path(f'store.{generation}.aof'), 'ab')
+        tmp_path = self._path('store.snapshot.tmp')
+        f = open(tmp_path, 'wb')
+        try:
+            header = pickle.dumps({'generation': generation})
+            await loop.run_in_executor(self._executor, self._write, f, header)
+            keys = list(self.store.store)
+            items = self.store.store
+            count = 0
+            for idx in range(0, len(keys), self.snapshot_chunk):
+                chunk = []
+                for key in keys[idx:idx + self.snapshot_chunk]:
+                    item = items.get(key)
+                    if item is not None:
+                        chunk.append((key, item.value, item.expires_at, item.size))
+                count += len(chunk)
+                # values may be mutated by processors, serialize them on the
+                # loop one bounded chunk at a time and only write in the thread
+                data = pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+                await loop.run_in_executor(self._executor, self._write, f, data)
+        except Exception:
+            f.close()
+            os.remove(tmp_path)
+            raise
+        await loop.run_in_executor(self._executor, self._write, f, None, True)
+        os.replace(tmp_path, self._path('store.snapshot'))
+        for old_generation in self._log_generations():
+            if old_generation < generation:
+                os.remove(self._path(f'store.{old_generation}.aof'))
+        elapsed = (time.monotonic() - start) * 1000
+        logger.info(f'store snapshot of {count} keys written in {elapsed:.0f}ms')
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self.store.journal = None
+        self._executor.shutdown(wait=True)
+        if self._log_file is not None:
+            self._write(self._log_file, self._take_buffer(), True)
+            self._log_file = None
@@ -0,0 +1,277 @@
+import os
+import re
+import queue
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger('pymock.recorder')
+_request_re = re.compile(rb'^===== REQUEST (\S+) (\S+) (\d+) =====$')
+_response_re = re.compile(rb'^===== RESPONSE (\S+) (\d+) =====$')
+# names of the segments written by _open_segment
+segment_name_re = re.compile(r'^\d{8}-\d{6}-\d+-\d{4,}\.txt$')
+# one file per request recordings of older versions, HHMMSSffffff-<path>.txt
+legacy_name_re = re.compile(r'^\d{12}-.*\.txt$')
+_legacy_request = b'===== REQUEST =====\n'
+_legacy_response = b'\n===== RESPONSE =====\n'
+
+
+class Recording:
+    def __init__(self, request_id, method, uri, req_headers, req_body, status, reason, resp_headers, resp_body):
+        self.request_id = request_id
+        self.time = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        self.method = method
+        self.uri = uri
+        self.req_headers = req_headers
+        self.req_body = req_body or b''
+        self.status = status
+        self.reason = reason
+        self.resp_headers = resp_headers
+        self.resp_body = resp_body or b''
+
+    def serialize(self):
+        parts = [f'===== REQUEST {self.request_id} {self.time} {len(self.req_body)} =====\n'.encode('ascii')]
+        parts.append(f'{self.method} {self.uri}\n'.encode('latin-1'))
+        for name, value in self.req_headers:
+            parts.append(f'{name}: {value}\n'.encode('latin-1'))
+        parts.append(b'\n')
+        parts.append(self.req_body)
+        parts.append(f'\n===== RESPONSE {self.request_id} {len(self.resp_body)} =====\n'.encode('ascii'))
+        parts.append(f'{self.status} {self.reason}\n'.encode('latin-1'))
+        for name, value in self.resp_headers:
+            parts.append(f'{name}: {value}\n'.encode('latin-1'))
+        parts.append(b'\n')
+        parts.append(self.resp_body)
+        parts.append(b'\n\n')
+        return b''.join(parts)
+
+    def size(self):
+        # approximate memory held while queued, bodies and headers
+        size = len(self.req_body) + len(self.resp_body) + len(self.uri)
+        for name, value in self.req_headers:
+            size += len(name) + len(value)
+        for name, value in self.resp_headers:
+            size += len(name) + len(value)
+        return size
+
+
+class RecordEntry:
+    # offsets of a recording inside a segment file, bodies are not copied
+    def __init__(self, offset):
+        self.offset = offset
+        self.end = None
+        self.request_id = None
+        self.time = None
+        self.method = None
+        self.uri = None
+        self.req_headers = []
+        self.req_body_offset = None
+        self.req_body_len = None
+        self.status = None
+        self.reason = None
+        self.resp_headers = []
+        self.resp_body_offset = None
+        self.resp_body_len = None
+
+
+def _read_line(data, pos):
+    end = data.find(b'\n', pos)
+    if end < 0:
+        return None, pos
+    return data[pos:end], end + 1
+
+
+def _read_head(data, pos):
+    start_line, pos = _read_line(data, pos)
+    if start_line is None:
+        return None, None, pos
+    headers = []
+    while True:
+        line, pos = _read_line(data, pos)
+        if line is None:
+            return None, None, pos
+        if not line:
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers.append((name, value.strip()))
+    return start_line.decode('latin-1'), headers, pos
+
+
+def iter_records(data, offset=0, on_malformed=None):
+    # yields the complete recordings in data (bytes or mmap) starting at offset,
+    # a partially written tail is left for the next scan. on_malformed is
+    # called with the offset of a malformed recording, where the scan stops
+    size = len(data)
+    pos = offset
+    while pos < size:
+        entry = RecordEntry(pos)
+        line, pos = _read_line(data, pos)
+        if line is None:
+            return
+        m = _request_re.match(line)
+        if not m:
+            logger.warning(f'malformed recording at offset {entry.offset}')
+            if on_malformed is not None:
+                on_malformed(entry.offset)
+            return
+        entry.request_id = m.group(1).decode('ascii')
+        entry.time = m.group(2).decode('ascii')
+        entry.req_body_len = int(m.group(3))
+        start_line, entry.req_headers, pos = _read_head(data, pos)
+        if start_line is None:
+            return
+        entry.method, _, entry.uri = start_line.partition(' ')
+        entry.req_body_offset = pos
+        pos += entry.req_body_len + 1
+        line, pos = _read_line(data, pos)
+        if line is None:
+            return
+        m = _response_re.match(line)
+        if not m:
+            logger.warning(f'malformed recording at offset {entry.offset}')
+            if on_malformed is not None:
+                on_malformed(entry.offset)
+            return
+        entry.resp_body_len = int(m.group(2))
+        start_line, entry.resp_headers, pos = _read_head(data, pos)
+        if start_line is None:
+            return
+        status, _, entry.reason = start_line.partition(' ')
+        entry.status = int(status)
+        entry.resp_body_offset = pos
+        pos += entry.resp_body_len + 2
+        if pos > size:
+            return
+        entry.end = pos
+        yield entry
+
+
+def parse_legacy(data):
+    # the recording of a legacy file, None when malformed. bodies have no
+    # length there, the request body ends at the first response marker and
+    # the response body at the end of the file
+    if not data.startswith(_legacy_request):
+        return None
+    entry = RecordEntry(0)
+    start_line, entry.req_headers, pos = _read_head(data, len(_legacy_request))
+    if start_line is None:
+        return None
+    entry.method, _, entry.uri = start_line.partition(' ')
+    marker = data.find(_legacy_response, pos)
+    if marker < 0:
+        return None
+    entry.req_body_offset = pos
+    entry.req_body_len = marker - pos
+    start_line, entry.resp_headers, pos = _read_head(data, marker + len(_legacy_response))
+    if start_line is None:
+        return None
+    status, _, entry.reason = start_line.partition(' ')
+    if not status.isdigit():
+        return None
+    entry.status = int(status)
+    entry.resp_body_offset = pos
+    entry.resp_body_len = len(data) - pos
+    entry.end = len(data)
+    return entry
+
+
+class Recorder:
+    # recordings are queued on the event loop and appended to segment files
+    # by a background thread, in batches. the queue is bounded by the bytes
+    # it holds, recordings past max_queue_bytes are dropped and counted
+    def __init__(self, directory='recordings', max_queue_bytes=64 * 1024 * 1024, batch_size=100,
+                 segment_size=16 * 1024 * 1024):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.segment_size = segment_size
+        self.max_queue_bytes = max_queue_bytes
+        self.queue = queue.Queue()
+        # updated by the loop and the writer thread under _queued_lock
+        self.queued_bytes = 0
+        self._queued_lock = threading.Lock()
+        self.listeners = []
+        self.written = 0
+        self.dropped = 0
+        self._segment = None
+        self._segment_path = None
+        self._segment_seq = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, recording):
+        if self._thread is None:
+            self._start()
+        size = recording.size()
+        with self._queued_lock:
+            if self.queued_bytes + size > self.max_queue_bytes:
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logger.warning(f'recording queue full, {self.dropped} recordings dropped')
+                return
+            self.queued_bytes += size
+        self.queue.put_nowait((recording, size))
+
+    def add_listener(self, listener):
+        # listener(segment_path, start, end) is called from the writer thread
+        self.listeners.append(listener)
+
+    def close(self):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self.queue.put((None, 0))
+            thread.join()
+        logger.debug(f'recorder closed, written={self.written}, dropped={self.dropped}')
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='pymock-recorder', daemon=True)
+                self._thread.start()
+
+    def _open_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment_seq += 1
+        time_str = datetime.now().strftime('%Y%m%d-%H%M%S')
+        # pid keeps the segments of -workers processes apart
+        self._segment_path = os.path.join(self.directory, f'{time_str}-{os.getpid()}-{self._segment_seq:04d}.txt')
+        self._segment = open(self._segment_path, 'ab')
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopped = any(recording is None for recording, _ in batch)
+            recordings = [recording for recording, _ in batch if recording is not None]
+            if recordings:
+                try:
+                    self._write(recordings)
+                except Exception:
+                    logger.exception(f'error writing {len(recordings)} recordings')
+            # released once written
+            with self._queued_lock:
+                self.queued_bytes -= sum(size for _, size in batch)
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def _write(self, batch):
+        if self._segment is None or self._segment.tell() >= self.segment_size:
+            self._open_segment()
+        start = self._segment.tell()
+        self._segment.write(b''.join(recording.serialize() for recording in batch))
+        self._segment.flush()
+        end = self._segment.tell()
+        self.written += len(batch)
+        for listener in self.listeners:
+            try:
+                listener(self._segment_path, start, end)
+            except Exception:
+                logger.exception('error notifying recording listener')
@@ -0,0 +1,185 @@
+import os
+import mmap
+import asyncio
+import hashlib
+import logging
+import urllib.parse
+
+from .recorder import iter_records, parse_legacy, segment_name_re, legacy_name_re
+
+logger = logging.getLogger('pymock.replay')
+indexes = {}
+_skipped_headers = ('Content-Length', 'Transfer-Encoding', 'Content-Encoding', 'Connection')
+
+
+def _request_key(method, uri, body):
+    path, _, query = uri.partition('?')
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(query, keep_blank_values=True)))
+    digest = hashlib.sha1(query.encode('utf-8'))
+    digest.update(b'\0')
+    if body:
+        digest.update(body)
+    return method, path, digest.hexdigest()
+
+
+class _Segment:
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.data = None
+
+    def remap(self):
+        size = os.path.getsize(self.path)
+        if size == 0 or (self.data is not None and len(self.data) == size):
+            return False
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        if self.data is not None:
+            self.data.close()
+        self.data = data
+        return True
+
+    def close(self):
+        # legacy recordings are read as bytes
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
+
+
+class ReplayIndex:
+    # in-memory index over the recording segments, responses are served from
+    # the memory mapped segment files
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = {}
+        self.exact = {}
+        self.latest = {}
+        self.loaded = False
+        self.closed = False
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        with os.scandir(self.directory) as it:
+            names = sorted(entry.name for entry in it if entry.is_file())
+        # legacy recordings first, the segments are newer
+        legacy = [name for name in names if legacy_name_re.match(name)]
+        for name in legacy:
+            self._load_legacy(os.path.join(self.directory, name))
+        for name in names:
+            if segment_name_re.match(name):
+                self.refresh_segment(os.path.join(self.directory, name))
+        logger.info(f'replay index loaded, {len(self.segments)} segments, {len(legacy)} legacy recordings, '
+                    f'{len(self.exact)} requests in {self.directory}')
+
+    def _load_legacy(self, path):
+        # one small file per request, read instead of mapped
+        segment = _Segment(path)
+        try:
+            with open(path, 'rb') as f:
+                segment.data = f.read()
+        except OSError:
+            logger.exception(f'error reading {path}')
+            return
+        entry = parse_legacy(segment.data)
+        if entry is None:
+            logger.warning(f'malformed legacy recording {path}')
+            return
+        self._add(segment, entry)
+
+    def _add(self, segment, entry):
+        data = segment.data
+        req_body = data[entry.req_body_offset:entry.req_body_offset + entry.req_body_len]
+        key = _request_key(entry.method, entry.uri, req_body)
+        self.exact[key] = (segment, entry)
+        self.latest[key[:2]] = (segment, entry)
+
+    def refresh_segment(self, path):
+        if self.closed:
+            return
+        segment = self.segments.get(path)
+        if segment is None:
+            segment = self.segments[path] = _Segment(path)
+        try:
+            remapped = segment.remap()
+        except (OSError, ValueError):
+            logger.exception(f'error mapping {path}')
+            remapped = False
+        count = 0
+        if remapped:
+            for entry in iter_records(segment.data, segment.offset):
+                self._add(segment, entry)
+                segment.offset = entry.end
+                count += 1
+        if segment.offset == 0:
+            # nothing indexed, malformed or not completely written yet, the
+            # recorder notifies again once it appended to the file
+            segment.close()
+            del self.segments[path]
+        elif count:
+            logger.debug(f'{count} recordings indexed from {path}')
+
+    def lookup(self, method, uri, body, fallback=False):
+        key = _request_key(method, uri, body)
+        found = self.exact.get(key)
+        if found is None and fallback:
+            # "replay_fallback": true, the latest recording of the same method and path
+            found = self.latest.get(key[:2])
+        return found
+
+    def close(self):
+        self.closed = True
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+        self.exact.clear()
+        self.latest.clear()
+
+    def processor(self, fallback=False):
+        async def processor(ctx):
+            body = await ctx.request_body()
+            found = self.lookup(ctx.request.method, ctx.request.uri, body, fallback)
+            if found is None:
+                ctx.logger.error(f'[{ctx.request_id}] no recording found for {ctx.request.method} {ctx.request.uri}')
+                ctx.set_status(404)
+                return
+            segment, entry = found
+            ctx.resp_status = entry.status
+            ctx.resp_reason = entry.reason
+            for name, value in entry.resp_headers:
+                if name not in _skipped_headers:
+                    ctx.add_header(name, value)
+            start = entry.resp_body_offset
+            ctx.set_body(segment.data[start:start + entry.resp_body_len])
+        return processor
+
+
+def get_index(directory):
+    directory = os.path.normpath(directory)
+    index = indexes.get(directory)
+    if index is None:
+        # config reloads run in the executor, the index is only visible to
+        # on_recorded once loaded
+        index = ReplayIndex(directory)
+        index.load()
+        indexes[directory] = index
+    return index
+
+
+def close_indexes(keep=()):
+    # unmaps the indexes no rule uses anymore, all of them on stop
+    keep = {os.path.normpath(directory) for directory in keep}
+    for directory in [d for d in indexes if d not in keep]:
+        indexes.pop(directory).close()
+
+
+def setup_replay(recorder):
+    loop = asyncio.get_event_loop()
+
+    def on_recorded(segment_path, start, end):
+        # called from the recorder thread
+        index = indexes.get(os.path.normpath(os.path.dirname(segment_path)))
+        if index is not None:
+            loop.call_soon_threadsafe(index.refresh_segment, segment_path)
+    recorder.add_listener(on_recorded)
@@ -8,6 +8,7 @@ var reloadButton = $('#reloadButton');
 var newFolderButton = $('#newFolderButton');
 var newFileButton = $('#newFileButton');
 var entries = null;
+var nextOffset = null;
 var fileNamePattern = /^[A-Za-z0-9_\-.]+$/
 fileList.on('click', onFileListClicked);
 listFiles(currentPath);
@@ -54,6 +55,10 @@ newFileButton.on('click', function() {
 });
 
 function onFileListClicked(event) {
+    if ($(event.target).hasClass('more')) {
+        listFiles(currentPath, nextOffset);
+        return;
+    }
     var entryidx = $(event.target).data('entryidx');
     if (entryidx !== undefined) {
         var entry = entries[entryidx];
@@ -148,16 +153,27 @@ function entryHtml(entry, idx) {
     return `<li data-entryidx="${idx}">${icon} ${entry.name}</li>`;
 }
 
-function listFiles(path) {
-    $.get('/file/list?path=' + encodeURIComponent(path), function(data) {
+function listFiles(path, offset) {
+    // large directories are listed a page at a time
+    offset = offset || 0;
+    $.get('/file/list?path=' + encodeURIComponent(path) + '&offset=' + offset, function(data) {
         currentPath = data.current_path;
-        entries = data.entries;
+        if (offset == 0) {
+            entries = [];
+            fileList.empty();
+        } else {
+            fileList.children('li.more').remove();
+        }
         var content = '';
         for (var idx in data.entries) {
-            entry = data.entries[idx];
-            content += entryHtml(entry, idx);
+            entries.push(data.entries[idx]);
+            content += entryHtml(data.entries[idx], entries.length - 1);
+        }
+        nextOffset = data.next_offset;
+        if (nextOffset !== null) {
+            content += `<li class="more">${data.total - nextOffset} more ...</li>`;
         }
-        fileList.html(content);
+        fileList.append(content);
         filePath.html(currentPath);
     }).fail(reportError)
 }
@@ -1,5 +1,6 @@
 var wsStatus = document.getElementById('wsStatus');
 var logPanel = document.getElementById('logPanel');
+var filterForm = document.getElementById('filterForm');
 var schema = 'ws';
 if (location.protocol == 'https:') {
     schema = 'wss';
@@ -8,9 +9,28 @@ var ws = new WebSocket(`${schema}://${location.host}/ws/logs`);
 ws.onopen = onOpen;
 ws.onclose = onClose;
 ws.onmessage = onMessage;
+filterForm.onsubmit = onFilter;
 
 function onOpen() {
     wsStatus.innerText = 'connected';
+    sendFilter();
+}
+
+function onFilter(e) {
+    e.preventDefault();
+    logPanel.innerHTML = '';
+    sendFilter();
+}
+
+function sendFilter() {
+    // the server only sends the lines matching every non empty field
+    var filter = {};
+    new FormData(filterForm).forEach(function(value, name) {
+        if (value) {
+            filter[name] = value;
+        }
+    });
+    ws.send(JSON.stringify(filter));
 }
 
 function onClose(e) {
@@ -18,7 +38,8 @@ function onClose(e) {
 }
 
 function onMessage(msg) {
-    appendLog(msg.data);
+    // every frame is a batch of log lines
+    JSON.parse(msg.data).forEach(appendLog);
 }
 
 function appendLog(log) {
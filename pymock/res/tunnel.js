@@ -22,18 +22,30 @@ function reportError(e) {
     }
 }
 
+function backendItem(backend) {
+    return `<li class="backend-item">
+    <span class="desc">${backend.host}:${backend.port}</span>
+    <span class="tag">${backend.healthy ? 'up' : 'down'}</span>
+    <span>active ${backend.active}, total ${backend.total}, failures ${backend.failures},
+        in ${backend.bytes_in}B, out ${backend.bytes_out}B</span>
+</li>`;
+}
+
 function tunnelItem(tunnel, idx) {
     return `<li class="tunnel-item" data-idx="${idx}">
     <div class="tunnel-desc">
         <span class="desc button tunnelDesc">${tunnel.name}</span>
         <span class="tag">${tunnel.status}</span>
+        ${tunnel.shaping ? '<span class="tag">shaped</span>' : ''}
     </div>
     <div class="tunnel-action">
         <span>
             <i class="fas fa-play-circle button tunnelPlayButton"></i>
             <i class="fas fa-stop-circle button tunnelStopButton"></i>
+            <i class="fas fa-sliders-h button tunnelShapeButton"></i>
         </span>
     </div>
+    <ul class="backend-list">${tunnel.backends.map(backendItem).join('')}</ul>
 </li>`;
 }
 
@@ -42,7 +54,8 @@ function loadTunnels() {
         tunnels = data;
         html = '';
         tunnels.forEach((tunnel, idx) => {
-            tunnel.name = `${tunnel.port}=>${tunnel.dest_host}:${tunnel.dest_port}`;
+            var dests = tunnel.backends.map(b => `${b.host}:${b.port}`).join(',');
+            tunnel.name = tunnel.backends.length > 1 ? `${tunnel.port}=>${tunnel.balance}(${dests})` : `${tunnel.port}=>${dests}`;
             html += tunnelItem(tunnel, idx);
         });
         tunnelList.html(html);
@@ -50,6 +63,7 @@ function loadTunnels() {
         $('span.tunnelDesc').on('click', tunnelClick);
         $('i.tunnelPlayButton').on('click', tunnelPlay);
         $('i.tunnelStopButton').on('click', tunnelStop);
+        $('i.tunnelShapeButton').on('click', tunnelShape);
     }).fail(reportError);
 }
 
@@ -61,7 +75,7 @@ function tunnelClick() {
 
 function connectionItem(conn, idx) {
     return `<li class="connection-item" data-idx="${idx}">
-    <span class="desc">${conn.peer_ip}:${conn.peer_port}</span>
+    <span class="desc">${conn.peer_ip}:${conn.peer_port} => ${conn.backend}</span>
     <span>
         <span class="button connectionCloseButton">close</span>
         <span class="button connectionResetButton">reset</span>
@@ -104,6 +118,21 @@ function tunnelStop() {
     return false;
 }
 
+function tunnelShape() {
+    var idx = $(this).parent().parent().parent().data('idx');
+    var tunnel = tunnels[idx];
+    // bandwidth in bytes/s, latency and jitter in ms, packet_size in bytes, 0 to disable
+    var shaping = tunnel.shaping || {bandwidth: 0, latency: 0, jitter: 0, packet_size: 0};
+    var value = prompt(`shaping of ${tunnel.name}`, $.param(shaping));
+    if (value === null) {
+        return false;
+    }
+    $.post(`/tunnel?port=${tunnel.port}&action=shape&${value}`, function(data) {
+        loadTunnels();
+    }).fail(reportError);
+    return false;
+}
+
 function connectionAction(elem, action) {
     var idx = $(elem).parent().parent().data('idx');
     var connection = connections[idx];
@@ -0,0 +1,55 @@
+MATCH_FIRST = 'first'
+MATCH_LONGEST = 'longest'
+match_modes = (MATCH_FIRST, MATCH_LONGEST)
+
+
+class _Node:
+    __slots__ = ('children', 'rule', 'order')
+
+    def __init__(self):
+        self.children = {}
+        self.rule = None
+        self.order = None
+
+
+class RuleIndex:
+    # prefix trie over Rule.prefix, match cost depends on the path length
+    # instead of the number of rules
+    def __init__(self, rules, mode=MATCH_FIRST):
+        if mode not in match_modes:
+            raise ValueError(f'unknown match mode {mode}, should be one of {match_modes}')
+        self.mode = mode
+        self.rules = tuple(rules)
+        self.root = _Node()
+        for order, rule in enumerate(self.rules):
+            node = self.root
+            for c in rule.prefix:
+                child = node.children.get(c)
+                if child is None:
+                    child = node.children[c] = _Node()
+                node = child
+            # duplicated prefix, the first declared one wins as the linear scan did
+            if node.rule is None:
+                node.rule = rule
+                node.order = order
+
+    def match(self, path):
+        node = self.root
+        matched = node.rule
+        matched_order = node.order
+        first = self.mode == MATCH_FIRST
+        for c in path:
+            node = node.children.get(c)
+            if node is None:
+                break
+            if node.rule is not None:
+                if not first or matched is None or node.order < matched_order:
+                    matched = node.rule
+                    matched_order = node.order
+        return matched
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(self.rules)
@@ -0,0 +1,415 @@
+import os
+import re
+import gc
+import mmap
+import math
+import time
+import array
+import bisect
+import pickle
+import logging
+import itertools
+import threading
+
+from .recorder import iter_records, segment_name_re
+from . import metrics
+
+logger = logging.getLogger('pymock.search')
+_token_re = re.compile(rb'[A-Za-z0-9_]{2,64}')
+_query_re = re.compile(r'(?:(\w+):)?(\S+)')
+_index_version = 1
+
+# fields of a posting, kept in the low bits of the posting value
+FIELD_METHOD = 1
+FIELD_PATH = 2
+FIELD_STATUS = 4
+FIELD_HEADER = 8
+FIELD_BODY = 16
+_field_bits = 5
+_field_mask = (1 << _field_bits) - 1
+fields = {
+    'method': FIELD_METHOD,
+    'path': FIELD_PATH,
+    'status': FIELD_STATUS,
+    'header': FIELD_HEADER,
+    'body': FIELD_BODY
+}
+_field_weights = ((FIELD_METHOD, 1), (FIELD_PATH, 3), (FIELD_STATUS, 1), (FIELD_HEADER, 1), (FIELD_BODY, 2))
+# score of a term by the fields it was found in
+_weights = [sum(weight for field, weight in _field_weights if flags & field) for flags in range(1 << _field_bits)]
+_text_types = ('text/', 'json', 'xml', 'javascript', 'x-www-form-urlencoded')
+
+
+def _tokens(data):
+    return [token.lower() for token in _token_re.findall(data)]
+
+
+def _header(headers, name):
+    name = name.lower()
+    for header_name, value in headers:
+        if header_name.lower() == name:
+            return value
+    return None
+
+
+def _is_text(headers, body):
+    if _header(headers, 'Content-Encoding') not in (None, '', 'identity'):
+        return False
+    content_type = _header(headers, 'Content-Type')
+    if content_type is not None:
+        content_type = content_type.lower()
+        return any(t in content_type for t in _text_types)
+    return b'\0' not in body[:512]
+
+
+def _iter_pickles(f):
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+
+
+def _window(lst, mask, start_doc, end_doc):
+    # doc id => fields of the postings of lst in [start_doc, end_doc)
+    lo = bisect.bisect_left(lst, start_doc << _field_bits)
+    hi = bisect.bisect_left(lst, end_doc << _field_bits, lo)
+    return {value >> _field_bits: value & mask for value in lst[lo:hi] if value & mask}
+
+
+class SearchIndex:
+    # inverted index over the recordings of a directory: the postings of a
+    # token, an array or a single int, hold doc_id << 5 | fields and are
+    # appended in doc id order so they stay sorted. segments are indexed
+    # incrementally by a background thread, woken by the recorder or by
+    # polling for the segments of -workers processes. queries only read the
+    # postings while the thread appends to them.
+    def __init__(self, directory='recordings', poll_interval=2, save_interval=300, max_body_size=64 * 1024):
+        self.directory = directory
+        self.index_path = os.path.join(directory, '.index', 'search.pickle')
+        self.poll_interval = poll_interval
+        self.save_interval = save_interval
+        self.max_body_size = max_body_size
+        # a query stops collecting matches after scan_limit, newest first
+        self.scan_limit = 20000
+        self.save_chunk = 10000
+        self.segments = []
+        self.segment_ids = {}
+        # indexed offset of each segment
+        self.indexed = []
+        # segment id => offset of a malformed recording, the segment is not
+        # read again while indexed up to there
+        self.malformed = {}
+        self.doc_segments = array.array('I')
+        self.doc_offsets = array.array('Q')
+        self.postings = {}
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def __len__(self):
+        return len(self.doc_offsets)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='pymock-search', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    def notify(self, *args):
+        # recorder listener, new recordings were written
+        self._wakeup.set()
+
+    def _run(self):
+        try:
+            self.load()
+        except Exception:
+            logger.exception(f'error loading {self.index_path}, rebuilding the search index')
+        while True:
+            stopped = self._stopped
+            try:
+                self.update()
+                if self.dirty and (stopped or time.monotonic() - self.saved_at >= self.save_interval):
+                    self.save()
+            except Exception:
+                logger.exception('error updating the search index')
+            if stopped:
+                return
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def load(self):
+        if not os.path.isfile(self.index_path):
+            return
+        start = time.monotonic()
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        postings = {}
+        try:
+            with open(self.index_path, 'rb') as f:
+                records = _iter_pickles(f)
+                state = next(records, None)
+                if state is None or state.get('version') != _index_version:
+                    logger.info('search index format changed, rebuilding')
+                    return
+                for chunk in records:
+                    postings.update(chunk)
+        except (OSError, pickle.UnpicklingError, ValueError) as e:
+            logger.warning(f'invalid search index {self.index_path}, rebuilding: {e}')
+            return
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if len(postings) != state.get('terms'):
+            logger.warning(f'truncated search index {self.index_path}, rebuilding')
+            return
+        for name, offset in zip(state['segments'], state['indexed']):
+            path = os.path.join(self.directory, name)
+            if not os.path.isfile(path) or os.path.getsize(path) < offset:
+                # recordings were removed, the postings would point to them
+                logger.info(f'segment {name} changed, rebuilding the search index')
+                return
+        self.segments = state['segments']
+        self.segment_ids = {name: idx for idx, name in enumerate(self.segments)}
+        self.indexed = state['indexed']
+        self.doc_segments = state['doc_segments']
+        self.doc_offsets = state['doc_offsets']
+        self.postings = postings
+        elapsed = (time.monotonic() - start) * 1000
+        logger.info(f'search index loaded in {elapsed:.1f}ms, {len(self)} recordings, {len(self.postings)} terms')
+
+    def save(self):
+        start = time.monotonic()
+        directory = os.path.dirname(self.index_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        state = {
+            'version': _index_version,
+            'segments': self.segments,
+            'indexed': self.indexed,
+            'doc_segments': self.doc_segments,
+            'doc_offsets': self.doc_offsets,
+            'terms': len(self.postings)
+        }
+        tmp_path = f'{self.index_path}.tmp'
+        # a header then the postings in chunks, a single pickle of a large
+        # index holds the GIL, and so the loop, for seconds
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            items = iter(self.postings.items())
+            while True:
+                chunk = dict(itertools.islice(items, self.save_chunk))
+                if not chunk:
+                    break
+                pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        elapsed = (time.monotonic() - start) * 1000
+        logger.debug(f'search index saved in {elapsed:.1f}ms, {len(self)} recordings')
+
+    def update(self):
+        with os.scandir(self.directory) as it:
+            names = sorted(entry.name for entry in it if entry.is_file() and segment_name_re.match(entry.name))
+        count = 0
+        for name in names:
+            if self._stopped and count:
+                # indexed segments are saved, the rest is indexed on the next start
+                break
+            count += self.index_segment(name)
+        if count:
+            logger.debug(f'{count} recordings indexed, {len(self)} total')
+
+    def index_segment(self, name):
+        segment_id = self.segment_ids.get(name)
+        if segment_id is None:
+            segment_id = self.segment_ids[name] = len(self.segments)
+            self.segments.append(name)
+            self.indexed.append(0)
+        offset = self.indexed[segment_id]
+        path = os.path.join(self.directory, name)
+        if os.path.getsize(path) <= offset or self.malformed.get(segment_id) == offset:
+            return 0
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        count = 0
+        malformed = []
+        # a partially written tail is indexed by a later update
+        for entry in iter_records(data, on_malformed=malformed.append):
+            self.add(segment_id, offset + entry.offset, entry, data)
+            self.indexed[segment_id] = offset + entry.end
+            count += 1
+        if malformed:
+            self.malformed[segment_id] = offset + malformed[0]
+        if count:
+            self.dirty = True
+        return count
+
+    def add(self, segment_id, offset, entry, data):
+        terms = {}
+
+        def add_tokens(tokens, field):
+            for token in tokens:
+                terms[token] = terms.get(token, 0) | field
+        add_tokens(_tokens(entry.method.encode('latin-1')), FIELD_METHOD)
+        add_tokens(_tokens(entry.uri.encode('latin-1')), FIELD_PATH)
+        add_tokens((str(entry.status).encode('ascii'),), FIELD_STATUS)
+        for headers, body_offset, body_len in ((entry.req_headers, entry.req_body_offset, entry.req_body_len),
+                                               (entry.resp_headers, entry.resp_body_offset, entry.resp_body_len)):
+            for _, value in headers:
+                add_tokens(_tokens(value.encode('latin-1')), FIELD_HEADER)
+            body = data[body_offset:body_offset + min(body_len, self.max_body_size)]
+            if body and _is_text(headers, body):
+                add_tokens(_tokens(body), FIELD_BODY)
+        # the document is complete before its postings are visible
+        doc_id = len(self.doc_offsets)
+        self.doc_segments.append(segment_id)
+        self.doc_offsets.append(offset)
+        postings = self.postings
+        for token, flags in terms.items():
+            value = doc_id << _field_bits | flags
+            lst = postings.get(token)
+            if lst is None:
+                # most terms are ids seen once, a plain int rather than an
+                # array keeps millions of objects away from the gc
+                postings[token] = value
+            elif type(lst) is int:
+                postings[token] = array.array('I', (lst, value))
+            else:
+                lst.append(value)
+
+    def parse_query(self, query):
+        # space separated terms, all required, "field:term" limits a term to
+        # method, path, status, header or body
+        terms = {}
+        for m in _query_re.finditer(query):
+            field_name, text = m.group(1), m.group(2)
+            mask = _field_mask
+            if field_name is not None:
+                if field_name.lower() not in fields:
+                    raise ValueError(f'unknown search field {field_name}, should be one of {sorted(fields)}')
+                mask = fields[field_name.lower()]
+            for token in _tokens(text.encode('utf-8')):
+                terms[token] = terms.get(token, 0) | mask
+        return terms
+
+    def search(self, query, offset=0, limit=20):
+        start = time.monotonic()
+        terms = self.parse_query(query)
+        if not terms:
+            raise ValueError('query has no searchable terms')
+        doc_count = len(self)
+        lists = []
+        for token, mask in terms.items():
+            lst = self.postings.get(token)
+            if lst is None:
+                lists = None
+                break
+            if type(lst) is int:
+                lst = (lst,)
+            idf = math.log(1 + doc_count / len(lst))
+            lists.append((lst, mask, idf))
+        matches = []
+        truncated = False
+        if lists:
+            lists.sort(key=lambda item: len(item[0]))
+            first = lists[0][0]
+            # newest recordings first, in growing windows of the shortest
+            # list, the other lists are only read over the same doc ids
+            hi = len(first)
+            end_doc = (first[-1] >> _field_bits) + 1
+            size = 4096
+            while hi > 0:
+                lo = max(hi - size, 0)
+                start_doc = first[lo] >> _field_bits
+                found = [_window(lst, mask, start_doc, end_doc) for lst, mask, _ in lists]
+                docs = set(found[0]).intersection(*found[1:])
+                for doc_id in sorted(docs, reverse=True):
+                    score = sum(idf * _weights[flags[doc_id]] for (_, _, idf), flags in zip(lists, found))
+                    matches.append((score, doc_id))
+                hi = lo
+                end_doc = start_doc
+                size *= 2
+                if len(matches) >= self.scan_limit:
+                    truncated = len(matches) > self.scan_limit or hi > 0
+                    del matches[self.scan_limit:]
+                    break
+        matches.sort(key=lambda item: (-item[0], -item[1]))
+        hits = [self.read_hit(doc_id, score) for score, doc_id in matches[offset:offset + limit]]
+        next_offset = offset + limit
+        return {
+            'query': query,
+            'total': len(matches),
+            'truncated': truncated,
+            'took_ms': round((time.monotonic() - start) * 1000, 3),
+            'hits': hits,
+            'next_offset': next_offset if next_offset < len(matches) else None
+        }
+
+    def read_hit(self, doc_id, score):
+        name = self.segments[self.doc_segments[doc_id]]
+        offset = self.doc_offsets[doc_id]
+        hit = {
+            'id': doc_id,
+            'score': round(score, 3),
+            'segment': name,
+            'offset': offset
+        }
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    entry = next(iter_records(data, offset), None)
+        except (OSError, ValueError):
+            # the segment was removed since it was indexed
+            return hit
+        if entry is not None:
+            hit.update({
+                'request_id': entry.request_id,
+                'time': entry.time,
+                'method': entry.method,
+                'uri': entry.uri,
+                'status': entry.status,
+                'reason': entry.reason
+            })
+        return hit
+
+
+search_index = None
+
+
+def setup_search(recorder, directory='recordings'):
+    global search_index
+    search_index = SearchIndex(directory)
+    recorder.add_listener(search_index.notify)
+    search_index.start()
+    return search_index
+
+
+def close_search():
+    if search_index is not None:
+        search_index.close()
+
+
+def _collect_metrics():
+    if search_index is None:
+        return []
+    result = []
+    for name, help, value in (
+            ('pymock_search_recordings', 'recordings in the search index', len(search_index)),
+            ('pymock_search_terms', 'terms in the search index', len(search_index.postings))):
+        metric = metrics.Collected(name, 'gauge', help)
+        metric.add(value=value)
+        result.append(metric)
+    return result
+
+
+metrics.add_collector(_collect_metrics)
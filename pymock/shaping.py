@@ -0,0 +1,180 @@
+import heapq
+import random
+import asyncio
+import itertools
+import collections
+
+# bytes a shaped direction may hold before the reading side waits, like a
+# tcp window it bounds the throughput of a high latency link to window / latency
+shaping_window = 4 * 1024 * 1024
+# deadlines closer than this are released in the same timer run
+timer_resolution = 0.001
+shaping_options = ('bandwidth', 'latency', 'jitter', 'packet_size')
+
+
+class Shaping:
+    # per direction of every connection of a tunnel: bandwidth in bytes/s,
+    # latency and jitter in ms, packet_size in bytes, 0 disables an option
+    def __init__(self, bandwidth=0, latency=0, jitter=0, packet_size=0):
+        self.bandwidth = 0
+        self.latency = 0
+        self.jitter = 0
+        self.packet_size = 0
+        self.update(bandwidth=bandwidth, latency=latency, jitter=jitter, packet_size=packet_size)
+
+    @classmethod
+    def from_config(cls, config):
+        unknown = set(config) - set(shaping_options)
+        if unknown:
+            raise ValueError(f'unknown shaping options {sorted(unknown)}')
+        return cls(**config)
+
+    def update(self, **options):
+        for name, value in options.items():
+            if name not in shaping_options:
+                raise ValueError(f'unknown shaping option {name}')
+            value = float(value) if name in ('latency', 'jitter') else int(value)
+            if value < 0:
+                raise ValueError(f'shaping option {name} should not be negative')
+            setattr(self, name, value)
+
+    def active(self):
+        return any(getattr(self, name) for name in shaping_options)
+
+    def delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0) / 1000
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in shaping_options}
+
+
+class ShapingTimer:
+    # one timer shared by all the shaped connections: deadlines wait in a
+    # heap and a single loop timer is armed for the earliest one
+    def __init__(self):
+        self.heap = []
+        self.handle = None
+        self.handle_at = None
+        self._seq = itertools.count()
+
+    def wait(self, when):
+        # None when the deadline has passed already
+        loop = asyncio.get_event_loop()
+        if when <= loop.time() + timer_resolution:
+            return None
+        fut = loop.create_future()
+        heapq.heappush(self.heap, (when, next(self._seq), fut))
+        if self.handle_at is None or when < self.handle_at:
+            if self.handle is not None:
+                self.handle.cancel()
+            self.handle = loop.call_at(when, self._fire)
+            self.handle_at = when
+        return fut
+
+    def _fire(self):
+        loop = asyncio.get_event_loop()
+        self.handle = self.handle_at = None
+        heap = self.heap
+        deadline = loop.time() + timer_resolution
+        while heap and heap[0][0] <= deadline:
+            fut = heapq.heappop(heap)[2]
+            if not fut.done():
+                fut.set_result(None)
+        if heap:
+            self.handle_at = heap[0][0]
+            self.handle = loop.call_at(self.handle_at, self._fire)
+
+
+timer = ShapingTimer()
+
+
+class ShapedWriter:
+    # delays and paces the data written to one side of a tunnel connection,
+    # data is queued with its send time so added latency is pipelined rather
+    # than serialized, a writer task releases it in order
+    def __init__(self, tunnel, writer):
+        self.tunnel = tunnel
+        self.writer = writer
+        self.queue = collections.deque()
+        self.queued = 0
+        self.release_at = 0
+        # virtual time of the token bucket, see _send_time
+        self.bucket_at = 0
+        self._data_ready = None
+        self._window = asyncio.Event()
+        self._window.set()
+        self.task = asyncio.ensure_future(self._run())
+
+    def _send_time(self, shaping, release, size):
+        if not shaping.bandwidth:
+            return release
+        cost = size / shaping.bandwidth
+        # a full packet, or 16KB, may be sent at once after an idle period
+        burst = max(shaping.packet_size, 16 * 1024) / shaping.bandwidth
+        bucket_at = max(self.bucket_at, release)
+        self.bucket_at = bucket_at + cost
+        return max(release, bucket_at + cost - burst)
+
+    def _enqueue(self, send_at, data):
+        self.queue.append((send_at, data))
+        if data is not None:
+            self.queued += len(data)
+        if self._data_ready is not None and not self._data_ready.done():
+            self._data_ready.set_result(None)
+
+    async def write(self, data):
+        if self.task.done():
+            # the writer side failed, raise its error
+            self.task.result()
+            raise ConnectionError('shaped writer closed')
+        shaping = self.tunnel.shaping
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        if shaping is None:
+            self._enqueue(max(now, self.release_at), data)
+        else:
+            # jitter never reorders a stream, a packet is not released before the previous one
+            release = self.release_at = max(now + shaping.delay(), self.release_at)
+            step = shaping.packet_size or len(data)
+            view = memoryview(data)
+            for idx in range(0, len(data), step):
+                piece = view[idx:idx + step]
+                self._enqueue(self._send_time(shaping, release, len(piece)), piece)
+        if self.queued > shaping_window:
+            self._window.clear()
+            await self._window.wait()
+
+    async def close(self):
+        self._enqueue(self.release_at, None)
+        await self.task
+
+    def cancel(self):
+        self.task.cancel()
+
+    async def _run(self):
+        try:
+            while True:
+                if not self.queue:
+                    self._data_ready = asyncio.get_event_loop().create_future()
+                    await self._data_ready
+                    self._data_ready = None
+                    continue
+                send_at, data = self.queue[0]
+                fut = timer.wait(send_at)
+                if fut is not None:
+                    await fut
+                self.queue.popleft()
+                if data is None:
+                    self.writer.write_eof()
+                    return
+                self.writer.write(data)
+                self.queued -= len(data)
+                if self.queued <= shaping_window:
+                    self._window.set()
+                await self.writer.drain()
+        finally:
+            # a blocked write() wakes up and sees the task is done
+            self._window.set()
@@ -26,6 +26,7 @@ import collections
 import copy
 import functools
 import re
+import select
 import socket
 import ssl
 import sys
@@ -76,14 +77,133 @@ class HTTPStreamClosedError(HTTPError):
         return self.message or "Stream closed"
 
 
+class _ConnectionPool(object):
+    """Pool of idle keep-alive streams keyed by ``(scheme, host, port)``.
+
+    ``max_idle`` bounds the total number of idle streams, ``max_per_host``
+    the number of idle streams kept for a single key, and streams idle for
+    longer than ``idle_timeout`` seconds are closed.  ``hits`` and
+    ``misses`` count the lookups served from and missed by the pool.
+    """
+
+    def __init__(
+        self, max_idle: int = 64, max_per_host: int = 8, idle_timeout: float = 30.0
+    ) -> None:
+        self.io_loop = IOLoop.current()
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.idle = (
+            collections.OrderedDict()
+        )  # type: Dict[Tuple[str, str, int], Deque[Tuple[IOStream, object]]]
+        self.idle_count = 0
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, key: "Tuple[str, str, int]") -> Optional[IOStream]:
+        streams = self.idle.get(key)
+        while streams:
+            stream, timeout_handle = streams.pop()
+            self.idle_count -= 1
+            self.io_loop.remove_timeout(timeout_handle)
+            stream.set_close_callback(None)
+            if self._is_usable(stream):
+                if not streams:
+                    del self.idle[key]
+                self.hits += 1
+                return stream
+            stream.close()
+        if key in self.idle:
+            del self.idle[key]
+        self.misses += 1
+        return None
+
+    def release(self, key: "Tuple[str, str, int]", stream: IOStream) -> None:
+        if self.max_idle <= 0 or self.max_per_host <= 0 or not self._is_usable(stream):
+            stream.close()
+            return
+        streams = self.idle.get(key)
+        if streams is None:
+            streams = self.idle[key] = collections.deque()
+        else:
+            self.idle.move_to_end(key)
+        if len(streams) >= self.max_per_host:
+            self._discard(key, streams.popleft())
+        elif self.idle_count >= self.max_idle:
+            # evict from the least recently released host
+            oldest_key = next(iter(self.idle))
+            self._discard(oldest_key, self.idle[oldest_key].popleft())
+        timeout_handle = self.io_loop.add_timeout(
+            self.io_loop.time() + self.idle_timeout,
+            functools.partial(self._on_idle_timeout, key, stream),
+        )
+        stream.set_close_callback(functools.partial(self._on_idle_close, key, stream))
+        streams.append((stream, timeout_handle))
+        self.idle_count += 1
+
+    def close(self) -> None:
+        for key, streams in list(self.idle.items()):
+            while streams:
+                self._discard(key, streams.popleft())
+        self.idle.clear()
+
+    def _discard(self, key: "Tuple[str, str, int]", item: "Tuple[IOStream, object]") -> None:
+        stream, timeout_handle = item
+        self.idle_count -= 1
+        self.io_loop.remove_timeout(timeout_handle)
+        stream.set_close_callback(None)
+        stream.close()
+        if key in self.idle and not self.idle[key]:
+            del self.idle[key]
+
+    def _remove(self, key: "Tuple[str, str, int]", stream: IOStream) -> None:
+        streams = self.idle.get(key)
+        if not streams:
+            return
+        for item in streams:
+            if item[0] is stream:
+                streams.remove(item)
+                self._discard(key, item)
+                return
+
+    def _on_idle_timeout(self, key: "Tuple[str, str, int]", stream: IOStream) -> None:
+        self._remove(key, stream)
+
+    def _on_idle_close(self, key: "Tuple[str, str, int]", stream: IOStream) -> None:
+        self._remove(key, stream)
+
+    @staticmethod
+    def _is_usable(stream: IOStream) -> bool:
+        if stream.closed() or stream.reading() or stream.writing():
+            return False
+        sock = stream.socket
+        if sock is None:
+            return False
+        # an idle HTTP/1.1 connection must not have anything to read, a
+        # readable socket means the peer closed it or sent unexpected data.
+        # select() is limited to fds below FD_SETSIZE, poll() where available
+        try:
+            if hasattr(select, "poll"):
+                poller = select.poll()
+                poller.register(sock.fileno(), select.POLLIN | select.POLLPRI)
+                return not poller.poll(0)
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+
 class SimpleAsyncHTTPClient(AsyncHTTPClient):
     """Non-blocking HTTP client with no external dependencies.
 
     This class implements an HTTP 1.1 client on top of Tornado's IOStreams.
     Some features found in the curl-based AsyncHTTPClient are not yet
-    supported.  In particular, proxies are not supported, connections
-    are not reused, and callers cannot select the network interface to be
-    used.
+    supported.  In particular, proxies are not supported and callers
+    cannot select the network interface to be used.
+
+    Connections are kept alive and reused through a per-(scheme, host, port)
+    pool of idle connections unless the request sets its own ``Connection``
+    header to ``close``.
     """
 
     def initialize(  # type: ignore
@@ -95,6 +215,9 @@ class SimpleAsyncHTTPClient(AsyncHTTPClient):
         defaults: Dict[str, Any] = None,
         max_header_size: int = None,
         max_body_size: int = None,
+        max_idle_connections: int = 64,
+        max_idle_per_host: int = 8,
+        idle_timeout: float = 30.0,
     ) -> None:
         """Creates a AsyncHTTPClient.
 
@@ -125,6 +248,10 @@ class SimpleAsyncHTTPClient(AsyncHTTPClient):
         applies; with a ``streaming_callback`` only ``max_body_size``
         does.
 
+        ``max_idle_connections``, ``max_idle_per_host`` and ``idle_timeout``
+        bound the pool of idle keep-alive connections, set
+        ``max_idle_connections`` to 0 to disable connection reuse.
+
         .. versionchanged:: 4.2
            Added the ``max_body_size`` argument.
         """
@@ -155,9 +282,13 @@ class SimpleAsyncHTTPClient(AsyncHTTPClient):
                 resolver=self.resolver, mapping=hostname_mapping
             )
         self.tcp_client = TCPClient(resolver=self.resolver)
+        self.pool = _ConnectionPool(
+            max_idle_connections, max_idle_per_host, idle_timeout
+        )
 
     def close(self) -> None:
         super(SimpleAsyncHTTPClient, self).close()
+        self.pool.close()
         if self.own_resolver:
             self.resolver.close()
         self.tcp_client.close()
@@ -213,6 +344,7 @@ class SimpleAsyncHTTPClient(AsyncHTTPClient):
             self.tcp_client,
             self.max_header_size,
             self.max_body_size,
+            self.pool,
         )
 
     def _release_fetch(self, key: object) -> None:
@@ -263,6 +395,7 @@ class _HTTPConnection(httputil.HTTPMessageDelegate):
         tcp_client: TCPClient,
         max_header_size: int,
         max_body_size: int,
+        pool: Optional[_ConnectionPool] = None,
     ) -> None:
         self.io_loop = IOLoop.current()
         self.start_time = self.io_loop.time()
@@ -275,8 +408,12 @@ class _HTTPConnection(httputil.HTTPMessageDelegate):
         self.tcp_client = tcp_client
         self.max_header_size = max_header_size
         self.max_body_size = max_body_size
+        self.pool = pool
+        self._pool_key = None  # type: Optional[Tuple[str, str, int]]
+        self._keep_alive = False
         self.code = None  # type: Optional[int]
         self.headers = None  # type: Optional[httputil.HTTPHeaders]
+        self.version = None  # type: Optional[str]
         self.chunks = []  # type: List[bytes]
         self._decompressor = None
         # Timeout handle returned by IOLoop.add_timeout
@@ -327,14 +464,24 @@ class _HTTPConnection(httputil.HTTPMessageDelegate):
                     self.start_time + timeout,
                     functools.partial(self._on_timeout, "while connecting"),
                 )
-                stream = await self.tcp_client.connect(
-                    host,
-                    port,
-                    af=af,
-                    ssl_options=ssl_options,
-                    max_buffer_size=self.max_buffer_size,
-                    source_ip=source_ip,
+                self._keep_alive = (
+                    self.pool is not None
+                    and source_ip is None
+                    and self.request.headers.get("Connection", "").lower() != "close"
                 )
+                stream = None
+                if self._keep_alive:
+                    self._pool_key = (self.parsed.scheme, host, port)
+                    stream = self.pool.acquire(self._pool_key)
+                if stream is None:
+                    stream = await self.tcp_client.connect(
+                        host,
+                        port,
+                        af=af,
+                        ssl_options=ssl_options,
+                        max_buffer_size=self.max_buffer_size,
+                        source_ip=source_ip,
+                    )
 
                 if self.final_callback is None:
                     # final_callback is cleared if we've hit our timeout.
@@ -365,7 +512,9 @@ class _HTTPConnection(httputil.HTTPMessageDelegate):
                     if getattr(self.request, key, None):
                         raise NotImplementedError("%s not supported" % key)
                 if "Connection" not in self.request.headers:
-                    self.request.headers["Connection"] = "close"
+                    self.request.headers["Connection"] = (
+                        "keep-alive" if self._keep_alive else "close"
+                    )
                 if "Host" not in self.request.headers:
                     if "@" in self.parsed.netloc:
                         self.request.headers["Host"] = self.parsed.netloc.rpartition(
@@ -496,7 +645,7 @@ class _HTTPConnection(httputil.HTTPMessageDelegate):
             stream,
             True,
             HTTP1ConnectionParameters(
-                no_keep_alive=True,
+                no_keep_alive=not self._keep_alive,
                 max_header_size=self.max_header_size,
                 max_body_size=self.max_body_size,
                 decompress=bool(self.request.decompress_response),
@@ -590,6 +739,7 @@ class _HTTPConnection(httputil.HTTPMessageDelegate):
             return
         self.code = first_line.code
         self.reason = first_line.reason
+        self.version = first_line.version
         self.headers = headers
 
         if self._should_follow_redirect():
@@ -671,7 +821,30 @@ class _HTTPConnection(httputil.HTTPMessageDelegate):
         self._on_end_request()
 
     def _on_end_request(self) -> None:
-        self.stream.close()
+        if self._can_reuse():
+            self.stream.set_close_callback(None)
+            self.pool.release(self._pool_key, self.connection.detach())
+        else:
+            self.stream.close()
+
+    def _can_reuse(self) -> bool:
+        if not self._keep_alive or self.stream.closed() or self.headers is None:
+            return False
+        if self.connection.stream is None or self.connection._disconnect_on_finish:
+            return False
+        connection_header = self.headers.get("Connection", "").lower()
+        if connection_header == "close":
+            return False
+        # HTTP/1.0 closes after the response unless keep-alive was negotiated
+        if self.version != "HTTP/1.1" and connection_header != "keep-alive":
+            return False
+        # responses delimited by connection close cannot be reused
+        return (
+            self.request.method == "HEAD"
+            or self.code in (204, 304)
+            or "Content-Length" in self.headers
+            or self.headers.get("Transfer-Encoding", "").lower() == "chunked"
+        )
 
     async def data_received(self, chunk: bytes) -> None:
         if self._should_follow_redirect():
@@ -1,50 +1,306 @@
+import abc
+import sys
 import time
-import asyncio
+import heapq
 import random
+import asyncio
+import itertools
 import logging
+import collections
 
 _ARG_DEFAULT = object()
 logger = logging.getLogger('store')
+POLICY_LRU = 'lru'
+POLICY_LFU = 'lfu'
+POLICY_VOLATILE_TTL = 'volatile-ttl'
+eviction_policies = (POLICY_LRU, POLICY_LFU, POLICY_VOLATILE_TTL)
+
+
+def approximate_size(obj, depth=2):
+    # shallow sizes of the object and of its items, containers nested deeper
+    # than depth are counted by their own shallow size only
+    size = sys.getsizeof(obj)
+    if depth > 0:
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                size += approximate_size(k, depth - 1) + approximate_size(v, depth - 1)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            for v in obj:
+                size += approximate_size(v, depth - 1)
+    return size
 
 
 class StoreItem:
-    def __init__(self, value, expires_at):
+    __slots__ = ('value', 'expires_at', 'size', 'hits', 'decayed_at', 'pos')
+
+    def __init__(self, value, expires_at, size=0):
         self.value = value
         self.expires_at = expires_at
+        self.size = size
+        # lfu access counter, halved every lfu_decay_time seconds. new keys
+        # start above keys whose counter decayed to 0
+        self.hits = 1
+        self.decayed_at = time.monotonic()
+        # index in Store.keys
+        self.pos = 0
 
 
-class Store:
+class StoreBackend(abc.ABC):
+    # the api processors use through ctx.store. the reads of a remote store
+    # block the loop for a round trip, the _async variants wait for it on the
+    # loop and return at once for the in-process store
+    @abc.abstractmethod
+    def put(self, key, value, expires=None):
+        pass
+
+    @abc.abstractmethod
+    def get(self, key, default=_ARG_DEFAULT, expires=None):
+        pass
+
+    @abc.abstractmethod
+    def expires(self, key, expires):
+        pass
+
+    @abc.abstractmethod
+    def flush_all(self):
+        pass
+
+    @abc.abstractmethod
+    def stats(self):
+        pass
+
+    @abc.abstractmethod
+    def __len__(self):
+        pass
+
+    async def get_async(self, key, default=_ARG_DEFAULT, expires=None):
+        return self.get(key, default, expires)
+
+    async def stats_async(self):
+        return self.stats()
+
+
+class Store(StoreBackend):
+    # in-process dict backend, the default
     def __init__(self):
-        self.store = {}
-        self.expiring_delay = 300
+        # insertion order is the LRU order, oldest first
+        self.store = collections.OrderedDict()
+        # min-heap of (expires_at, seq, key), entries of overwritten or
+        # deleted keys are skipped when popped
+        self.expiring_heap = []
+        self.expiring_interval = 1
+        self.expiring_budget = 0.002
+        # the old heap while it is compacted, see _expire
+        self._compacting = None
+        self.expired = 0
+        self.maxmemory = 0
+        self.policy = POLICY_LRU
+        self.eviction_samples = 5
+        self.lfu_decay_time = 60
+        # the keys in no particular order, for the random lfu samples
+        self.keys = []
+        self.used_memory = 0
+        self.evictions = 0
+        # StorePersistence when persistence is enabled, mutations are logged to it
+        self.journal = None
+        self._seq = itertools.count()
         self.loop = asyncio.get_event_loop()
-        self.loop.create_task(self._expiring_task(0, 20))
-
-    async def _expiring_task(self, delay, size):
-        assert size > 0
-        if delay > 0:
-            await asyncio.sleep(delay)
-        logger.debug('start expiring keys')
-        if size >= len(self.store):
-            keys = list(self.store.keys())
-        else:
-            keys = random.sample(self.store.keys(), size)
-        count = 0
+        self.loop.call_soon(self._expire)
+
+    def configure(self, maxmemory=0, policy=POLICY_LRU):
+        if policy not in eviction_policies:
+            raise ValueError(f'unknown eviction policy {policy}, should be one of {eviction_policies}')
+        self.maxmemory = maxmemory
+        self.policy = policy
+        self._evict()
+
+    def _expire(self):
+        deadline = time.monotonic() + self.expiring_budget
         now = time.time()
-        for key in keys:
-            item = self.store[key]
-            if item.expires_at is not None and item.expires_at <= now:
-                logger.debug('expired key: %s', key)
+        heap = self.expiring_heap
+        count = popped = 0
+        while heap and heap[0][0] <= now:
+            expires_at, _, key = heapq.heappop(heap)
+            popped += 1
+            item = self.store.get(key)
+            if item is not None and item.expires_at == expires_at:
+                self._delete(key)
                 count += 1
-                del self.store[key]
-        if count/size > 0.25:
-            self.loop.create_task(self._expiring_task(0, size))
+            if popped % 64 == 0 and time.monotonic() >= deadline:
+                break
+        if self._compacting is not None:
+            count += self._compact(deadline, now)
+        elif len(heap) > 2 * len(self.store) + 1024:
+            # the stale entries are dropped while moving the heap to a new
+            # one in slices, new entries go to the new heap meanwhile
+            self._compacting = heap
+            self.expiring_heap = []
+        self.expired += count
+        if count > 0:
+            logger.debug('expired %d keys', count)
+        heap = self.expiring_heap
+        if self._compacting is not None or heap and heap[0][0] <= now:
+            # budget exhausted, continue in the next loop iteration
+            self.loop.call_soon(self._expire)
         else:
-            self.loop.create_task(self._expiring_task(self.expiring_delay, size))
+            self.loop.call_later(self.expiring_interval, self._expire)
+
+    def _compact(self, deadline, now):
+        # moves the live entries of the old heap until the deadline, the due
+        # ones are expired on the way. popping from the end frees the stale
+        # entries slice by slice rather than all at once with the old heap
+        old = self._compacting
+        heap = self.expiring_heap
+        count = moved = 0
+        while old:
+            entry = old.pop()
+            moved += 1
+            item = self.store.get(entry[2])
+            if item is not None and item.expires_at == entry[0]:
+                if entry[0] <= now:
+                    self._delete(entry[2])
+                    count += 1
+                else:
+                    heapq.heappush(heap, entry)
+            if moved % 256 == 0 and time.monotonic() >= deadline:
+                break
+        if not old:
+            self._compacting = None
+        return count
+
+    def _schedule(self, key, expires_at):
+        heapq.heappush(self.expiring_heap, (expires_at, next(self._seq), key))
+
+    def _add(self, key, item):
+        item.pos = len(self.keys)
+        self.keys.append(key)
+        self.store[key] = item
+        self.used_memory += item.size
+
+    def _remove(self, key):
+        item = self.store.pop(key, None)
+        if item is not None:
+            self.used_memory -= item.size
+            last = self.keys.pop()
+            if item.pos < len(self.keys):
+                self.keys[item.pos] = last
+                self.store[last].pos = item.pos
+        return item
+
+    def _delete(self, key):
+        # expiries and evictions are logged too, a restart would bring the
+        # key back from an older put otherwise
+        self._remove(key)
+        if self.journal is not None:
+            self.journal.log(('delete', key))
+
+    def _evict(self):
+        if self.maxmemory <= 0:
+            return
+        while self.used_memory > self.maxmemory and self.store:
+            key = self._eviction_candidate()
+            self._delete(key)
+            self.evictions += 1
+            logger.debug('evicted key: %s', key)
+
+    def _eviction_candidate(self):
+        if self.policy == POLICY_VOLATILE_TTL:
+            heap = self.expiring_heap
+            while heap:
+                expires_at, _, key = heap[0]
+                item = self.store.get(key)
+                if item is not None and item.expires_at == expires_at:
+                    return key
+                heapq.heappop(heap)
+            # no key with a ttl left, fall back to lru
+        elif self.policy == POLICY_LFU:
+            # approximated like redis, the least used key among random samples
+            keys = self.keys
+            now = time.monotonic()
+            samples = [keys[random.randrange(len(keys))] for _ in range(self.eviction_samples)]
+            return min(samples, key=lambda key: self._lfu_hits(self.store[key], now))
+        return next(iter(self.store))
+
+    def _lfu_hits(self, item, now):
+        periods = int((now - item.decayed_at) / self.lfu_decay_time)
+        if periods:
+            item.hits >>= min(periods, 32)
+            item.decayed_at += periods * self.lfu_decay_time
+        return item.hits
+
+    def __len__(self):
+        return len(self.store)
+
+    def stats(self):
+        return {
+            'keys': len(self.store),
+            'bytes': self.used_memory,
+            'maxmemory': self.maxmemory,
+            'policy': self.policy,
+            'evictions': self.evictions,
+            'expired': self.expired
+        }
+
+    def _restore(self, key, value, expires_at, size=None):
+        if expires_at is not None:
+            self._schedule(key, expires_at)
+        old = self._remove(key)
+        if size is None:
+            size = approximate_size(key) + approximate_size(value)
+        item = StoreItem(value, expires_at=expires_at, size=size)
+        if old is not None:
+            item.hits, item.decayed_at = old.hits, old.decayed_at
+        self._add(key, item)
+        # logged ahead of the deletes of the keys it evicts, itself included
+        if self.journal is not None:
+            self.journal.log(('put', key, value, expires_at))
+        self._evict()
+
+    def _load(self, entries, now):
+        # bulk insert of snapshot entries into an empty store, the caller
+        # heapifies and evicts once all the entries are loaded
+        heap = self.expiring_heap
+        skipped = 0
+        for key, value, expires_at, size in entries:
+            if expires_at is not None:
+                if expires_at <= now:
+                    skipped += 1
+                    continue
+                heap.append((expires_at, next(self._seq), key))
+            self._add(key, StoreItem(value, expires_at, size))
+        return skipped
+
+    def _apply(self, record, now):
+        # replays a journal record, see StorePersistence
+        op = record[0]
+        if op == 'put':
+            _, key, value, expires_at = record
+            if expires_at is None or expires_at > now:
+                self._restore(key, value, expires_at)
+            else:
+                self._remove(key)
+        elif op == 'expires':
+            _, key, expires_at = record
+            if expires_at is not None and expires_at <= now:
+                self._remove(key)
+            elif key in self.store:
+                self.store[key].expires_at = expires_at
+                if expires_at is not None:
+                    self._schedule(key, expires_at)
+        elif op == 'delete':
+            self._remove(record[1])
+        elif op == 'flush_all':
+            self.flush_all()
 
     def flush_all(self):
         self.store.clear()
-    
+        self.keys.clear()
+        self.expiring_heap.clear()
+        self._compacting = None
+        self.used_memory = 0
+        if self.journal is not None:
+            self.journal.log(('flush_all',))
+
     def put(self, key, value, expires=None):
         if expires is not None:
             if expires <= 0:
@@ -52,13 +308,18 @@ class Store:
             expires_at = time.time() + expires
         else:
             expires_at = None
-        self.store[key] = StoreItem(value, expires_at=expires_at)
-    
+        self._restore(key, value, expires_at)
+
     def get(self, key, default=_ARG_DEFAULT, expires=None):
         if key in self.store:
             item = self.store[key]
-            if item.expires_at > time.time():
+            if item.expires_at is None or item.expires_at > time.time():
+                if self.policy == POLICY_LFU:
+                    self._lfu_hits(item, time.monotonic())
+                    item.hits += 1
+                self.store.move_to_end(key)
                 return item.value
+            self._delete(key)
         if default == _ARG_DEFAULT:
             return None
         self.put(key, default, expires)
@@ -67,11 +328,16 @@ class Store:
     def expires(self, key, expires):
         if expires is not None:
             if expires <= 0:
-                del self.store[key]
+                if self._remove(key) is not None and self.journal is not None:
+                    self.journal.log(('expires', key, 0))
                 return
             expires_at = time.time() + expires
         else:
             expires_at = None
         if key in self.store:
+            if self.journal is not None:
+                self.journal.log(('expires', key, expires_at))
             item = self.store[key]
-            item.expires_at = expires_at
\ No newline at end of file
+            item.expires_at = expires_at
+            if expires_at is not None:
+                self._schedule(key, expires_at)
@@ -0,0 +1,275 @@
+import os
+import time
+import socket
+import struct
+import pickle
+import asyncio
+import logging
+import collections
+
+from .store import StoreBackend, _ARG_DEFAULT
+
+logger = logging.getLogger('store')
+_header = struct.Struct('!I')
+# ops answered by the server, the others are fire-and-forget so a client
+# can pipeline any number of writes ahead of its next read
+_reply_ops = ('get', 'stats', 'len')
+
+
+def _frame(obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return _header.pack(len(data)) + data
+
+
+class StoreServer:
+    # serves a local Store to RemoteStore clients over a unix domain socket
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.server = None
+        self.clients = 0
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self._on_client, path=self.path)
+        logger.info(f'store server listening on {self.path}')
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _handle(self, request):
+        op = request[0]
+        if op == 'get':
+            _, key, has_default, default, expires = request
+            if has_default:
+                return self.store.get(key, default, expires)
+            return self.store.get(key)
+        elif op == 'put':
+            _, key, value, expires = request
+            self.store.put(key, value, expires)
+        elif op == 'expires':
+            _, key, expires = request
+            self.store.expires(key, expires)
+        elif op == 'flush_all':
+            self.store.flush_all()
+        elif op == 'stats':
+            return self.store.stats()
+        elif op == 'len':
+            return len(self.store)
+        else:
+            raise ValueError(f'unknown store op {op}')
+
+    async def _on_client(self, reader, writer):
+        self.clients += 1
+        try:
+            while True:
+                header = await reader.readexactly(_header.size)
+                request = pickle.loads(await reader.readexactly(_header.unpack(header)[0]))
+                try:
+                    result = ('ok', self._handle(request))
+                except Exception as e:
+                    logger.exception(f'store op {request[0]} failed')
+                    result = ('error', f'{type(e).__name__}: {e}')
+                if request[0] in _reply_ops:
+                    writer.write(_frame(result))
+                    if writer.transport.get_write_buffer_size() > 65536:
+                        await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception('store client error')
+        finally:
+            self.clients -= 1
+            writer.close()
+
+
+class RemoteStore(StoreBackend):
+    # client of StoreServer over a unix domain socket. writes are buffered and
+    # sent in one batch at the end of the loop iteration or before the next
+    # read. replies come in the order of the reads: the _async variants wait
+    # for theirs on the loop, get/stats/len block the loop for the round trip
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self._writing = False
+        self._pending = bytearray()
+        self._received = bytearray()
+        self._flush_scheduled = False
+        self._replies = collections.deque()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            self._fail(f'cannot connect to the store server {self.path}: {type(e).__name__} {e}')
+            return False
+        sock.setblocking(False)
+        self.sock = sock
+        asyncio.get_event_loop().add_reader(sock.fileno(), self._on_readable)
+        return True
+
+    def _close(self, message):
+        if self.sock is not None:
+            loop = asyncio.get_event_loop()
+            loop.remove_reader(self.sock.fileno())
+            if self._writing:
+                loop.remove_writer(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+        self._writing = False
+        self._received.clear()
+        self._fail(message)
+
+    def _fail(self, message):
+        if self._pending:
+            logger.error(f'store requests to {self.path} lost')
+            self._pending.clear()
+        while self._replies:
+            fut = self._replies.popleft()
+            if not fut.done():
+                fut.set_exception(ConnectionError(message))
+
+    def _flush(self, deadline=None):
+        # sends what the socket takes and the rest when it is writable, with
+        # a deadline blocks until everything is sent
+        self._flush_scheduled = False
+        if not self._pending or self._writing and deadline is None:
+            return
+        if self.sock is None and not self._connect():
+            return
+        try:
+            if deadline is None:
+                del self._pending[:self.sock.send(self._pending)]
+            else:
+                self.sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                try:
+                    self.sock.sendall(self._pending)
+                finally:
+                    self.sock.setblocking(False)
+                self._pending.clear()
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            # a partial blocking send leaves the stream unusable
+            self._close(f'store server {self.path} write failed: {type(e).__name__} {e}')
+            return
+        if self._pending and not self._writing:
+            asyncio.get_event_loop().add_writer(self.sock.fileno(), self._flush)
+            self._writing = True
+        elif not self._pending and self._writing:
+            asyncio.get_event_loop().remove_writer(self.sock.fileno())
+            self._writing = False
+
+    def _on_readable(self):
+        try:
+            data = self.sock.recv(262144)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._close(f'store server {self.path} read failed: {type(e).__name__} {e}')
+            return
+        self._on_data(data)
+
+    def _on_data(self, data):
+        if not data:
+            self._close(f'store server {self.path} closed the connection')
+            return
+        buf = self._received
+        buf += data
+        offset = 0
+        while len(buf) - offset >= _header.size:
+            end = offset + _header.size + _header.unpack_from(buf, offset)[0]
+            if len(buf) < end:
+                break
+            reply = pickle.loads(buf[offset + _header.size:end])
+            offset = end
+            fut = self._replies.popleft()
+            # a read that timed out is still answered
+            if not fut.done():
+                fut.set_result(reply)
+        del buf[:offset]
+
+    def _write(self, request):
+        self._pending += _frame(request)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self._flush)
+
+    def _request(self, request):
+        fut = asyncio.get_event_loop().create_future()
+        self._replies.append(fut)
+        self._pending += _frame(request)
+        return fut
+
+    @staticmethod
+    def _result(reply):
+        status, result = reply
+        if status == 'error':
+            raise RuntimeError(f'store server error: {result}')
+        return result
+
+    async def _read(self, request):
+        fut = self._request(request)
+        self._flush()
+        return self._result(await asyncio.wait_for(fut, self.timeout))
+
+    def _blocking_read(self, request):
+        # the replies of pending async reads are dispatched on the way
+        deadline = time.monotonic() + self.timeout
+        fut = self._request(request)
+        self._flush(deadline)
+        while not fut.done():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'store server {self.path} did not answer in {self.timeout}s')
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(262144)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                self._close(f'store server {self.path} read failed: {type(e).__name__} {e}')
+                break
+            finally:
+                if self.sock is not None:
+                    self.sock.setblocking(False)
+            self._on_data(data)
+        return self._result(fut.result())
+
+    def flush_all(self):
+        self._write(('flush_all',))
+
+    def put(self, key, value, expires=None):
+        self._write(('put', key, value, expires))
+
+    def get(self, key, default=_ARG_DEFAULT, expires=None):
+        if default == _ARG_DEFAULT:
+            return self._blocking_read(('get', key, False, None, None))
+        return self._blocking_read(('get', key, True, default, expires))
+
+    async def get_async(self, key, default=_ARG_DEFAULT, expires=None):
+        if default == _ARG_DEFAULT:
+            return await self._read(('get', key, False, None, None))
+        return await self._read(('get', key, True, default, expires))
+
+    def expires(self, key, expires):
+        self._write(('expires', key, expires))
+
+    def stats(self):
+        return self._blocking_read(('stats',))
+
+    async def stats_async(self):
+        return await self._read(('stats',))
+
+    def __len__(self):
+        return self._blocking_read(('len',))
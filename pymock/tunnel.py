@@ -1,16 +1,64 @@
+import os
+import socket
 import asyncio
 import logging
-from . import utils
+from . import utils, metrics
+from .shaping import ShapedWriter
+from .balancer import Backend, Balancer, HealthCheck, BALANCE_ROUND_ROBIN
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger('pymock.tunnel')
 tunnel_map = {}
 processor = None
+# reads start small for interactive traffic and double while they fill the
+# buffer, up to max_read_size for bulk transfers
+min_read_size = 16 * 1024
+max_read_size = 256 * 1024
+splice_supported = hasattr(os, 'splice')
+# -no-splice turns the fast path off for all the tunnels
+splice_enabled = True
+
+
+def _next_read_size(size, received):
+    if received >= size:
+        return min(size * 2, max_read_size)
+    if received < size // 4:
+        return max(size // 2, min_read_size)
+    return size
+
+
+async def _wait_fd(loop, fd, writable=False):
+    fut = loop.create_future()
+    if writable:
+        loop.add_writer(fd, fut.set_result, None)
+    else:
+        loop.add_reader(fd, fut.set_result, None)
+    try:
+        await fut
+    finally:
+        if writable:
+            loop.remove_writer(fd)
+        else:
+            loop.remove_reader(fd)
+
+
+async def _write_fd(loop, fd, data):
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except BlockingIOError:
+            await _wait_fd(loop, fd, writable=True)
 
 
 class ControllerBase:
     def __init__(self, conn):
         self.conn = conn
-        self.logger = logger
+        self.logger = conn.logger
         self.conn_id = self.conn.conn_id
 
     def on_connected(self):
@@ -26,39 +74,71 @@ class ControllerBase:
 class Connection:
     def __init__(self, conn_id, local_reader, local_writer, tunnel):
         self.conn_id = conn_id
+        # structured fields for the log subscriptions of the websocket viewer
+        self.logger = logging.LoggerAdapter(logger, {'conn_id': conn_id, 'tunnel_port': tunnel.port})
         self.local_reader = local_reader
         self.local_writer = local_writer
         self.tunnel = tunnel
         peer_info = local_writer.get_extra_info('peername')
         self.peer_ip, self.peer_port = peer_info[0], peer_info[1]
-        self.desc = f'{self.peer_ip}:{self.peer_port} => {self.tunnel.dest_host}:{self.tunnel.dest_port}'
+        self.desc = f'{self.peer_ip}:{self.peer_port} => {self.tunnel.port}'
+        self.backend = None
         self.local_socket = local_writer.get_extra_info('socket')
         self.dest_reader = self.dest_writer = self.dest_socket = self.conn_fut = None
         self.cancelled = False
         self.controller = tunnel.controller_cls(self)
         self.utils = utils
 
+    async def connect(self):
+        error = None
+        for backend in self.tunnel.balancer.candidates(self.peer_ip):
+            try:
+                self.dest_reader, self.dest_writer = await asyncio.open_connection(
+                    backend.host, backend.port, limit=max_read_size)
+            except OSError as e:
+                error = e
+                self.logger.warning(f'[{self.conn_id}] tunnel backend {backend.name} connect failed: {e}')
+                self.tunnel.on_backend_failure(backend)
+                continue
+            self.backend = backend
+            backend.active += 1
+            backend.total += 1
+            self.desc = f'{self.peer_ip}:{self.peer_port} => {backend.name}'
+            return
+        raise error
+
     async def start(self):
-        dest_host = self.tunnel.dest_host
-        dest_port = self.tunnel.dest_port
-        self.dest_reader, self.dest_writer = await asyncio.open_connection(dest_host, dest_port)
+        try:
+            await self.connect()
+        except OSError:
+            self.logger.error(f'[{self.conn_id}] tunnel connect failed {self.desc}')
+            self.local_writer.close()
+            self.tunnel.on_disconnect(self)
+            return
         self.dest_socket = self.dest_writer.get_extra_info('socket')
-        logger.info(f'[{self.conn_id}] tunnel connected {self.desc}')
+        self.logger.info(f'[{self.conn_id}] tunnel connected {self.desc}')
         self.controller.on_connected()
-        input_co = self.proxy_in()
-        output_co = self.proxy_out()
+        if self.tunnel.use_splice and splice_enabled and splice_supported and self.tunnel.shaping is None \
+                and type(self.controller) is ControllerBase:
+            # nothing looks at the data, the kernel moves it between the sockets
+            input_co = self.splice(self.dest_reader, self.dest_writer, self.local_writer, 'bytes_in')
+            output_co = self.splice(self.local_reader, self.local_writer, self.dest_writer, 'bytes_out')
+        else:
+            input_co = self.proxy_in()
+            output_co = self.proxy_out()
         self.conn_fut = asyncio.gather(input_co, output_co)
         try:
             await self.conn_fut
-            logger.info(f'[{self.conn_id}] tunnel closed {self.desc}')
+            self.logger.info(f'[{self.conn_id}] tunnel closed {self.desc}')
         except:
             if self.cancelled:
-                logger.info(f'[{self.conn_id}] tunnel cancelled {self.desc}')
+                self.logger.info(f'[{self.conn_id}] tunnel cancelled {self.desc}')
             else:
-                logger.exception(f'[{self.conn_id}] tunnel error {self.desc}')
+                self.logger.exception(f'[{self.conn_id}] tunnel error {self.desc}')
                 # cancel the remain task
                 self.conn_fut.cancel()
         finally:
+            self.backend.active -= 1
             self.tunnel.on_disconnect(self)
 
     def cancel(self):
@@ -67,42 +147,126 @@ class Connection:
             self.conn_fut.cancel()
 
     async def proxy_out(self):
+        return await self.proxy(self.local_reader, self.dest_writer, self.controller.on_output, 'bytes_out')
+
+    async def proxy_in(self):
+        return await self.proxy(self.dest_reader, self.local_writer, self.controller.on_input, 'bytes_in')
+
+    async def proxy(self, reader, writer, on_data, counter):
+        size = min_read_size
+        # created once the tunnel is shaped, also when shaping is set live
+        shaped = None
         try:
             while True:
-                data = await self.local_reader.read(1024)
+                data = await reader.read(size)
                 if data:
-                    await self.controller.on_output(data)
-                    self.dest_writer.write(data)
-                    await self.dest_writer.drain()
+                    size = _next_read_size(size, len(data))
+                    await on_data(data)
+                    self._count(counter, len(data))
+                    if shaped is None and self.tunnel.shaping is not None:
+                        shaped = ShapedWriter(self.tunnel, writer)
+                    if shaped is not None:
+                        await shaped.write(data)
+                    else:
+                        writer.write(data)
+                        await writer.drain()
                 else:
-                    self.dest_writer.write_eof()
+                    if shaped is not None:
+                        await shaped.close()
+                    else:
+                        writer.write_eof()
                     return True
         except:
-            self.dest_writer.close()
+            if shaped is not None:
+                shaped.cancel()
+            writer.close()
             raise
 
-    async def proxy_in(self):
+    def _count(self, counter, size):
+        setattr(self.tunnel, counter, getattr(self.tunnel, counter) + size)
+        setattr(self.backend, counter, getattr(self.backend, counter) + size)
+
+    async def _drain_reader(self, loop, reader, writer, dst_fd, counter):
+        # sends what the stream read before the transport was paused, a read
+        # still waiting after one loop iteration means the buffer is empty.
+        # the stream resumes the transport when its buffer shrinks, so it is
+        # paused again until it stays paused. True at eof
+        while True:
+            writer.transport.pause_reading()
+            read = asyncio.ensure_future(reader.read(max_read_size))
+            await asyncio.sleep(0)
+            if not read.done():
+                read.cancel()
+                try:
+                    await read
+                except asyncio.CancelledError:
+                    pass
+                if writer.transport.is_reading():
+                    continue
+                return False
+            data = read.result()
+            if not data:
+                return True
+            self._count(counter, len(data))
+            await _write_fd(loop, dst_fd, data)
+
+    async def splice(self, src_reader, src_writer, dst_writer, counter):
+        # zero-copy relay through a pipe with os.splice, the transports are
+        # paused and the sockets are driven on duplicated descriptors since
+        # the event loop refuses readers on descriptors owned by a transport
+        loop = asyncio.get_running_loop()
+        src_fd = os.dup(src_writer.get_extra_info('socket').fileno())
+        dst_fd = os.dup(dst_writer.get_extra_info('socket').fileno())
+        pipe_r, pipe_w = os.pipe()
+        if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, max_read_size)
+            except OSError:
+                pass
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
         try:
-            while True:
-                data = await self.dest_reader.read(1024)
-                if data:
-                    await self.controller.on_input(data)
-                    self.local_writer.write(data)
-                    await self.local_writer.drain()
-                else:
-                    self.local_writer.write_eof()
-                    return True
+            # spliced bytes go straight to the socket, the ones still queued
+            # in the transport must be sent first
+            dst_writer.transport.set_write_buffer_limits(high=0)
+            await dst_writer.drain()
+            eof = await self._drain_reader(loop, src_reader, src_writer, dst_fd, counter)
+            while not eof:
+                try:
+                    received = os.splice(src_fd, pipe_w, max_read_size, flags=flags)
+                except BlockingIOError:
+                    await _wait_fd(loop, src_fd)
+                    continue
+                if received == 0:
+                    break
+                self._count(counter, received)
+                while received > 0:
+                    try:
+                        received -= os.splice(pipe_r, dst_fd, received, flags=flags)
+                    except BlockingIOError:
+                        await _wait_fd(loop, dst_fd, writable=True)
+            dst_writer.write_eof()
+            return True
         except:
-            self.local_writer.close()
+            dst_writer.close()
             raise
+        finally:
+            for fd in (src_fd, dst_fd, pipe_r, pipe_w):
+                os.close(fd)
 
 
 class Tunnel:
-    def __init__(self, port, dest_host, dest_port, controller_cls):
+    def __init__(self, port, dest_host, dest_port, controller_cls, shaping=None,
+                 destinations=None, balance=BALANCE_ROUND_ROBIN, health_check=None):
         self.port = port
-        self.dest_host = dest_host
-        self.dest_port = dest_port
-        self.desc = f'{self.port} => {dest_host}:{dest_port}'
+        # destinations is a list of (host, port), dest_host:dest_port is the first one
+        if not destinations:
+            destinations = [(dest_host, dest_port)]
+        self.backends = [Backend(*destination) for destination in destinations]
+        self.balancer = Balancer(self.backends, balance)
+        self.dest_host, self.dest_port = destinations[0]
+        self.desc = f'{self.port} => {", ".join(b.name for b in self.backends)}'
+        # HealthCheck options checked by health_check_config, None without active checks
+        self.health_check = HealthCheck(self.backends, self.desc, **health_check) if health_check is not None else None
         if controller_cls:
             self.controller_cls = controller_cls
         else:
@@ -110,14 +274,25 @@ class Tunnel:
         self.connections = {}
         self.server = None
         self.status = 'stopped'
-        
+        # bytes received from the destination and sent to it
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.use_splice = True
+        # Shaping of the connections, None when not shaped
+        self.shaping = shaping
+        # identity of the config mapping, see reload_tunnel
+        self.signature = None
+        self.controller_file = None
+
     async def start(self):
         logger.info(f'starting tunnel server {self.desc}')
         if self.status != 'stopped':
             return
         self.status = 'starting'
         self.started = True
-        self.server = await asyncio.start_server(self.on_connect, port=self.port)
+        self.server = await asyncio.start_server(self.on_connect, port=self.port, limit=max_read_size)
+        if self.health_check is not None:
+            self.health_check.start()
         self.status = 'started'
 
     async def on_connect(self, local_reader, local_writer):
@@ -132,6 +307,12 @@ class Tunnel:
     def on_disconnect(self, conn):
         del self.connections[conn.conn_id]
 
+    def on_backend_failure(self, backend):
+        backend.failures += 1
+        if self.health_check is not None:
+            # counts as a failed check, a dead backend is ejected without waiting
+            self.health_check.report(backend, False)
+
     async def stop(self):
         logger.info(f'stopping tunnel server {self.desc}')
         if self.status != 'started':
@@ -140,6 +321,8 @@ class Tunnel:
         self.started = False
         self.server.close()
         await self.server.wait_closed()
+        if self.health_check is not None:
+            self.health_check.stop()
         for conn in self.connections.values():
             conn.cancel()
         self.status = 'stopped'
@@ -163,11 +346,43 @@ async def start_tunnel(tunnel):
 
 
 async def reload_tunnel(tunnel_list):
-    for _, tunnel in tunnel_map.items():
-        await tunnel.stop()
-    tunnel_map.clear()
-    for tunnel in tunnel_list:
-        await start_tunnel(tunnel)
+    # only the tunnels whose mapping changed are restarted, the others keep
+    # their connections and pick up the reloaded controller class
+    new_map = {t.port: t for t in tunnel_list}
+    for port, tunnel in list(tunnel_map.items()):
+        new_tunnel = new_map.get(port)
+        if new_tunnel is None or new_tunnel.signature is None or new_tunnel.signature != tunnel.signature:
+            await tunnel.stop()
+            del tunnel_map[port]
+    for port, tunnel in new_map.items():
+        running = tunnel_map.get(port)
+        if running is not None:
+            running.controller_cls = tunnel.controller_cls
+            if running.status == 'stopped':
+                await running.start()
+        else:
+            await start_tunnel(tunnel)
+
+
+def _collect_metrics():
+    result = []
+    labels = ('port', 'destination')
+    for name, type, help, attr in (
+            ('pymock_tunnel_connections', 'gauge', 'open tunnel connections', 'active'),
+            ('pymock_tunnel_connections_total', 'counter', 'tunnel connections to the destination', 'total'),
+            ('pymock_tunnel_connect_failures_total', 'counter', 'failed connects to the destination', 'failures'),
+            ('pymock_tunnel_received_bytes_total', 'counter', 'bytes received from the tunnel destination', 'bytes_in'),
+            ('pymock_tunnel_sent_bytes_total', 'counter', 'bytes sent to the tunnel destination', 'bytes_out'),
+            ('pymock_tunnel_destination_healthy', 'gauge', 'health of the tunnel destination', 'healthy')):
+        metric = metrics.Collected(name, type, help, labels)
+        for tunnel in tunnel_map.values():
+            for backend in tunnel.backends:
+                metric.add(tunnel.port, backend.name, value=int(getattr(backend, attr)))
+        result.append(metric)
+    return result
+
+
+metrics.add_collector(_collect_metrics)
 
 
 def setup_tunnel(tunnel_list):
@@ -9,6 +9,25 @@ import struct
 _ARG_DEFAULT = object()
 safe_chars = '_-.' + string.ascii_letters + string.digits
 
+class BodyBuffer:
+    # bytearray backed accumulator, appending chunks stays linear in the body size
+    def __init__(self):
+        self._buf = bytearray()
+
+    def append(self, chunk):
+        self._buf += chunk
+
+    def getvalue(self):
+        return bytes(self._buf)
+
+    def getbuffer(self):
+        # no copy, the buffer can't grow while the view is alive
+        return memoryview(self._buf)
+
+    def __len__(self):
+        return len(self._buf)
+
+
 def init_logging():
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.INFO)
@@ -0,0 +1,216 @@
+import os
+import sys
+import struct
+import ctypes
+import ctypes.util
+import asyncio
+import logging
+
+from . import config
+
+logger = logging.getLogger('pymock.watcher')
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+_watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_event = struct.Struct('iIII')
+
+
+def _file_version(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class Inotify:
+    # directories are watched rather than files, editors often save by
+    # writing a new file and renaming it over the old one
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor => directory
+        self.dirs = {}
+
+    def watch(self, directories):
+        watched = set(self.dirs.values())
+        for directory in directories - watched:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), _watch_mask)
+            if wd < 0:
+                logger.warning(f'cannot watch {directory}: {os.strerror(ctypes.get_errno())}')
+                continue
+            self.dirs[wd] = directory
+        for wd, directory in list(self.dirs.items()):
+            if directory not in directories:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[wd]
+
+    def read(self):
+        # paths of the events, None for a queue overflow
+        paths = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return paths
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, size = _event.unpack_from(data, pos)
+                pos += _event.size
+                name = data[pos:pos + size].rstrip(b'\0')
+                pos += size
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                directory = self.dirs.get(wd)
+                if directory is not None and name:
+                    paths.add(os.path.join(directory, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    # calls on_change(paths) with the files of paths_getter() whose mtime or
+    # size changed, once a burst of changes has been quiet for debounce seconds
+    def __init__(self, paths_getter, on_change, debounce=0.3, poll_interval=1, use_inotify=True):
+        self.paths_getter = paths_getter
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        # a constant stream of writes still reloads after max_delay
+        self.max_delay = debounce * 10
+        self.use_inotify = use_inotify
+        self.inotify = None
+        # absolute path => path as returned by paths_getter
+        self.paths = {}
+        self.versions = {}
+        # versions seen by the last poll, a burst is over once a poll sees no change
+        self.polled = {}
+        self.pending = set()
+        self._timer = None
+        self._first_pending = None
+        self._poll_handle = None
+        self._lock = asyncio.Lock()
+        self.loop = None
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        if self.use_inotify and sys.platform.startswith('linux'):
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                logger.warning(f'inotify not available, polling files instead: {e}')
+        self.refresh()
+        if self.inotify is not None:
+            self.loop.add_reader(self.inotify.fd, self._on_events)
+        self._poll_handle = self.loop.call_later(self.poll_interval, self._poll)
+        logger.info(f'watching {len(self.paths)} files' + (' with inotify' if self.inotify else ''))
+
+    def stop(self):
+        if self.inotify is not None:
+            self.loop.remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+        for handle in (self._timer, self._poll_handle):
+            if handle is not None:
+                handle.cancel()
+
+    def refresh(self):
+        # the watched files change with the config
+        paths = {}
+        for path in self.paths_getter():
+            paths[os.path.abspath(path)] = path
+        for abspath in paths:
+            if abspath not in self.versions:
+                self.versions[abspath] = self.polled[abspath] = _file_version(abspath)
+        for abspath in list(self.versions):
+            if abspath not in paths:
+                del self.versions[abspath]
+                self.polled.pop(abspath, None)
+        self.paths = paths
+        if self.inotify is not None:
+            self.inotify.watch({os.path.dirname(abspath) for abspath in paths})
+
+    def _on_events(self):
+        paths = self.inotify.read()
+        if paths is None:
+            # events lost, check every file
+            paths = set(self.paths)
+        self._schedule(paths & set(self.paths))
+
+    def _poll(self):
+        # with inotify only a slow resync of the watched files
+        if self.inotify is None:
+            changed = set()
+            for abspath in self.paths:
+                version = _file_version(abspath)
+                if version != self.polled.get(abspath):
+                    self.polled[abspath] = version
+                    changed.add(abspath)
+            self._schedule(changed)
+            interval = self.poll_interval
+        else:
+            self.refresh()
+            interval = self.poll_interval * 5
+        self._poll_handle = self.loop.call_later(interval, self._poll)
+
+    def _schedule(self, paths):
+        if not paths:
+            return
+        self.pending |= paths
+        now = self.loop.time()
+        if self._first_pending is None:
+            self._first_pending = now
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = min(self.debounce, self._first_pending + self.max_delay - now)
+        self._timer = self.loop.call_later(max(delay, 0), self._fire)
+
+    def _fire(self):
+        self._timer = None
+        self._first_pending = None
+        changed = []
+        for abspath in self.pending:
+            version = _file_version(abspath)
+            if version is not None and version != self.versions.get(abspath):
+                self.versions[abspath] = version
+                if abspath in self.paths:
+                    changed.append(self.paths[abspath])
+        self.pending.clear()
+        if changed:
+            self.loop.create_task(self._notify(sorted(changed)))
+
+    async def _notify(self, paths):
+        async with self._lock:
+            try:
+                await self.on_change(paths)
+            except Exception:
+                logger.exception(f'error handling changes of {paths}')
+            self.refresh()
+
+
+def setup_watcher(mock, workers=None, poll_interval=1):
+    async def on_change(paths):
+        # a changed config reloads the rule and controller files changed with it
+        if config.config_file in paths:
+            paths = [config.config_file]
+        for path in paths:
+            try:
+                message = await config.reload_file(path, mock)
+                logger.info(f'{path} changed: {message}')
+            except Exception:
+                logger.exception(f'error reloading {path}')
+                continue
+            if workers:
+                await workers.broadcast_reload(path)
+
+    watcher = FileWatcher(config.watched_files, on_change, poll_interval=poll_interval)
+    watcher.start()
+    return watcher
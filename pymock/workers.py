@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+import collections
+from tornado import ioloop, process, iostream
+from . import metrics, mock
+
+logger = logging.getLogger('pymock.workers')
+
+
+class WorkerPool:
+    # supervisor side of the -workers mode, every worker is a pymock process
+    # serving the mock port with SO_REUSEPORT, commands go through stdin and
+    # the answers of queries and the log records through a pipe, one line
+    # each. log records are only sent while log_handler has clients
+    def __init__(self, count, worker_args, query_timeout=5):
+        self.count = count
+        self.worker_args = worker_args
+        self.query_timeout = query_timeout
+        self.workers = [None] * count
+        # futures of the queries waiting for an answer, in order
+        self.answers = [collections.deque() for _ in range(count)]
+        self.query_locks = [asyncio.Lock() for _ in range(count)]
+        # the WebsocketHandler of /ws/logs, set by main
+        self.log_handler = None
+        self.forward_logs = False
+        self.restarts = 0
+        self.restart_delay = 1
+        self.stopping = False
+
+    def start(self):
+        for idx in range(self.count):
+            self._spawn(idx)
+
+    def _spawn(self, idx):
+        reply_r, reply_w = os.pipe()
+        args = [sys.executable, '-m', 'pymock.main', '-worker', '-reply-fd', str(reply_w)] + self.worker_args
+        try:
+            proc = process.Subprocess(args, stdin=process.Subprocess.STREAM, pass_fds=(reply_w,))
+        except Exception:
+            os.close(reply_r)
+            raise
+        finally:
+            os.close(reply_w)
+        proc.set_exit_callback(lambda code: self._on_exit(idx, proc, code))
+        self.workers[idx] = proc
+        ioloop.IOLoop.current().spawn_callback(self._read_replies, idx, iostream.PipeIOStream(reply_r))
+        if self.forward_logs:
+            ioloop.IOLoop.current().spawn_callback(self._send, idx, proc, 'logs on')
+        logger.info(f'worker[{idx}] started, pid={proc.pid}')
+
+    async def _read_replies(self, idx, stream):
+        answers = self.answers[idx]
+        try:
+            while True:
+                message = json.loads(await stream.read_until(b'\n'))
+                if 'log' in message:
+                    self._on_log(idx, message['log'])
+                    continue
+                fut = answers.popleft()
+                # a query that timed out is still answered
+                if not fut.done():
+                    fut.set_result(message)
+        except iostream.StreamClosedError:
+            pass
+        except Exception:
+            logger.exception(f'worker[{idx}] sent an invalid message')
+        finally:
+            stream.close()
+            while answers:
+                fut = answers.popleft()
+                if not fut.done():
+                    fut.set_result({'error': 'worker not reachable'})
+
+    def _on_log(self, idx, fields):
+        if self.log_handler is None:
+            return
+        fields['msg'] = f'worker[{idx}] {fields["msg"]}'
+        # only to /ws/logs, the worker already wrote it to stdout
+        self.log_handler.handle(logging.makeLogRecord(fields))
+
+    def set_forward_logs(self, enabled):
+        if enabled == self.forward_logs:
+            return
+        self.forward_logs = enabled
+        for idx, proc in enumerate(self.workers):
+            if proc is not None:
+                ioloop.IOLoop.current().spawn_callback(self._send, idx, proc, f'logs {"on" if enabled else "off"}')
+
+    async def _send(self, idx, proc, command):
+        try:
+            await proc.stdin.write(f'{command}\n'.encode('utf-8'))
+        except iostream.StreamClosedError:
+            logger.warning(f'worker[{idx}] not reachable, {command} skipped')
+
+    def _on_exit(self, idx, proc, code):
+        if self.workers[idx] is not proc:
+            return
+        self.workers[idx] = None
+        if self.stopping:
+            logger.info(f'worker[{idx}] stopped, pid={proc.pid}')
+            return
+        logger.error(f'worker[{idx}] exited with code {code}, pid={proc.pid}, restarting')
+        self.restarts += 1
+        ioloop.IOLoop.current().call_later(self.restart_delay, self._respawn, idx)
+
+    def _respawn(self, idx):
+        if not self.stopping and self.workers[idx] is None:
+            self._spawn(idx)
+
+    async def broadcast_reload(self, path):
+        message = f'reload {path}\n'.encode('utf-8')
+        for idx, proc in enumerate(self.workers):
+            if proc is None:
+                continue
+            try:
+                await proc.stdin.write(message)
+            except iostream.StreamClosedError:
+                logger.warning(f'worker[{idx}] not reachable, reload of {path} skipped')
+
+    async def _query(self, idx, command):
+        proc = self.workers[idx]
+        if proc is None:
+            return {'error': 'worker not running'}
+        # one query at a time per worker, the answers come in order
+        async with self.query_locks[idx]:
+            fut = asyncio.get_event_loop().create_future()
+            self.answers[idx].append(fut)
+            try:
+                await proc.stdin.write(f'{command}\n'.encode('utf-8'))
+                return await asyncio.wait_for(asyncio.shield(fut), self.query_timeout)
+            except iostream.StreamClosedError:
+                return {'error': 'worker not reachable'}
+            except asyncio.TimeoutError:
+                proc.proc.kill()
+                return {'error': f'no answer after {self.query_timeout}s, worker restarted'}
+
+    async def query(self, command):
+        # the answer of every worker, {'error': ...} for the unreachable ones
+        return await asyncio.gather(*[self._query(idx, command) for idx in range(self.count)])
+
+    def stop(self):
+        self.stopping = True
+        for proc in self.workers:
+            if proc is not None:
+                proc.proc.terminate()
+        for proc in self.workers:
+            if proc is not None:
+                proc.proc.wait()
+
+
+def _answer(command):
+    if command == 'stats':
+        return {'cache': mock.response_cache.stats(), 'metrics': metrics.render()}
+    if command == 'cache-clear':
+        mock.response_cache.clear()
+        return {'cleared': True}
+    return {'error': f'unknown worker command {command}'}
+
+
+class PipeLogHandler(logging.Handler):
+    # worker side of the log forwarding, records are written to the reply
+    # pipe as {"log": {...}} lines while the supervisor has log clients
+    def __init__(self, stream):
+        logging.Handler.__init__(self)
+        self.stream = stream
+        self.enabled = False
+        self.io_loop = ioloop.IOLoop.current()
+        self._formatter = logging.Formatter()
+
+    def emit(self, record):
+        if not self.enabled:
+            return
+        try:
+            msg = record.getMessage()
+            if record.exc_info:
+                msg = f'{msg}\n{self._formatter.formatException(record.exc_info)}'
+            fields = {'name': record.name, 'levelno': record.levelno, 'levelname': record.levelname,
+                      'msg': msg, 'created': record.created}
+            for name in ('request_id', 'request_path', 'conn_id'):
+                if hasattr(record, name):
+                    fields[name] = getattr(record, name)
+            line = json.dumps({'log': fields}, default=str).encode('utf-8') + b'\n'
+            # records come from other threads too, the stream is the loop's
+            self.io_loop.add_callback(self._write, line)
+        except Exception:
+            self.handleError(record)
+
+    def _write(self, line):
+        if not self.stream.closed():
+            self.stream.write(line)
+
+
+async def read_commands(mocker, reload_file, reply_fd):
+    # worker side, commands are sent by WorkerPool.broadcast_reload,
+    # WorkerPool.query and WorkerPool.set_forward_logs, the answers of
+    # queries and the forwarded log records go to reply_fd
+    stream = iostream.PipeIOStream(sys.stdin.fileno())
+    replies = iostream.PipeIOStream(reply_fd)
+    log_handler = PipeLogHandler(replies)
+    logging.getLogger('pymock').addHandler(log_handler)
+    while True:
+        try:
+            line = await stream.read_until(b'\n')
+        except iostream.StreamClosedError:
+            logger.info('supervisor gone, stopping worker')
+            ioloop.IOLoop.current().stop()
+            return
+        command, _, arg = line.decode('utf-8').strip().partition(' ')
+        if command == 'reload':
+            try:
+                message = await reload_file(arg, mocker)
+                logger.info(f'{arg}: {message}')
+            except Exception:
+                logger.exception(f'error reloading {arg}')
+        elif command == 'logs':
+            log_handler.enabled = arg == 'on'
+        else:
+            try:
+                answer = _answer(command)
+            except Exception as e:
+                logger.exception(f'error answering {command}')
+                answer = {'error': f'{type(e).__name__}: {e}'}
+            await replies.write(json.dumps(answer).encode('utf-8') + b'\n')
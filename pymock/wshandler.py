@@ -1,14 +1,143 @@
+import re
+import logging
+import itertools
+import collections
 from logging import Handler
+from tornado import ioloop
+
+
+class LogFilter:
+    # subscription of a log client, every given field must match
+    fields = ('level', 'logger', 'request_id', 'path', 'conn_id', 'regex')
+
+    def __init__(self, spec):
+        unknown = set(spec) - set(self.fields)
+        if unknown:
+            raise ValueError(f'unknown filter fields {sorted(unknown)}')
+        for name in self.fields:
+            value = spec.get(name)
+            if value is None:
+                continue
+            if name == 'level':
+                if not isinstance(value, (str, int)) or isinstance(value, bool):
+                    raise ValueError(f'filter field level should be a string or an integer')
+            elif not isinstance(value, str):
+                raise ValueError(f'filter field {name} should be a string')
+        level = spec.get('level') or logging.NOTSET
+        if isinstance(level, str):
+            level = logging.getLevelName(level.upper())
+            if not isinstance(level, int):
+                raise ValueError(f'unknown log level {spec["level"]}')
+        self.level = level
+        self.logger = spec.get('logger') or None
+        self.request_id = spec.get('request_id') or None
+        self.path = spec.get('path') or None
+        self.conn_id = spec.get('conn_id') or None
+        self.regex = re.compile(spec['regex']) if spec.get('regex') else None
+
+    def match(self, record):
+        if record.levelno < self.level:
+            return False
+        if self.logger is not None and record.name != self.logger \
+                and not record.name.startswith(self.logger + '.'):
+            return False
+        if self.request_id is not None and getattr(record, 'request_id', None) != self.request_id:
+            return False
+        if self.path is not None:
+            path = getattr(record, 'request_path', None)
+            if path is None or not path.startswith(self.path):
+                return False
+        if self.conn_id is not None and getattr(record, 'conn_id', None) != self.conn_id:
+            return False
+        if self.regex is not None and not self.regex.search(record.getMessage()):
+            return False
+        return True
+
 
 class WebsocketHandler(Handler):
-    def __init__(self, clients_getter):
+    # emit only appends the raw record to a ring buffer, records are
+    # formatted once and sent to every client in coalesced frames by
+    # _send_batch. not named flush, which logging.shutdown calls
+    def __init__(self, clients_getter, capacity=10000, interval=0.1, max_batch=1000):
         Handler.__init__(self)
         self.clients_getter = clients_getter
+        self.records = collections.deque(maxlen=capacity)
+        self.next_seq = 0
+        self.interval = interval
+        self.max_batch = max_batch
+        self._callback = None
+
+    def start(self):
+        self._callback = ioloop.PeriodicCallback(self._send_batch, self.interval * 1000)
+        self._callback.start()
 
     def emit(self, record):
+        # called with self.lock held, see Handler.handle
         try:
-            msg = self.format(record)
-            for client in self.clients_getter():
-                client.send_log(msg)
+            clients = self.clients_getter()
+            if not clients:
+                return
+            # records nobody subscribed to never reach the ring buffer
+            for client in clients:
+                if client.log_filter is None or client.log_filter.match(record):
+                    break
+            else:
+                return
+            self.records.append([self.next_seq, record, None])
+            self.next_seq += 1
         except Exception:
-            self.handleError(record)
\ No newline at end of file
+            self.handleError(record)
+
+    def _format(self, entry):
+        if entry[2] is None:
+            try:
+                entry[2] = self.format(entry[1])
+            except Exception:
+                entry[2] = ''
+                self.handleError(entry[1])
+        return entry[2]
+
+    def _start_seq(self, client, end):
+        # first batch since the client connected, start at its connect time
+        seq = end
+        for entry in reversed(self.records):
+            if entry[1].created < client.connected_at:
+                break
+            seq = entry[0]
+        return seq
+
+    def _send_batch(self):
+        clients = self.clients_getter()
+        if not clients or not self.records:
+            return
+        # records are appended by other threads too, with the handler lock held
+        with self.lock:
+            end = self.next_seq
+            oldest = end - len(self.records)
+            for client in clients:
+                if client.log_seq is None:
+                    client.log_seq = self._start_seq(client, end)
+            # only the entries after the least advanced cursor are copied,
+            # taken from the right end of the ring buffer
+            start = max(min(client.log_seq for client in clients), oldest)
+            if start >= end:
+                return
+            entries = list(itertools.islice(reversed(self.records), end - start))
+        entries.reverse()
+        for client in clients:
+            if client.log_seq >= end or client.sending():
+                continue
+            lines = []
+            if client.log_seq < oldest:
+                dropped = oldest - client.log_seq
+                client.dropped += dropped
+                lines.append(f'... {dropped} log lines dropped')
+                client.log_seq = oldest
+            first = client.log_seq - start
+            batch = entries[first:first + self.max_batch]
+            log_filter = client.log_filter
+            lines.extend(self._format(entry) for entry in batch
+                         if log_filter is None or log_filter.match(entry[1]))
+            client.log_seq = batch[-1][0] + 1
+            if lines:
+                client.send_logs(lines)
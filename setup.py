@@ -1,4 +1,32 @@
+import os
+import gzip
+import shutil
 from setuptools import setup
+from setuptools.command.build_py import build_py
+
+# same extensions as pymock.assets.compressible
+compressible = ('.html', '.js', '.css', '.json', '.svg', '.txt')
+
+
+class BuildPyWithGzip(build_py):
+    # web ui files are gzipped at build time, the controller serves the .gz
+    # variant to clients accepting it instead of compressing at runtime
+    def run(self):
+        super().run()
+        res_dir = os.path.join(self.build_lib, 'pymock', 'res')
+        for root, _, files in os.walk(res_dir):
+            for name in files:
+                if not name.endswith(compressible):
+                    continue
+                path = os.path.join(root, name)
+                gz_path = f'{path}.gz'
+                with open(path, 'rb') as f, open(gz_path, 'wb') as out:
+                    # mtime=0 keeps the builds reproducible
+                    with gzip.GzipFile(os.path.basename(path), 'wb', 9, out, mtime=0) as gz:
+                        shutil.copyfileobj(f, gz)
+                if os.path.getsize(gz_path) >= os.path.getsize(path):
+                    os.remove(gz_path)
+
 
 setup(
     name='pymock',
@@ -7,7 +35,10 @@ setup(
     author='triplezee',
     packages=['pymock'],
     package_data={
-        'pymock': ['res/*'],
+        'pymock': ['res/*', 'res/*/*', 'res/*/*/*'],
+    },
+    cmdclass={
+        'build_py': BuildPyWithGzip
     },
 
     entry_points={